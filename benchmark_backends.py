@@ -0,0 +1,100 @@
+"""
+Подготовка и сравнение бэкендов инференса модели занятости парковок.
+
+Экспортирует модель из config.PARKING_ANALYSIS_PARAMS в ONNX, квантует ее в int8
+(калибровка по вырезкам слотов), измеряет пропускную способность каждого бэкенда и
+согласие с эталоном на выборке слотов и рекомендует самый быстрый бэкенд в пределах
+допуска. Отчет сохраняется в OUTPUT_DIR_REL/BACKEND_BENCHMARK_FILENAME.
+
+Запуск: python benchmark_backends.py [--ortho путь] [--layout путь] [--force]
+"""
+import argparse
+import logging
+import os
+import sys
+
+import config
+from core import io_utils, model_tools
+from utils import helpers
+
+logger = logging.getLogger(__name__)
+
+def prepare_models(model_path: str, calibration_images, input_size: int, force: bool = False):
+    """ Экспорт ONNX (для .pt) и квантование int8; существующие файлы переиспользуются без force. """
+    onnx_path = model_path
+    if model_path.endswith('.pt'):
+        onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+        if force or not os.path.exists(onnx_path):
+            try:
+                onnx_path = model_tools.export_onnx(model_path, input_size=input_size)
+            except ImportError as e:
+                logger.error(f"Экспорт в ONNX невозможен ({e}): установите ultralytics.")
+                return
+    int8_path = os.path.splitext(onnx_path)[0] + '.int8.onnx'
+    if os.path.exists(onnx_path) and (force or not os.path.exists(int8_path)):
+        try:
+            model_tools.quantize_onnx(onnx_path, calibration_images, input_size=input_size)
+        except ImportError as e:
+            logger.error(f"Квантование невозможно ({e}): установите onnxruntime и onnx.")
+
+def main(argv=None) -> int:
+    params = config.PARKING_ANALYSIS_PARAMS
+    bench = config.BACKEND_BENCHMARK_PARAMS
+    parser = argparse.ArgumentParser(description="Экспорт, квантование и сравнение бэкендов инференса.")
+    parser.add_argument('--ortho', default=os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL, config.ORTHO_OUTPUT_FILENAME),
+                        help="Ортофотоплан для выборки вырезок слотов")
+    parser.add_argument('--layout', default=os.path.join(config.PROJECT_ROOT, config.PARKING_LAYOUT_DIR_REL, params['slot_filename']),
+                        help="Файл разметки слотов (JSON)")
+    parser.add_argument('--model', default=os.path.join(config.PROJECT_ROOT, config.MODELS_DIR_REL, params['model_filename']),
+                        help="Эталонная модель (.pt или .onnx)")
+    parser.add_argument('--backends', nargs='+', default=list(bench['backends']), help="Сравниваемые бэкенды")
+    parser.add_argument('--force', action='store_true', help="Пересоздать экспорт ONNX и int8-модель")
+    args = parser.parse_args(argv)
+
+    helpers.setup_logging(level=config.LOGGING_LEVEL)
+    slot_definitions = io_utils.load_json(args.layout)
+    if not isinstance(slot_definitions, list) or not os.path.exists(args.ortho) or not os.path.exists(args.model):
+        logger.error("Нужны ортофотоплан, разметка слотов и файл модели (см. --ortho, --layout, --model).")
+        return 1
+
+    read_block_size = params.get('read_block_size', 512)
+    # Калибровка int8 - на слотах, не входящих в оценочную выборку, чтобы не завышать согласие
+    sample_indices, calibration_indices = model_tools.split_sample_indices(
+        len(slot_definitions), bench['sample_size'], bench['calibration_size'], seed=0)
+    images = model_tools.sample_slot_crops(args.ortho, slot_definitions, sample_indices,
+                                           read_block_size=read_block_size)
+    calibration = model_tools.sample_slot_crops(args.ortho, slot_definitions, calibration_indices,
+                                                read_block_size=read_block_size)
+    logger.info(f"Выборка: {len(images)} вырезок для сравнения, {len(calibration)} для калибровки.")
+    prepare_models(args.model, calibration, params.get('input_size', 320), force=args.force)
+
+    try:
+        report = model_tools.benchmark_backends(
+            args.model, images, args.backends,
+            reference_backend='torch' if args.model.endswith('.pt') else 'onnx',
+            batch_size=params.get('batch_size', 32), num_threads=params.get('num_threads', 4),
+            confidence_threshold=params.get('confidence_threshold', 0.4),
+            iou_threshold=params.get('iou_threshold', 0.5), input_size=params.get('input_size', 320),
+            repeats=bench['repeats'])
+    except (RuntimeError, ValueError) as e:
+        logger.error(f"Сравнение бэкендов невозможно: {e}")
+        return 1
+
+    recommended = model_tools.select_backend(report, bench['tolerance'])
+    io_utils.save_json({'sample_size': len(images), 'tolerance': bench['tolerance'], 'recommended': recommended,
+                        'backends': report},
+                       os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL, config.BACKEND_BENCHMARK_FILENAME))
+    for entry in report:
+        if entry['error']:
+            logger.info(f"  {entry['backend']:<10} ошибка: {entry['error']}")
+        else:
+            logger.info(f"  {entry['backend']:<10} {entry['crops_per_s']:>8.1f} вырезок/с  "
+                        f"согласие {entry['agreement']:.2%}  d(уверенность) {entry['mean_confidence_diff']:.3f}")
+    if recommended:
+        logger.info(f"Рекомендуемый бэкенд: PARKING_ANALYSIS_PARAMS['backend'] = '{recommended}'")
+    else:
+        logger.warning("Ни один бэкенд не укладывается в допуск по согласию с эталоном.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,9 +18,64 @@ PARKING_LAYOUT_DIR_REL = 'data/parking_layout'
 MODELS_DIR_REL = 'models'
 
 # --- Параметры запуска ODM (для odm_runner.py) ---
-ODM_RUN_METHOD = 'docker'                 # Метод запуска: 'docker' или 'native'
+ODM_RUN_METHOD = 'docker'                 # Метод запуска: 'docker', 'native' или 'worker' (сервер задач NodeODM)
 ODM_DOCKER_IMAGE = 'opendronemap/odm:latest' # Docker образ ODM (можно 'opendronemap/odm:3.1.1' и т.д.)
 ODM_PROJECT_NAME = "odm_processing"
+ODM_RUN_CACHE = True                      # Пропускать ODM, если изображения, опции и образ не изменились с прошлого запуска
+ODM_RESUME = True                         # Продолжать упавший запуск с последней завершенной стадии (--rerun-from)
+ODM_MAX_RETRIES = 1                       # Число автоматических повторов ODM после ошибки (0 - без повторов)
+ODM_METRICS_FILENAME = 'odm_stage_metrics.json' # Длительность и счетчики стадий ODM (в OUTPUT_DIR_REL)
+ODM_RESOURCE_SAMPLING = True              # Опрашивать CPU/память/ввод-вывод контейнера ODM во время запуска?
+ODM_RESOURCE_SAMPLE_INTERVAL_S = 2.0      # Период опроса ресурсов, сек
+ODM_RESOURCE_METRICS_FILENAME = 'odm_resource_metrics.json' # Временной ряд ресурсов ODM (в OUTPUT_DIR_REL)
+ODM_RESOURCE_PROM_FILENAME = 'odm_resource_metrics.prom'    # Сводка ресурсов в формате Prometheus (в OUTPUT_DIR_REL)
+
+# --- Сервер задач ODM (для run_method='worker') ---
+# Долгоживущий NodeODM держит ODM "теплым": нет холодного старта контейнера на каждый полет.
+# Изображения загружаются по API, результаты скачиваются в OUTPUT_DIR_REL/<проект>.
+ODM_WORKER_PARAMS = {
+    "url": "http://127.0.0.1:3000",        # Адрес сервера: http://host:port или unix:///path/to.sock
+    "token": None,                         # Токен доступа NodeODM (--token), если задан
+    "autostart": True,                     # Запускать контейнер сервера, если он не отвечает
+    "image": "opendronemap/nodeodm:latest", # Образ сервера для автозапуска
+    "container_name": "odm-worker",        # Имя контейнера сервера (также для опроса ресурсов)
+    "poll_interval_s": 5.0,                # Период опроса статуса и лога задачи, сек
+    "upload_parallel": 4,                  # Параллельные загрузки изображений
+    "outputs": None,                       # Пути результатов в архиве (None - все), напр. ["odm_orthophoto/odm_orthophoto.tif", "odm_dem/dsm.tif"]
+    "remove_after_download": True,         # Удалять задачу на сервере после скачивания результатов
+}
+
+# --- Экспорт ортофотоплана в папку вывода ---
+ORTHO_OUTPUT_FILENAME = 'orthophoto.tif'  # Имя ортофотоплана для анализа (в папке вывода)
+ORTHO_COG_ENABLED = True                  # Конвертировать в Cloud-Optimized GeoTIFF? (False - жесткая ссылка/reflink)
+ORTHO_COG_PARAMS = {
+    "blocksize": 512,                     # Размер внутренних тайлов, пикс.
+    "compress": "DEFLATE",                # Сжатие без потерь (JPEG/WEBP меньше, но меняют пиксели для анализа)
+    "predictor": 2,                       # Горизонтальный предиктор для DEFLATE/LZW/ZSTD
+    "overview_resampling": "average",     # Ресэмплинг пирамиды обзоров
+    "num_threads": "ALL_CPUS",            # Потоки GDAL для сжатия
+}
+
+# --- Автоподбор опций ODM под бюджет (для odm_profile.py) ---
+ODM_AUTOTUNE_ENABLED = False              # Подбирать max-concurrency/resize-to/fast-orthophoto по набору, хосту и истории?
+ODM_AUTOTUNE_PARAMS = {
+    "time_budget_s": 4 * 3600,            # Допустимое время запуска ODM, сек (None - без ограничения)
+    "memory_budget_gb": None,             # Допустимая память, ГБ (None - доля доступной памяти)
+    "memory_reserve_fraction": 0.8,       # Доля доступной памяти, если memory_budget_gb не задан
+    "resize_ladder": [4000, 3200, 2400, 2000, 1600], # Варианты resize-to (длинная сторона, пикс)
+}
+ODM_RUN_HISTORY_FILENAME = 'odm_run_history.jsonl' # История запусков ODM для калибровки (в OUTPUT_DIR_REL)
+ODM_PROFILE_FILENAME = 'odm_profile.json' # Выбранные опции и обоснование (в OUTPUT_DIR_REL)
+
+# --- Режим split-merge для больших полетов (odm_runner.run_odm_split) ---
+ODM_SPLIT_ENABLED = False                 # Делить снимки на GPS-кластеры и считать подмодели параллельно?
+ODM_SPLIT_PARAMS = {
+    "min_images": 1000,                   # Разбивать только наборы от этого размера
+    "max_images_per_submodel": 400,       # Максимум снимков в подмодели (без учета перекрытия)
+    "overlap_m": 50.0,                    # Перекрытие соседних подмоделей, м
+    "max_parallel": 2,                    # Максимум одновременных контейнеров ODM
+    "memory_budget_gb": None,             # Общий бюджет памяти подмоделей, ГБ (None - без ограничения)
+}
 
 ODM_OPTIONS = {
     "dsm": True,                      # Генерировать DSM?
@@ -37,15 +92,114 @@ ODM_OPTIONS = {
     "matcher-type": "flann",
 }
 
+# --- Очередь полетов (для job_queue.py) ---
+JOB_QUEUE_ENABLED = False                 # Обрабатывать очередь полетов вместо одной папки INPUT_IMAGE_DIR_REL?
+JOB_QUEUE_DB_REL = 'data/jobs.sqlite'     # База очереди заданий (относительно PROJECT_ROOT)
+JOB_MAX_RETRIES = 1                       # Повторы задания после ошибки
+JOB_DEFAULT_MEMORY_GB = 8.0               # Минимальная память, резервируемая под задание, ГБ
+JOB_SCHEDULER_PARAMS = {
+    "total_cores": None,                  # Бюджет ядер узла (None - все ядра)
+    "total_memory_gb": None,              # Бюджет памяти узла, ГБ (None - доступная память)
+    "max_parallel_jobs": 2,               # Максимум одновременно выполняемых полетов
+    "poll_interval_s": 5.0,               # Период опроса очереди, сек
+}
+
+# --- Конвейер потока полетов (для orchestrator.py) ---
+ORCHESTRATOR_ENABLED = False              # Обрабатывать подпапки FLIGHTS_DIR_REL конвейером (стадии перекрываются)?
+FLIGHTS_DIR_REL = 'flights'               # Папка с полетами: каждая подпапка - изображения одного полета
+ORCHESTRATOR_STAGE_LIMITS = {             # Одновременные выполнения каждой стадии
+    "odm": 1,
+    "postprocess": 2,
+    "analysis": 1,
+}
+ORCHESTRATOR_SUMMARY_FILENAME = 'pipeline_summary.json' # Время стадий по полетам (в OUTPUT_DIR_REL)
+
+# --- Предобработка снимков перед ODM (для preingest.py) ---
+PREINGEST_ENABLED = False                 # Сканировать EXIF, отбрасывать размытые/дубли и готовить staging-папку для ODM
+STAGING_DIR_REL = 'data/staging_images'   # Папка с отобранными (и, возможно, уменьшенными) снимками, монтируется в ODM
+PREINGEST_PARAMS = {
+    'workers': multiprocessing.cpu_count(), # Процессы для параллельного сканирования снимков
+    'blur_threshold': 50.0,            # Мин. дисперсия лапласиана (на копии ~1024 px); ниже - кадр размыт
+    'duplicate_hash_distance': 4,      # Макс. расстояние Хэмминга pHash до предыдущего кадра для дубля (-1 - не искать)
+    'duplicate_max_distance_m': 2.0,   # Макс. смещение точки съемки (м) для дубля (зависание дрона)
+    'downscale_max_side': None,        # Уменьшать снимки до этой длинной стороны (px), None - без уменьшения
+    'jpeg_quality': 95                 # Качество JPEG для уменьшенных копий
+}
+PREINGEST_REPORT_FILENAME = 'preingest_report.json' # Отчет предобработки (в OUTPUT_DIR_REL)
+
+# --- Наблюдение за папкой загрузки (для watch_ingest.py, подкоманда main.py watch) ---
+WATCH_PARAMS = {
+    'poll_interval_s': 5.0,            # Период пересканирования папки (с); с inotify - макс. ожидание события
+    'use_inotify': True,               # inotify на Linux; на WSL (/mnt/c) и сетевых папках события не приходят - опрос
+    'stable_seconds': 10.0,            # Файл считается докопированным, если размер и mtime не менялись столько секунд
+    'quiet_period_s': 300.0,           # Запуск ODM после стольких секунд без новых файлов (None - не использовать)
+    'expected_count': None,            # Запуск ODM после стольких принятых снимков (None - не использовать)
+    'manifest_filename': 'flight_manifest.json', # Список снимков полета в папке загрузки: запуск, когда все получены
+    'min_images': 5                    # Меньше снимков - полет не запускается
+}
+
+# CRS координат разметки парковки (обычно совпадает с CRS ортофото ODM - UTM зоны площадки).
+# Общий для отбора снимков по разметке и для таблицы слотов анализа (при другом CRS ортофото разметка перепроецируется)
+LAYOUT_CRS = 'EPSG:32637'
+
+# --- Отбор снимков по области интереса (разметке парковки) перед ODM (для footprint_index.py) ---
+ROI_FILTER_ENABLED = False                # Передавать в ODM только снимки, покрывающие разметку парковки
+ROI_FILTER_PARAMS = {
+    'margin_m': 20.0,                  # Запас вокруг охвата разметки (м)
+    'neighbour_rings': 1,              # Доп. расширение запроса на N медианных размеров следа (перекрытие для SfM)
+    'min_images': 5,                   # Если отобрано меньше - используются все снимки
+    'default_agl_m': 100.0,            # Высота полета над землей (м), если ее нет в XMP
+    'default_hfov_deg': 73.7,          # Горизонтальный угол обзора камеры, если нет фокусного расстояния 35 мм
+    'ground_elevation_m': None         # Абс. высота земли (м) для расчета AGL из GPS-высоты (None - не использовать)
+}
+
 # --- Параметры анализа парковок (для analysis.py) ---
 RUN_PARKING_ANALYSIS = False             # Включить/выключить анализ
 PARKING_ANALYSIS_PARAMS = {
     'model_filename': 'yolov8s_parking_best.pt', # Имя файла модели YOLO (.pt) в папке MODELS_DIR_REL
     'slot_filename': 'parking_slots_layout.json',# Имя файла разметки в PARKING_LAYOUT_DIR_REL
     'confidence_threshold': 0.4,       # Порог уверенности для детекции YOLO
-    'iou_threshold': 0.5                 # Порог IoU для NMS (если используется)
+    'iou_threshold': 0.5,                # Порог IoU для NMS (если используется)
+    'read_block_size': 512,              # Мин. сторона окна чтения ортофото (кратно внутренним блокам GeoTIFF)
+    'zonal_stats': True,                 # Считать статистику по слотам (mean/std/гистограммы) за один проход
+    'histogram_bins': 16,                # Число бинов гистограммы на канал для статистики слотов
+    'occupancy_mode': 'image',           # Источник занятости: 'image' (модель), 'dsm' (высоты над землей), 'fused' (оба)
+    'dsm_min_vehicle_height': 1.0,       # Мин. высота объекта над землей (м), при которой слот занят
+    'dsm_max_vehicle_height': 4.0,       # Выше этой высоты (м) объект не считается ТС (деревья, навесы)
+    'dsm_ground_margin': 3.0,            # Ширина окрестности слота (в единицах CRS, м) для оценки земли без DTM
+    'batch_size': 32,                    # Число вырезок слотов в одном пакете инференса
+    'num_threads': max(1, multiprocessing.cpu_count() // 2), # Потоки CPU для инференса (PyTorch/ONNX Runtime)
+    'input_size': 320,                   # Размер входа модели (px); для .onnx берется из самой модели, если фиксирован
+    'backend': 'auto',                   # Бэкенд инференса: 'auto' (по расширению модели), 'torch', 'onnx', 'onnx_int8', 'opencv'
+    'prefetch_batches': 2,               # Сколько пакетов вырезок готовить заранее в фоновом потоке
+    'cascade': False,                    # Каскад "грубо-точно": сначала все слоты по обзорам, в полном разрешении - только неуверенные
+    'cascade_overview_factor': 4,        # Макс. фактор уменьшения уровня обзоров для грубой оценки (нужен COG/обзоры)
+    'cascade_uncertainty_band': (0.2, 0.8), # Оценка занятости внутри полосы - слот перепроверяется в полном разрешении
+    'cascade_min_slot_px': 12,           # Мин. сторона слота (px) на грубом уровне, иначе сразу полное разрешение
+    'incremental': False,                # Повторные полеты площадки: модель только для слотов, изменившихся с прошлого расчета
+    'incremental_change_threshold': 0.08, # Порог изменения отпечатка слота (средняя разница нормированной яркости)
+    'incremental_fingerprint_size': 8,   # Сторона отпечатка слота (px, RGB)
+    'incremental_max_reuse': 5,          # Статус переносится не более N полетов подряд, затем слот пересчитывается
+    'slot_table_cache': True,            # Разметка в массивах NumPy с кэшем пиксельной геометрии (.npz) для каждого ортофото
+    'decoded_cache': False,              # Декодировать ортофото один раз в .npy (memmap) для повторных анализов (подбор порогов, модели)
+    'decoded_cache_max_gb': 20           # Лимит размера кэша декодированных растров (ГБ), старые записи вытесняются
 }
+# Сравнение бэкендов инференса (python benchmark_backends.py)
+BACKEND_BENCHMARK_PARAMS = {
+    'backends': ['onnx', 'onnx_int8', 'opencv'], # Сравниваются с эталоном (исходная модель: .pt - PyTorch, .onnx - ONNX Runtime)
+    'sample_size': 256,                  # Вырезок слотов в оценочной выборке
+    'calibration_size': 128,             # Вырезок слотов для калибровки int8 (не пересекается с оценочной)
+    'repeats': 3,                        # Проходов по выборке (берется лучший)
+    'tolerance': 0.02                    # Допустимая доля расхождений статусов с эталоном
+}
+BACKEND_BENCHMARK_FILENAME = 'backend_benchmark.json' # Отчет сравнения бэкендов (в OUTPUT_DIR_REL)
+ANALYSIS_NUM_WORKERS = 1                  # Число процессов для параллельного анализа по тайлам (1 - без параллелизма)
+ANALYSIS_TILE_SIZE = 4096                 # Сторона тайла ортофото (px) при распределении слотов по процессам
 ANALYSIS_RESULTS_FILENAME = 'parking_analysis_results.json' # Имя файла для сохранения результатов анализа (в OUTPUT_DIR_REL)
+SLOT_TABLE_CACHE_DIR_REL = 'data/output/cache/slot_tables' # Кэш таблиц разметки (.npz), ключ - хэш разметки и сетка растра
+DECODED_RASTER_CACHE_DIR_REL = 'data/output/cache/decoded_rasters' # Кэш декодированных ортофото (.npy + .json сайдкар)
+SLOT_FINGERPRINTS_SUFFIX = '_fingerprints.npz' # Отпечатки слотов для инкрементального анализа (<имя разметки><суффикс> в OUTPUT_DIR_REL)
+ZONAL_STATS_FILENAME = 'parking_slot_stats.json' # Имя файла статистики по слотам (в OUTPUT_DIR_REL)
 
 USE_LLM_ASSISTANT = False                 # Использовать LLM для генерации отчета?
 LM_STUDIO_API_BASE = "http://localhost:1234/v1" # URL сервера LM Studio
@@ -60,3 +214,9 @@ REPORT_FILENAME = "processing_report.txt" # Имя файла для отчет
 LOGGING_LEVEL = 'INFO'                    # Уровни: DEBUG, INFO, WARNING, ERROR, CRITICAL
 LOG_TO_FILE = True                        # Записывать ли лог в файл?
 LOG_FILENAME = 'orthophoto_analyzer.log'  # Имя файла лога (будет сохранен в OUTPUT_DIR_REL)
+
+# --- Профилирование (helpers.Timer -> helpers.profiler) ---
+PROFILING_ENABLED = False                  # Записывать интервалы Timer (время, вложенность, память, атрибуты)?
+PROFILING_TRACEMALLOC = False              # Учитывать Python-аллокации через tracemalloc (заметно замедляет)
+PROFILE_SUMMARY_FILENAME = 'profile_summary.json' # Сводка по интервалам (в OUTPUT_DIR_REL)
+PROFILE_TRACE_FILENAME = 'profile_trace.json'     # Трасса для chrome://tracing / Perfetto (в OUTPUT_DIR_REL)
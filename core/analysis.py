@@ -1,35 +1,449 @@
 import numpy as np
 import logging
 import os
-from typing import List, Dict, Any, Optional
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 import rasterio 
+from rasterio.windows import Window
+
+from core import inference, raster_cache
+from core.slot_table import SlotTable
+from utils import helpers
 
 logger = logging.getLogger(__name__)
 
-def load_parking_model(model_dir: str, model_filename: str):
-    """ Загружает модель для анализа парковок. """
-    model_path = os.path.join(model_dir, model_filename)
-    if not os.path.exists(model_path):
-        logger.error(f"Файл модели не найден: {model_path}")
+def load_parking_model(model_dir: str, model_filename: str, batch_size: int = 32, num_threads: int = 4,
+                       confidence_threshold: float = 0.4, iou_threshold: float = 0.5, input_size: int = 320,
+                       backend: str = 'auto'):
+    """
+    Загружает модель для анализа парковок (один раз на запуск).
+
+    Поддерживаются веса ultralytics (.pt) и экспортированная модель ONNX (.onnx).
+    Если файл .pt отсутствует, но рядом лежит .onnx с тем же именем, используется он.
+    Бэкенды 'onnx', 'onnx_int8' и 'opencv' берут файл, подготовленный model_tools
+    (экспорт .onnx / квантованный .int8.onnx рядом с весами).
+
+    Returns:
+        inference.ParkingInferenceEngine или None при ошибке.
+    """
+    model_path = inference.backend_model_path(os.path.join(model_dir, model_filename), backend)
+    if backend not in ('auto', 'torch') and not os.path.exists(model_path):
+        logger.error(f"Файл модели для бэкенда '{backend}' не найден: {model_path}. "
+                     f"Подготовьте его: python benchmark_backends.py")
         return None
+    if not os.path.exists(model_path):
+        onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+        if os.path.exists(onnx_path):
+            logger.info(f"Файл модели {model_filename} не найден, используется экспорт ONNX: {onnx_path}")
+            model_path = onnx_path
+        else:
+            logger.error(f"Файл модели не найден: {model_path}")
+            return None
     logger.info(f"Загрузка модели анализа парковок из: {model_path}")
    
     try:
-        logger.warning("Загрузка реальной модели не реализована. Возвращена заглушка.")
-        return "dummy_parking_model" # Возвращаем строку как заглушку
+        return inference.ParkingInferenceEngine(
+            model_path,
+            batch_size=batch_size,
+            num_threads=num_threads,
+            confidence_threshold=confidence_threshold,
+            iou_threshold=iou_threshold,
+            input_size=input_size,
+            backend=backend
+        )
     except ImportError as ie:
-         logger.error(f"Необходимая библиотека для загрузки модели не найдена: {ie}. Установите TensorFlow или PyTorch.")
+         logger.error(f"Необходимая библиотека для загрузки модели не найдена: {ie}. Установите ultralytics (PyTorch), onnxruntime или opencv-python.")
          return None
     except Exception as e:
         logger.error(f"Ошибка при загрузке модели {model_path}: {e}", exc_info=True)
         return None
 
+def _slot_pixel_bbox(geometry, transform, width: int, height: int) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Переводит полигон слота (координаты в CRS растра) в пиксельный bbox.
+
+    Returns:
+        Кортеж (row_start, col_start, row_stop, col_stop), обрезанный по границам растра,
+        или None, если геометрия некорректна или слот лежит вне растра.
+    """
+    try:
+        coords = np.asarray(geometry, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if coords.ndim != 2 or coords.shape[0] < 3 or coords.shape[1] < 2:
+        return None
+    # Обратное аффинное преобразование: мировые координаты -> (col, row)
+    inv = ~transform
+    xs, ys = coords[:, 0], coords[:, 1]
+    cols = inv.a * xs + inv.b * ys + inv.c
+    rows = inv.d * xs + inv.e * ys + inv.f
+    row_start = max(int(np.floor(rows.min())), 0)
+    col_start = max(int(np.floor(cols.min())), 0)
+    row_stop = min(int(np.ceil(rows.max())), height)
+    col_stop = min(int(np.ceil(cols.max())), width)
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+    return row_start, col_start, row_stop, col_stop
+
+def _slot_id(slot_definitions, index: int) -> Any:
+    """ id слота по индексу (для SlotTable - без построения словаря слота). """
+    if isinstance(slot_definitions, SlotTable):
+        return slot_definitions.slot_id(index)
+    return slot_definitions[index].get('id', 'unknown_slot')
+
+def subset_slots(slot_definitions, indices: List[int]):
+    """ Подмножество разметки в том же представлении (SlotTable или список словарей). """
+    if isinstance(slot_definitions, SlotTable):
+        return slot_definitions.subset(indices)
+    return [slot_definitions[i] for i in indices]
+
+def slot_pixel_boxes(slot_definitions, src, warn: bool = True) -> Dict[int, Tuple[int, int, int, int]]:
+    """ Пиксельные bbox слотов внутри растра {индекс: bbox} (для SlotTable - векторно/из кэша). """
+    if isinstance(slot_definitions, SlotTable):
+        boxes = slot_definitions.pixel_boxes(src.transform, src.width, src.height)
+        inside = np.flatnonzero(boxes[:, 2] > boxes[:, 0])
+        if warn and len(inside) < len(slot_definitions):
+            logger.warning(f"{len(slot_definitions) - len(inside)} слотов вне ортофотоплана или без корректной геометрии. Пропуск.")
+        return {int(i): tuple(int(v) for v in boxes[i]) for i in inside}
+    slot_boxes: Dict[int, Tuple[int, int, int, int]] = {}
+    for idx, slot in enumerate(slot_definitions):
+        slot_id = slot.get('id', 'unknown_slot')
+        geometry = slot.get('geometry')
+        if not geometry:
+            if warn:
+                logger.warning(f"Отсутствует геометрия для слота ID: {slot_id}")
+            continue
+        bbox = _slot_pixel_bbox(geometry, src.transform, src.width, src.height)
+        if bbox is None:
+            if warn:
+                logger.warning(f"Слот ID: {slot_id} вне ортофотоплана или имеет некорректную геометрию. Пропуск.")
+            continue
+        slot_boxes[idx] = bbox
+    return slot_boxes
+
+def _read_tile_shape(src, min_read_size: int) -> Tuple[int, int]:
+    """
+    Размер "тайла чтения": внутренний блок GeoTIFF, увеличенный кратно до min_read_size.
+    Для полосовых (striped) файлов блок 1xW превращается в полосу из нескольких строк.
+    """
+    block_h, block_w = src.block_shapes[0]
+    block_h, block_w = max(int(block_h), 1), max(int(block_w), 1)
+    tile_h = block_h * max(1, -(-min_read_size // block_h))
+    tile_w = block_w * max(1, -(-min_read_size // block_w))
+    return min(tile_h, src.height), min(tile_w, src.width)
+
+def _group_slots_by_tile(slot_boxes: Dict[int, Tuple[int, int, int, int]],
+                         tile_shape: Tuple[int, int]) -> List[Tuple[Tuple[int, int], List[int]]]:
+    """
+    Группирует слоты по тайлу чтения, в который попадает левый верхний угол их bbox.
+    Группы возвращаются в порядке строк/столбцов тайлов (последовательный I/O).
+    """
+    tile_h, tile_w = tile_shape
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for idx, (r0, c0, _, _) in slot_boxes.items():
+        groups.setdefault((r0 // tile_h, c0 // tile_w), []).append(idx)
+    return sorted(groups.items())
+
+def iter_slot_crops(src, slot_definitions: List[Dict[str, Any]], min_read_size: int = 512):
+    """
+    Генератор вырезок растра для слотов с чтением по внутренним блокам GeoTIFF.
+
+    Слоты группируются по тайлам чтения (кратным внутренним блокам файла); для каждой
+    группы одним окном rasterio читается объединение их bbox, выровненное по границам
+    блоков, и из этого буфера раздаются вырезки. Пиковое потребление памяти ограничено
+    размером одной группы, а чтение идет последовательно по файлу.
+
+    Args:
+        src: Открытый набор данных rasterio.
+        slot_definitions: Список слотов с ключами 'id' и 'geometry' или SlotTable.
+        min_read_size: Минимальная сторона окна чтения в пикселях.
+
+    Yields:
+        Кортежи (индекс_слота, слот, вырезка[bands, h, w], bbox). Для SlotTable вместо
+        словаря слота передается его id.
+    """
+    slot_boxes = slot_pixel_boxes(slot_definitions, src)
+    if not slot_boxes:
+        return
+
+    is_table = isinstance(slot_definitions, SlotTable)
+    block_h, block_w = src.block_shapes[0]
+    tile_shape = _read_tile_shape(src, min_read_size)
+    groups = _group_slots_by_tile(slot_boxes, tile_shape)
+    logger.debug(f"Блок GeoTIFF: {block_h}x{block_w}, тайл чтения: {tile_shape[0]}x{tile_shape[1]}, "
+                 f"групп чтения: {len(groups)}")
+
+    for _, indices in groups:
+        boxes = [slot_boxes[i] for i in indices]
+        # Объединение bbox группы, выровненное по границам внутренних блоков файла
+        win_r0 = (min(b[0] for b in boxes) // block_h) * block_h
+        win_c0 = (min(b[1] for b in boxes) // block_w) * block_w
+        win_r1 = min(-(-max(b[2] for b in boxes) // block_h) * block_h, src.height)
+        win_c1 = min(-(-max(b[3] for b in boxes) // block_w) * block_w, src.width)
+        window = Window(win_c0, win_r0, win_c1 - win_c0, win_r1 - win_r0)
+        buffer = src.read(window=window)
+        for idx, (r0, c0, r1, c1) in zip(indices, boxes):
+            crop = buffer[:, r0 - win_r0:r1 - win_r0, c0 - win_c0:c1 - win_c0]
+            yield idx, _slot_id(slot_definitions, idx) if is_table else slot_definitions[idx], crop, (r0, c0, r1, c1)
+        del buffer
+
+_END_OF_BATCHES = object()
+
+def iter_crop_batches(orthophoto_path: str, slot_definitions: List[Dict[str, Any]], batch_size: int,
+                      read_block_size: int = 512, prefetch_batches: int = 2, overview_level: Optional[int] = None):
+    """
+    Генератор пакетов вырезок слотов с предзагрузкой в фоновом потоке.
+
+    Фоновый поток читает растр (iter_slot_crops) и собирает пакеты по batch_size RGB-вырезок
+    в ограниченную очередь, пока вызывающий код выполняет инференс предыдущего пакета.
+    Исключения фонового потока пробрасываются в вызывающий поток. overview_level - индекс
+    уровня пирамиды обзоров (None - полное разрешение).
+
+    Yields:
+        Кортежи (список_индексов_слотов, список_RGB_вырезок).
+    """
+    batches: "queue.Queue" = queue.Queue(maxsize=max(1, prefetch_batches))
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _producer():
+        try:
+            with raster_cache.open_raster(orthophoto_path, overview_level=overview_level) as src:
+                indices, images = [], []
+                for idx, _, crop, _ in iter_slot_crops(src, slot_definitions, min_read_size=read_block_size):
+                    indices.append(idx)
+                    images.append(inference.crop_to_rgb(crop))
+                    if len(indices) >= batch_size:
+                        if not _put((indices, images)):
+                            return
+                        indices, images = [], []
+                if indices and not _put((indices, images)):
+                    return
+            _put(_END_OF_BATCHES)
+        except BaseException as e:
+            _put(e)
+
+    worker = threading.Thread(target=_producer, name="slot-crop-prefetch", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is _END_OF_BATCHES:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+def _score_slots(orthophoto_path: str, model, slot_definitions: List[Dict[str, Any]], read_block_size: int,
+                 prefetch_batches: int, overview_level: Optional[int] = None) -> List[Tuple[int, str, float]]:
+    """ Прогоняет слоты через модель пакетами. Возвращает тройки (индекс_слота, статус, уверенность). """
+    scored = []
+    # Пока модель обрабатывает пакет, фоновый поток читает растр и готовит следующий
+    for indices, images in iter_crop_batches(orthophoto_path, slot_definitions, model.batch_size,
+                                             read_block_size=read_block_size,
+                                             prefetch_batches=prefetch_batches,
+                                             overview_level=overview_level):
+        with helpers.Timer("Инференс пакета", log_level=logging.DEBUG, slots=len(images)):
+            batch_results = model.classify_batch(images)
+        scored.extend((idx, status, confidence) for idx, (status, confidence) in zip(indices, batch_results))
+    return scored
+
+def _confident_results(scored: List[Tuple[int, str, float]], slot_definitions: List[Dict[str, Any]],
+                       confidence_threshold: float) -> List[Tuple[int, Dict[str, Any]]]:
+    """ Пары (индекс_слота, результат) для слотов с уверенностью не ниже порога. """
+    indexed_results = []
+    for idx, status, confidence in scored:
+        slot_id = _slot_id(slot_definitions, idx)
+        if confidence >= confidence_threshold:
+             logger.debug(f"Слот {slot_id}: Статус={status}, Уверенность={confidence:.2f}")
+             indexed_results.append((idx, {'slot_id': slot_id, 'status': status, 'confidence': round(confidence, 3)}))
+        else:
+             logger.debug(f"Слот {slot_id}: Низкая уверенность ({confidence:.2f} < {confidence_threshold}). Пропуск.")
+    return indexed_results
+
+def _classify_slots(orthophoto_path: str, model, slot_definitions: List[Dict[str, Any]],
+                    confidence_threshold: float, read_block_size: int,
+                    prefetch_batches: int) -> List[Tuple[int, Dict[str, Any]]]:
+    """ Классифицирует слоты пакетами. Возвращает пары (индекс_слота, результат) для уверенных слотов. """
+    scored = _score_slots(orthophoto_path, model, slot_definitions, read_block_size, prefetch_batches)
+    return _confident_results(scored, slot_definitions, confidence_threshold)
+
+def select_overview_level(src, max_factor: int) -> Tuple[Optional[int], int]:
+    """ Самый грубый уровень пирамиды с фактором не больше max_factor: (индекс_уровня, фактор) или (None, 1). """
+    levels = [(level, factor) for level, factor in enumerate(src.overviews(1)) if factor <= max_factor]
+    return levels[-1] if levels else (None, 1)
+
+def _classify_slots_cascade(orthophoto_path: str, model, slot_definitions: List[Dict[str, Any]],
+                            confidence_threshold: float, read_block_size: int, prefetch_batches: int,
+                            overview_factor: int = 4, uncertainty_band: Tuple[float, float] = (0.2, 0.8),
+                            min_slot_px: int = 12) -> Tuple[List[Tuple[int, Dict[str, Any]]], Dict[str, Any]]:
+    """
+    Каскадная классификация: все слоты оцениваются на уровне обзоров (в overview_factor раз
+    меньше пикселей по стороне), в полном разрешении перечитываются только неуверенные.
+
+    Слот считается решенным на грубом уровне, если его оценка занятости (уверенность для
+    'occupied', 1 - уверенность для 'vacant') вне uncertainty_band и уверенность не ниже
+    порога. Слоты, меньшие min_slot_px на грубом уровне, сразу идут в полное разрешение.
+    Без пирамиды обзоров (не COG) все слоты анализируются в полном разрешении.
+
+    Returns:
+        Кортеж (пары (индекс_слота, результат), статистика по уровням).
+    """
+    with raster_cache.open_raster(orthophoto_path) as src:
+        level, factor = select_overview_level(src, overview_factor)
+        boxes = slot_pixel_boxes(slot_definitions, src, warn=False)
+    stats = {'overview_factor': factor if level is not None else None, 'coarse_scored': 0,
+             'resolved_coarse': 0, 'rescored_full': 0, 'direct_full': 0}
+    if level is None:
+        logger.warning(f"В ортофотоплане нет обзоров с фактором <= {overview_factor}: каскад невозможен, "
+                       f"анализ в полном разрешении (включите ORTHO_COG_ENABLED).")
+        scored = _score_slots(orthophoto_path, model, slot_definitions, read_block_size, prefetch_batches)
+        stats['direct_full'] = len(scored)
+        return _confident_results(scored, slot_definitions, confidence_threshold), stats
+
+    coarse_indices = [idx for idx, box in boxes.items() if min(box[2] - box[0], box[3] - box[1]) / factor >= min_slot_px]
+    with helpers.Timer("Каскад: уровень обзоров", overview_factor=factor, slots=len(coarse_indices)):
+        coarse_scored = _score_slots(orthophoto_path, model, subset_slots(slot_definitions, coarse_indices),
+                                     read_block_size, prefetch_batches, overview_level=level)
+    low, high = uncertainty_band
+    resolved = []
+    for local_idx, status, confidence in coarse_scored:
+        occupancy = confidence if status == 'occupied' else 1.0 - confidence
+        if confidence >= confidence_threshold and (occupancy >= high or occupancy <= low):
+            resolved.append((coarse_indices[local_idx], status, confidence))
+    resolved_indices = {idx for idx, _, _ in resolved}
+
+    # Неуверенные и слишком мелкие для грубого уровня слоты - в полном разрешении
+    full_indices = [idx for idx in range(len(slot_definitions)) if idx not in resolved_indices]
+    with helpers.Timer("Каскад: полное разрешение", slots=len(full_indices)):
+        full_scored = _score_slots(orthophoto_path, model, subset_slots(slot_definitions, full_indices),
+                                   read_block_size, prefetch_batches)
+    scored = resolved + [(full_indices[local_idx], status, confidence) for local_idx, status, confidence in full_scored]
+    stats.update(coarse_scored=len(coarse_scored), resolved_coarse=len(resolved),
+                 rescored_full=len(coarse_scored) - len(resolved),
+                 direct_full=len(full_scored) - (len(coarse_scored) - len(resolved)))
+    return _confident_results(scored, slot_definitions, confidence_threshold), stats
+
+def _merge_cascade_stats(total: Dict[str, Any], part: Dict[str, Any]):
+    """ Суммирует статистику каскада (по тайлам параллельного анализа). """
+    for key, value in part.items():
+        if key == 'overview_factor':
+            total[key] = total.get(key) or value
+        else:
+            total[key] = total.get(key, 0) + value
+
+def partition_slots_by_tile(orthophoto_path: str, slot_definitions: List[Dict[str, Any]],
+                            tile_size: int = 4096) -> List[List[int]]:
+    """
+    Разбивает ортофото на тайлы (кратные внутренним блокам) и распределяет по ним слоты.
+
+    Слот относится ровно к одному тайлу - тому, в который попадает центр его bbox. Слоты
+    на границе тайлов при этом читаются целиком: окна чтения не ограничены тайлом.
+    Слоты вне растра или без геометрии не попадают ни в один тайл.
+
+    Returns:
+        Списки индексов слотов по тайлам в порядке строк/столбцов тайлов.
+    """
+    tiles: Dict[Tuple[int, int], List[int]] = {}
+    with raster_cache.open_raster(orthophoto_path) as src:
+        tile_h, tile_w = _read_tile_shape(src, tile_size)
+        for idx, bbox in slot_pixel_boxes(slot_definitions, src).items():
+            center_row, center_col = (bbox[0] + bbox[2]) // 2, (bbox[1] + bbox[3]) // 2
+            tiles.setdefault((center_row // tile_h, center_col // tile_w), []).append(idx)
+    return [indices for _, indices in sorted(tiles.items())]
+
+# Модель, загруженная в процессе-обработчике тайлов (см. _init_tile_worker)
+_worker_model = None
+
+def _init_tile_worker(model_path: str, engine_kwargs: Dict[str, Any]):
+    """ Инициализатор процесса: загружает собственную копию модели один раз на процесс. """
+    global _worker_model
+    _worker_model = inference.ParkingInferenceEngine(model_path, **engine_kwargs)
+
+def _analyze_tile(orthophoto_path: str, tile_indices: List[int], tile_slots: List[Dict[str, Any]],
+                  confidence_threshold: float, read_block_size: int, prefetch_batches: int,
+                  cascade_params: Optional[Dict[str, Any]] = None) -> Tuple[List[Tuple[int, Dict[str, Any]]], Dict[str, Any]]:
+    """ Задача процесса: анализ слотов одного тайла со своим дескриптором rasterio. """
+    stats: Dict[str, Any] = {}
+    if cascade_params is not None:
+        local_results, stats = _classify_slots_cascade(orthophoto_path, _worker_model, tile_slots, confidence_threshold,
+                                                       read_block_size, prefetch_batches, **cascade_params)
+    else:
+        local_results = _classify_slots(orthophoto_path, _worker_model, tile_slots,
+                                        confidence_threshold, read_block_size, prefetch_batches)
+    # Переводим локальные индексы тайла в индексы исходной разметки
+    return [(tile_indices[i], res) for i, res in local_results], stats
+
+def _analyze_tiles_parallel(orthophoto_path: str, model, slot_definitions: List[Dict[str, Any]],
+                            confidence_threshold: float, read_block_size: int, prefetch_batches: int,
+                            num_workers: int, tile_size: int, cascade_params: Optional[Dict[str, Any]] = None,
+                            stats: Optional[Dict[str, Any]] = None) -> List[Tuple[int, Dict[str, Any]]]:
+    """ Распределяет тайлы по пулу процессов; каждый процесс открывает растр и модель сам. """
+    tiles = partition_slots_by_tile(orthophoto_path, slot_definitions, tile_size)
+    num_workers = max(1, min(num_workers, len(tiles)))
+    engine_kwargs = {
+        'batch_size': model.batch_size,
+        # Делим потоки инференса между процессами, чтобы не перегружать ядра
+        'num_threads': max(1, model.num_threads // num_workers),
+        'confidence_threshold': model.confidence_threshold,
+        'iou_threshold': model.iou_threshold,
+        'input_size': model.input_size,
+        'backend': model.backend_name,
+    }
+    logger.info(f"Параллельный анализ: {len(tiles)} тайлов, {num_workers} процессов, "
+                f"{engine_kwargs['num_threads']} потоков инференса на процесс.")
+
+    indexed_results = []
+    # 'spawn' - безопасный старт процессов при уже инициализированных потоках PyTorch/GDAL
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_tile_worker,
+                             initargs=(model.model_path, engine_kwargs)) as executor:
+        futures = [executor.submit(_analyze_tile, orthophoto_path, indices,
+                                   subset_slots(slot_definitions, indices),
+                                   confidence_threshold, read_block_size, prefetch_batches, cascade_params)
+                   for indices in tiles]
+        for future in futures:
+            tile_results, tile_stats = future.result()
+            indexed_results.extend(tile_results)
+            if stats is not None:
+                _merge_cascade_stats(stats, tile_stats)
+    return indexed_results
+
 def analyze_parking_slots(
     orthophoto_path: str,
     model,
     slot_definitions: List[Dict[str, Any]], 
-    confidence_threshold: float = 0.7
+    confidence_threshold: float = 0.7,
+    read_block_size: int = 512,
+    prefetch_batches: int = 2,
+    num_workers: int = 1,
+    tile_size: int = 4096,
+    cascade_params: Optional[Dict[str, Any]] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    decoded_cache_params: Optional[Dict[str, Any]] = None
 ) -> List[Dict[str, Any]]:
+    """
+    Определяет статус слотов по ортофотоплану.
+
+    cascade_params (overview_factor, uncertainty_band, min_slot_px) включает каскад
+    "грубо-точно" по пирамиде обзоров; число слотов, решенных на каждом уровне,
+    записывается в stats (если передан). decoded_cache_params (cache_dir, max_bytes)
+    включает чтение вырезок из декодированного кэша растра (raster_cache).
+    """
     results = []
     if model is None:
         logger.error("Модель анализа парковок не загружена. Анализ невозможен.")
@@ -45,28 +459,41 @@ def analyze_parking_slots(
     logger.info(f"Количество слотов для анализа: {len(slot_definitions)}")
 
     try:
-        with rasterio.open(orthophoto_path) as src:
-            for slot in slot_definitions:
-                slot_id = slot.get('id', 'unknown_slot')
-                geometry = slot.get('geometry') # Ожидаем список координат [[x1,y1],...]
-                if not geometry:
-                    logger.warning(f"Отсутствует геометрия для слота ID: {slot_id}")
-                    continue
-
-                import random
-                status = random.choice(['occupied', 'vacant'])
-                confidence = random.uniform(0.6, 1.0)
-                if confidence >= confidence_threshold:
-                     logger.debug(f"Слот {slot_id}: Статус={status}, Уверенность={confidence:.2f} (ЗАГЛУШКА)")
-                     results.append({'slot_id': slot_id, 'status': status, 'confidence': round(confidence, 3)})
-                else:
-                     logger.debug(f"Слот {slot_id}: Низкая уверенность ({confidence:.2f} < {confidence_threshold}). Пропуск. (ЗАГЛУШКА)")
+        # Путь для чтения вырезок: декодированный кэш (.npy) или сам ортофотоплан
+        read_path = orthophoto_path
+        if decoded_cache_params is not None:
+            read_path = raster_cache.get_cached_raster(orthophoto_path, **decoded_cache_params) or orthophoto_path
+
+        if num_workers > 1 and isinstance(model, inference.ParkingInferenceEngine):
+            cascade_stats: Dict[str, Any] = {}
+            indexed_results = _analyze_tiles_parallel(read_path, model, slot_definitions,
+                                                      confidence_threshold, read_block_size, prefetch_batches,
+                                                      num_workers, tile_size, cascade_params, cascade_stats)
+        else:
+            if num_workers > 1:
+                logger.warning("Параллельный анализ доступен только для ParkingInferenceEngine. Анализ в одном процессе.")
+            if cascade_params is not None:
+                indexed_results, cascade_stats = _classify_slots_cascade(
+                    read_path, model, slot_definitions, confidence_threshold, read_block_size,
+                    prefetch_batches, **cascade_params)
+            else:
+                indexed_results = _classify_slots(read_path, model, slot_definitions,
+                                                  confidence_threshold, read_block_size, prefetch_batches)
+        if cascade_params is not None:
+            logger.info(f"Каскад (обзоры x{cascade_stats.get('overview_factor')}): решено на грубом уровне "
+                        f"{cascade_stats.get('resolved_coarse', 0)}, перепроверено в полном разрешении "
+                        f"{cascade_stats.get('rescored_full', 0)}, сразу в полном разрешении {cascade_stats.get('direct_full', 0)}.")
+            if stats is not None:
+                stats.update(cascade_stats)
 
+        # Восстанавливаем порядок слотов из разметки (чтение шло по блокам/тайлам файла)
+        indexed_results.sort(key=lambda item: item[0])
+        results = [res for _, res in indexed_results]
         logger.info(f"Анализ завершен. Определен статус для {len(results)} слотов.")
 
     except ImportError as ie:
          logger.error(f"Необходимая библиотека для анализа не найдена: {ie}. "
-                      "Установите rasterio, shapely, tensorflow/pytorch, opencv-python.")
+                      "Установите rasterio, opencv-python, ultralytics/onnxruntime.")
     except rasterio.RasterioIOError as rio_e:
          logger.error(f"Ошибка чтения ортофотоплана '{os.path.basename(orthophoto_path)}': {rio_e}")
     except Exception as e:
@@ -0,0 +1,111 @@
+import errno
+import logging
+import os
+from typing import Dict, Any, Optional
+
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+logger = logging.getLogger(__name__)
+
+# ioctl FICLONE (Linux): копия файла с общими блоками (reflink) на btrfs/XFS
+_FICLONE = 0x40049409
+
+def _overview_factors(width: int, height: int, blocksize: int):
+    """ Уровни пирамиды (2, 4, 8, ...) до размера, помещающегося в один блок. """
+    factors, factor = [], 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+def is_cog(path: str) -> bool:
+    """ Файл - тайловый GeoTIFF с пирамидой (достаточно для оконного чтения и просмотра). """
+    try:
+        with rasterio.open(path) as src:
+            return src.driver == 'GTiff' and src.profile.get('tiled', False) and bool(src.overviews(1))
+    except rasterio.errors.RasterioIOError:
+        return False
+
+def write_cog(source_path: str, destination_path: str, blocksize: int = 512, compress: str = 'DEFLATE',
+              predictor: Optional[int] = 2, overview_resampling: str = 'average', quality: int = 90,
+              num_threads: str = 'ALL_CPUS') -> str:
+    """
+    Конвертирует растр в Cloud-Optimized GeoTIFF: внутренние тайлы, сжатие и пирамида обзоров.
+
+    GDAL (драйвер COG) читает и пишет поблочно, поэтому растр целиком в память не загружается.
+    Если драйвер COG недоступен (GDAL < 3.1), тайловый файл пишется окнами по блокам, для
+    него строятся обзоры, и он копируется с COPY_SRC_OVERVIEWS (тот же порядок данных, что у COG).
+    Результат пишется во временный файл и атомарно переименовывается.
+
+    Returns:
+        destination_path.
+    """
+    os.makedirs(os.path.dirname(destination_path) or '.', exist_ok=True)
+    tmp_path = destination_path + '.tmp.tif'
+    options: Dict[str, Any] = {'BLOCKSIZE': blocksize, 'COMPRESS': compress.upper(), 'BIGTIFF': 'IF_SAFER',
+                               'NUM_THREADS': num_threads, 'OVERVIEW_RESAMPLING': overview_resampling.upper()}
+    if compress.upper() in ('DEFLATE', 'LZW', 'ZSTD') and predictor:
+        options['PREDICTOR'] = predictor
+    if compress.upper() in ('JPEG', 'WEBP'):
+        options['QUALITY'] = quality
+    try:
+        with rasterio.Env(GDAL_NUM_THREADS=num_threads, GDAL_TIFF_OVR_BLOCKSIZE=blocksize) as env:
+            if 'COG' in env.drivers():
+                rasterio.shutil.copy(source_path, tmp_path, driver='COG', **options)
+            else:
+                _write_cog_gtiff(source_path, tmp_path, blocksize, options)
+        os.replace(tmp_path, destination_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return destination_path
+
+def _write_cog_gtiff(source_path: str, destination_path: str, blocksize: int, options: Dict[str, Any]):
+    """ COG без драйвера COG: тайловая копия окнами + обзоры + копия с COPY_SRC_OVERVIEWS. """
+    tiled_path = destination_path + '.tiled.tif'
+    creation = {k: v for k, v in options.items() if k not in ('BLOCKSIZE', 'OVERVIEW_RESAMPLING')}
+    try:
+        with rasterio.open(source_path) as src:
+            profile = src.profile.copy()
+            profile.update(driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize, **creation)
+            with rasterio.open(tiled_path, 'w', **profile) as dst:
+                for row in range(0, src.height, blocksize):
+                    for col in range(0, src.width, blocksize):
+                        window = Window(col, row, min(blocksize, src.width - col), min(blocksize, src.height - row))
+                        dst.write(src.read(window=window), window=window)
+                factors = _overview_factors(src.width, src.height, blocksize)
+                if factors:
+                    dst.build_overviews(factors, Resampling[options['OVERVIEW_RESAMPLING'].lower()])
+        rasterio.shutil.copy(tiled_path, destination_path, driver='GTiff', COPY_SRC_OVERVIEWS='YES',
+                             TILED='YES', BLOCKXSIZE=blocksize, BLOCKYSIZE=blocksize, **creation)
+    finally:
+        if os.path.exists(tiled_path):
+            os.remove(tiled_path)
+
+def link_file(source_path: str, destination_path: str) -> bool:
+    """
+    Делает файл доступным по новому пути без копирования данных: жесткая ссылка, а на
+    другой файловой системе - reflink (FICLONE). Возвращает False, если ни то, ни другое невозможно.
+    """
+    os.makedirs(os.path.dirname(destination_path) or '.', exist_ok=True)
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+    try:
+        os.link(source_path, destination_path)
+        return True
+    except OSError as e:
+        logger.debug(f"Жесткая ссылка '{destination_path}' невозможна: {e}")
+    try:
+        import fcntl
+        with open(source_path, 'rb') as src, open(destination_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except (ImportError, OSError) as e:
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
+        if not isinstance(e, ImportError) and e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+            logger.warning(f"Reflink '{destination_path}' не удался: {e}")
+        return False
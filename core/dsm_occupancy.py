@@ -0,0 +1,182 @@
+import numpy as np
+import logging
+import os
+from typing import List, Dict, Any, Optional
+import rasterio
+
+from core.analysis import iter_slot_crops
+
+logger = logging.getLogger(__name__)
+
+def _as_float(crop: np.ndarray, nodata) -> np.ndarray:
+    """ Первый канал вырезки DEM в float64 с NaN вместо nodata. """
+    values = crop[0].astype(np.float64)
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    return values
+
+def _buffered_slots(slot_definitions: List[Dict[str, Any]], margin: float) -> List[Dict[str, Any]]:
+    """ Прямоугольники вокруг слотов, расширенные на margin (в единицах CRS), для оценки уровня земли. """
+    buffered = []
+    for slot in slot_definitions:
+        geometry = slot.get('geometry')
+        if not geometry:
+            buffered.append({'id': slot.get('id', 'unknown_slot'), 'geometry': None})
+            continue
+        coords = np.asarray(geometry, dtype=np.float64)[:, :2]
+        (x0, y0), (x1, y1) = coords.min(axis=0) - margin, coords.max(axis=0) + margin
+        buffered.append({'id': slot.get('id', 'unknown_slot'),
+                         'geometry': [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]})
+    return buffered
+
+def _height_confidence(height: float, min_height: float) -> float:
+    """ Уверенность растет с удалением высоты от порога: 0.5 на пороге, 1.0 на 0 и 2*порог. """
+    return float(min(1.0, 0.5 + abs(height - min_height) / (2.0 * min_height)))
+
+def compute_slot_heights(
+    dsm_path: str,
+    slot_definitions: List[Dict[str, Any]],
+    dtm_path: Optional[str] = None,
+    height_percentile: float = 90.0,
+    ground_margin: float = 3.0,
+    ground_percentile: float = 10.0,
+    read_block_size: int = 512
+) -> Dict[int, float]:
+    """
+    Считает высоту объектов над землей для каждого слота по DSM.
+
+    Высота слота = перцентиль height_percentile DSM внутри bbox слота минус уровень земли.
+    Уровень земли берется из DTM (если он задан и совпадает по сетке с DSM), иначе
+    оценивается локально как низкий перцентиль DSM в окрестности слота шириной ground_margin.
+    Чтение идет окнами по внутренним блокам (analysis.iter_slot_crops).
+
+    Returns:
+        Словарь {индекс_слота: высота_в_метрах} для слотов с валидными данными.
+    """
+    heights: Dict[int, float] = {}
+    with rasterio.open(dsm_path) as dsm:
+        surface: Dict[int, float] = {}
+        for idx, _, crop, _ in iter_slot_crops(dsm, slot_definitions, min_read_size=read_block_size):
+            values = _as_float(crop, dsm.nodata)
+            if np.isfinite(values).any():
+                surface[idx] = float(np.nanpercentile(values, height_percentile))
+
+        ground: Dict[int, float] = {}
+        use_dtm = False
+        if dtm_path and os.path.abspath(dtm_path) != os.path.abspath(dsm_path):
+            with rasterio.open(dtm_path) as dtm:
+                if dtm.transform == dsm.transform and dtm.shape == dsm.shape:
+                    use_dtm = True
+                    for idx, _, crop, _ in iter_slot_crops(dtm, slot_definitions, min_read_size=read_block_size):
+                        values = _as_float(crop, dtm.nodata)
+                        if np.isfinite(values).any():
+                            ground[idx] = float(np.nanmedian(values))
+                else:
+                    logger.warning("Сетка DTM не совпадает с DSM. Уровень земли будет оценен локально по DSM.")
+        if not use_dtm:
+            buffered = _buffered_slots(slot_definitions, ground_margin)
+            for idx, _, crop, _ in iter_slot_crops(dsm, buffered, min_read_size=read_block_size):
+                values = _as_float(crop, dsm.nodata)
+                if np.isfinite(values).any():
+                    ground[idx] = float(np.nanpercentile(values, ground_percentile))
+
+    for idx, top in surface.items():
+        if idx in ground:
+            heights[idx] = top - ground[idx]
+    logger.info(f"Высота над землей рассчитана для {len(heights)} из {len(slot_definitions)} слотов "
+                f"(земля: {'DTM' if use_dtm else 'локальная оценка по DSM'}).")
+    return heights
+
+def analyze_parking_slots_dsm(
+    dsm_path: str,
+    slot_definitions: List[Dict[str, Any]],
+    confidence_threshold: float = 0.7,
+    dtm_path: Optional[str] = None,
+    min_vehicle_height: float = 1.0,
+    max_vehicle_height: float = 4.0,
+    height_percentile: float = 90.0,
+    ground_margin: float = 3.0,
+    read_block_size: int = 512
+) -> List[Dict[str, Any]]:
+    """
+    Определяет занятость слотов по высоте над землей без нейросетевой модели.
+
+    Слот считается занятым, если высота объектов в нем не меньше min_vehicle_height.
+    Слоты с высотой больше max_vehicle_height (деревья, навесы) не классифицируются.
+    Формат результатов совпадает с analysis.analyze_parking_slots плюс поле 'height_m'.
+    """
+    results = []
+    if not slot_definitions:
+        logger.warning("Определения парковочных слотов не предоставлены. Анализ невозможен.")
+        return results
+    if not dsm_path or not os.path.exists(dsm_path):
+        logger.error(f"Файл DSM не найден: {dsm_path}. Анализ по высотам невозможен.")
+        return results
+
+    logger.info(f"Запуск анализа занятости по DSM: {os.path.basename(dsm_path)}")
+    try:
+        heights = compute_slot_heights(
+            dsm_path, slot_definitions, dtm_path=dtm_path,
+            height_percentile=height_percentile, ground_margin=ground_margin,
+            read_block_size=read_block_size
+        )
+        for idx, slot in enumerate(slot_definitions):
+            if idx not in heights:
+                continue
+            slot_id = slot.get('id', 'unknown_slot')
+            height = heights[idx]
+            if height > max_vehicle_height:
+                logger.debug(f"Слот {slot_id}: высота {height:.2f} м выше максимальной высоты ТС. Пропуск.")
+                continue
+            status = 'occupied' if height >= min_vehicle_height else 'vacant'
+            confidence = _height_confidence(height, min_vehicle_height)
+            if confidence >= confidence_threshold:
+                results.append({'slot_id': slot_id, 'status': status, 'confidence': round(confidence, 3),
+                                'height_m': round(height, 2)})
+            else:
+                logger.debug(f"Слот {slot_id}: Низкая уверенность по DSM ({confidence:.2f} < {confidence_threshold}). Пропуск.")
+        logger.info(f"Анализ по DSM завершен. Определен статус для {len(results)} слотов.")
+    except rasterio.RasterioIOError as rio_e:
+        logger.error(f"Ошибка чтения DSM/DTM '{os.path.basename(dsm_path)}': {rio_e}")
+    except Exception as e:
+        logger.error(f"Ошибка во время анализа занятости по DSM: {e}", exc_info=True)
+    return results
+
+def fuse_occupancy(
+    image_results: List[Dict[str, Any]],
+    dsm_results: List[Dict[str, Any]],
+    confidence_threshold: float = 0.7
+) -> List[Dict[str, Any]]:
+    """
+    Объединяет результаты анализа изображения и DSM по slot_id.
+
+    При совпадении статусов уверенность = 1 - (1 - a)(1 - b); при расхождении побеждает
+    более уверенный сигнал с уверенностью, уменьшенной на уверенность другого.
+    Если сигнал есть только у одного источника, он берется как есть.
+    Итог фильтруется по confidence_threshold; порядок - как в image_results, затем dsm_results.
+    """
+    dsm_by_id = {r['slot_id']: r for r in dsm_results}
+    fused = []
+    seen = set()
+    for img in image_results:
+        slot_id = img['slot_id']
+        seen.add(slot_id)
+        dsm = dsm_by_id.get(slot_id)
+        entry = dict(img, source='image')
+        if dsm is not None:
+            a, b = img['confidence'], dsm['confidence']
+            if img['status'] == dsm['status']:
+                entry['confidence'] = round(1.0 - (1.0 - a) * (1.0 - b), 3)
+            elif b > a:
+                entry['status'] = dsm['status']
+                entry['confidence'] = round(b - a, 3)
+            else:
+                entry['confidence'] = round(a - b, 3)
+            entry['height_m'] = dsm.get('height_m')
+            entry['source'] = 'fused'
+        if entry['confidence'] >= confidence_threshold:
+            fused.append(entry)
+    for dsm in dsm_results:
+        if dsm['slot_id'] not in seen and dsm['confidence'] >= confidence_threshold:
+            fused.append(dict(dsm, source='dsm'))
+    return fused
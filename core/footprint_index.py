@@ -0,0 +1,133 @@
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+from core import preingest
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[float, float, float, float] # (min_x, min_y, max_x, max_y)
+
+def _boxes_intersect(a: Box, b: Box) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+class FootprintIndex:
+    """
+    Равномерная сеточная пространственная индексация прямоугольных следов снимков.
+
+    Каждый след регистрируется во всех ячейках сетки, которые он покрывает; запрос по bbox
+    собирает кандидатов из покрытых ячеек и проверяет точное пересечение прямоугольников.
+    """
+    def __init__(self, cell_size: float):
+        self.cell_size = max(float(cell_size), 1e-6)
+        self.boxes: Dict[str, Box] = {}
+        self._cells: Dict[Tuple[int, int], List[str]] = {}
+
+    def _cell_range(self, box: Box):
+        cs = self.cell_size
+        for cx in range(math.floor(box[0] / cs), math.floor(box[2] / cs) + 1):
+            for cy in range(math.floor(box[1] / cs), math.floor(box[3] / cs) + 1):
+                yield cx, cy
+
+    def insert(self, key: str, box: Box):
+        self.boxes[key] = box
+        for cell in self._cell_range(box):
+            self._cells.setdefault(cell, []).append(key)
+
+    def query(self, box: Box) -> List[str]:
+        """ Ключи следов, пересекающих bbox (в порядке вставки). """
+        candidates = set()
+        for cell in self._cell_range(box):
+            candidates.update(self._cells.get(cell, ()))
+        order = {k: i for i, k in enumerate(self.boxes)}
+        return sorted((k for k in candidates if _boxes_intersect(self.boxes[k], box)), key=order.get)
+
+def footprint_radius(meta: Dict[str, Any], default_agl_m: float, default_hfov_deg: float,
+                     ground_elevation_m: Optional[float] = None) -> float:
+    """
+    Радиус (полудиагональ) следа снимка на земле для надирной съемки, в метрах.
+
+    Высота над землей: относительная высота из XMP, иначе абсолютная GPS-высота минус
+    ground_elevation_m, иначе default_agl_m. Горизонтальный угол обзора берется из
+    эквивалентного фокусного расстояния (35 мм), иначе default_hfov_deg. Курс дрона
+    неизвестен, поэтому след описывается описанной окружностью прямоугольника кадра.
+    """
+    agl = meta.get('relative_alt')
+    if agl is None and meta.get('alt') is not None and ground_elevation_m is not None:
+        agl = meta['alt'] - ground_elevation_m
+    if agl is None or agl <= 0:
+        agl = default_agl_m
+    f35 = meta.get('focal_length_35mm')
+    half_h = 36.0 / (2.0 * f35) if f35 else math.tan(math.radians(default_hfov_deg) / 2.0)
+    width, height = meta.get('width') or 4, meta.get('height') or 3
+    half_v = half_h * min(width, height) / max(width, height)
+    return agl * math.hypot(half_h, half_v)
+
+def layout_bounds(slot_definitions: List[Dict[str, Any]]) -> Optional[Box]:
+    """ Охват разметки слотов (в CRS разметки) или None, если геометрий нет. """
+    coords = [pt[:2] for slot in slot_definitions for pt in (slot.get('geometry') or [])]
+    if not coords:
+        return None
+    arr = np.asarray(coords, dtype=np.float64)
+    return float(arr[:, 0].min()), float(arr[:, 1].min()), float(arr[:, 0].max()), float(arr[:, 1].max())
+
+def build_footprint_index(metas: List[Dict[str, Any]], layout_crs: str, default_agl_m: float = 100.0,
+                          default_hfov_deg: float = 73.7,
+                          ground_elevation_m: Optional[float] = None) -> Tuple[FootprintIndex, List[str]]:
+    """
+    Строит индекс следов снимков в CRS разметки по EXIF GPS, высоте и углу обзора камеры.
+
+    Returns:
+        Кортеж (индекс по именам файлов, имена снимков без GPS).
+    """
+    from rasterio.warp import transform as warp_transform
+    with_gps = [m for m in metas if m.get('lat') is not None and m.get('lon') is not None]
+    no_gps = [m['name'] for m in metas if m.get('lat') is None or m.get('lon') is None]
+    if not with_gps:
+        return FootprintIndex(1.0), no_gps
+    xs, ys = warp_transform('EPSG:4326', layout_crs, [m['lon'] for m in with_gps], [m['lat'] for m in with_gps])
+    radii = [footprint_radius(m, default_agl_m, default_hfov_deg, ground_elevation_m) for m in with_gps]
+    # Ячейка сетки порядка размера следа: каждый след попадает в несколько ячеек
+    index = FootprintIndex(cell_size=float(np.median(radii)) * 2.0)
+    for meta, x, y, r in zip(with_gps, xs, ys, radii):
+        index.insert(meta['name'], (x - r, y - r, x + r, y + r))
+    return index, no_gps
+
+def select_images_for_roi(metas: List[Dict[str, Any]], roi: Box, layout_crs: str, margin_m: float = 20.0,
+                          neighbour_rings: int = 1, min_images: int = 5, default_agl_m: float = 100.0,
+                          default_hfov_deg: float = 73.7,
+                          ground_elevation_m: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Отбирает снимки, покрывающие область интереса (bbox разметки + margin_m).
+
+    Чтобы у краевых снимков было перекрытие для сопоставления, запрос расширяется еще
+    на neighbour_rings медианных размеров следа. Снимки без GPS сохраняются всегда.
+    Если отобрано меньше min_images, возвращаются все снимки.
+
+    Returns:
+        Метаданные отобранных снимков в исходном порядке.
+    """
+    index, no_gps = build_footprint_index(metas, layout_crs, default_agl_m, default_hfov_deg, ground_elevation_m)
+    if not index.boxes:
+        logger.warning("Ни у одного снимка нет GPS. Отбор по области интереса невозможен, используются все снимки.")
+        return metas
+    sizes = [b[2] - b[0] for b in index.boxes.values()]
+    expand = margin_m + neighbour_rings * float(np.median(sizes))
+    query_box = (roi[0] - expand, roi[1] - expand, roi[2] + expand, roi[3] + expand)
+    selected = set(index.query(query_box)) | set(no_gps)
+    if no_gps:
+        logger.warning(f"{len(no_gps)} снимков без GPS включены без проверки области интереса.")
+    if len(selected) < min_images:
+        logger.warning(f"Область интереса покрывают только {len(selected)} снимков (< {min_images}). Используются все снимки.")
+        return metas
+    logger.info(f"Отбор по области интереса: {len(selected)} из {len(metas)} снимков "
+                f"(запас {margin_m} м + {neighbour_rings} кольцо(а) соседей).")
+    return [m for m in metas if m['name'] in selected]
+
+def read_metadata(image_paths: List[str], workers: int = 8) -> List[Dict[str, Any]]:
+    """ Читает EXIF/GPS снимков в пуле потоков (чтение заголовков ограничено I/O). """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(preingest.read_image_metadata, image_paths))
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+import rasterio
+
+from core import analysis, inference
+from utils import helpers
+
+logger = logging.getLogger(__name__)
+
+def slot_geometry_hash(slot: Dict[str, Any]) -> str:
+    """ Хэш геометрии слота: измененный в разметке слот не наследует прошлый статус. """
+    canonical = json.dumps(slot.get('geometry'), separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+def slot_state_keys(slot_definitions) -> List[str]:
+    """
+    Ключи состояния слотов (уникальные в пределах разметки): id слота, а для слотов без id
+    или с повторяющимся id - id и хэш геометрии (плюс номер повтора для совпадающих слотов).
+    """
+    slots = list(slot_definitions)
+    id_counts = Counter(str(slot.get('id')) for slot in slots if slot.get('id') is not None)
+    keys, seen = [], Counter()
+    for slot in slots:
+        slot_id = slot.get('id')
+        if slot_id is not None and id_counts[str(slot_id)] == 1:
+            key = str(slot_id)
+        else:
+            key = f"{'' if slot_id is None else slot_id}#{slot_geometry_hash(slot)}"
+        seen[key] += 1
+        keys.append(key if seen[key] == 1 else f"{key}#{seen[key]}")
+    return keys
+
+def compute_slot_fingerprints(orthophoto_path: str, slot_definitions: List[Dict[str, Any]], size: int = 8,
+                              max_overview_factor: int = 4, read_block_size: int = 512) -> Dict[int, np.ndarray]:
+    """
+    Отпечатки слотов: вырезка, уменьшенная до size x size RGB и нормированная на медианную
+    яркость слотов всей площадки (освещенность разных полетов не считается изменением).
+
+    Вырезки читаются с уровня обзоров с фактором до max_overview_factor, если он есть
+    (для отпечатка полное разрешение не нужно).
+
+    Returns:
+        Словарь {индекс_слота: массив [size, size, 3] float32} для слотов внутри растра.
+    """
+    import cv2
+    patches: Dict[int, np.ndarray] = {}
+    with rasterio.open(orthophoto_path) as src:
+        level, _ = analysis.select_overview_level(src, max_overview_factor)
+    with rasterio.open(orthophoto_path, overview_level=level) as src:
+        for idx, _, crop, _ in analysis.iter_slot_crops(src, slot_definitions, min_read_size=read_block_size):
+            image = inference.crop_to_rgb(crop)
+            patches[idx] = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    if not patches:
+        return patches
+    # Нормировка по площадке: медиана средних яркостей слотов по каналам
+    lot_level = np.median(np.stack([p.mean(axis=(0, 1)) for p in patches.values()]), axis=0)
+    lot_level = np.maximum(lot_level, 1.0)
+    return {idx: patch / lot_level for idx, patch in patches.items()}
+
+def load_state(state_path: str) -> Dict[str, Dict[str, Any]]:
+    """ Состояние прошлого запуска: {ключ слота (slot_state_keys): {'geometry_hash', 'fingerprint', 'status', 'confidence', 'reuse_count'}}. """
+    if not os.path.exists(state_path):
+        return {}
+    try:
+        with np.load(state_path, allow_pickle=False) as data:
+            return {
+                str(slot_id): {'geometry_hash': str(geometry_hash), 'fingerprint': fingerprint,
+                               'status': str(status) or None, 'confidence': float(confidence),
+                               'reuse_count': int(reuse_count)}
+                for slot_id, geometry_hash, fingerprint, status, confidence, reuse_count in zip(
+                    data['slot_ids'], data['geometry_hashes'], data['fingerprints'], data['statuses'],
+                    data['confidences'], data['reuse_counts'])
+            }
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать отпечатки слотов '{state_path}': {e}. Все слоты будут пересчитаны.")
+        return {}
+
+def save_state(state_path: str, state: Dict[str, Dict[str, Any]]):
+    """ Атомарно сохраняет состояние (npz без pickle). """
+    if not state:
+        return
+    slot_ids = list(state)
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    tmp_path = state_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     slot_ids=np.array(slot_ids),
+                     geometry_hashes=np.array([state[s]['geometry_hash'] for s in slot_ids]),
+                     fingerprints=np.stack([state[s]['fingerprint'] for s in slot_ids]).astype(np.float16),
+                     statuses=np.array([state[s]['status'] or '' for s in slot_ids]),
+                     confidences=np.array([state[s]['confidence'] for s in slot_ids], dtype=np.float32),
+                     reuse_counts=np.array([state[s]['reuse_count'] for s in slot_ids], dtype=np.int32))
+        os.replace(tmp_path, state_path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить отпечатки слотов '{state_path}': {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def change_score(previous: np.ndarray, current: np.ndarray) -> float:
+    """ Средняя абсолютная разница нормированных отпечатков (0.1 - в среднем 10% яркости площадки). """
+    if previous.shape != current.shape:
+        return float('inf')
+    return float(np.mean(np.abs(previous.astype(np.float32) - current)))
+
+def analyze_parking_slots_incremental(orthophoto_path: str, model, slot_definitions: List[Dict[str, Any]],
+                                      state_path: str, change_threshold: float = 0.08, fingerprint_size: int = 8,
+                                      max_reuse: int = 5, stats: Optional[Dict[str, Any]] = None,
+                                      **analysis_kwargs) -> List[Dict[str, Any]]:
+    """
+    Инкрементальный анализ повторного полета той же площадки.
+
+    Отпечатки слотов сравниваются с сохраненными при последнем расчете статуса; модель
+    запускается только для слотов, изменившихся сильнее change_threshold, новых или
+    измененных в разметке, а также для слотов, статус которых переносился max_reuse раз
+    подряд. Остальные слоты получают прошлый статус. В каждом результате 'reused'
+    отмечает перенос, 'change_score' - величину изменения (None для новых слотов).
+
+    Returns:
+        Результаты в порядке разметки (формат analysis.analyze_parking_slots).
+    """
+    stats = stats if stats is not None else {}
+    with helpers.Timer("Отпечатки слотов", slot_count=len(slot_definitions)):
+        fingerprints = compute_slot_fingerprints(orthophoto_path, slot_definitions, size=fingerprint_size,
+                                                 read_block_size=analysis_kwargs.get('read_block_size', 512))
+    previous_state = load_state(state_path)
+    slots = list(slot_definitions)
+    keys = slot_state_keys(slots)
+
+    reused: Dict[int, Dict[str, Any]] = {}
+    scores: Dict[int, Optional[float]] = {}
+    to_compute: List[int] = []
+    for idx, slot in enumerate(slots):
+        if idx not in fingerprints:
+            continue # Вне растра или без геометрии
+        previous = previous_state.get(keys[idx])
+        if (previous is None or previous['geometry_hash'] != slot_geometry_hash(slot)
+                or previous['fingerprint'].shape != fingerprints[idx].shape):
+            scores[idx] = None
+            to_compute.append(idx)
+            continue
+        scores[idx] = change_score(previous['fingerprint'], fingerprints[idx])
+        if previous['status'] and scores[idx] <= change_threshold and previous['reuse_count'] < max_reuse:
+            reused[idx] = previous
+        else:
+            to_compute.append(idx)
+
+    computed: Dict[str, Dict[str, Any]] = {}
+    if to_compute:
+        if all(keys[i] == str(slots[i].get('id')) for i in to_compute):
+            subset = analysis.subset_slots(slot_definitions, to_compute)
+        else:
+            # Слоты без id или с повторами id: результаты сопоставляются по временному id = ключу
+            subset = [dict(slots[i], id=keys[i]) for i in to_compute]
+        for result in analysis.analyze_parking_slots(orthophoto_path, model, subset, stats=stats, **analysis_kwargs):
+            computed[str(result['slot_id'])] = result
+
+    results, new_state = [], dict(previous_state)
+    for idx, slot in enumerate(slots):
+        if idx not in fingerprints:
+            continue
+        slot_key = keys[idx]
+        score = round(scores[idx], 4) if scores[idx] is not None else None
+        if idx in reused:
+            previous = reused[idx]
+            results.append({'slot_id': slot.get('id', 'unknown_slot'), 'status': previous['status'],
+                            'confidence': round(previous['confidence'], 3), 'reused': True, 'change_score': score})
+            # Отпечаток не обновляется: медленное накопление изменений сравнивается с моментом расчета
+            new_state[slot_key] = dict(previous, reuse_count=previous['reuse_count'] + 1)
+            continue
+        result = computed.get(slot_key)
+        if result is not None:
+            results.append(dict(result, slot_id=slot.get('id', 'unknown_slot'), reused=False, change_score=score))
+        # Слот без уверенного результата сохраняется без статуса - в следующий раз будет пересчитан
+        new_state[slot_key] = {'geometry_hash': slot_geometry_hash(slot), 'fingerprint': fingerprints[idx],
+                              'status': result['status'] if result else None,
+                              'confidence': result['confidence'] if result else 0.0, 'reuse_count': 0}
+    save_state(state_path, new_state)
+
+    stats.update(reused=len(reused), recomputed=len(to_compute),
+                 new=sum(1 for i in to_compute if scores[i] is None))
+    logger.info(f"Инкрементальный анализ: перенесено {stats['reused']} слотов, пересчитано {stats['recomputed']} "
+                f"(из них новых/измененных в разметке {stats['new']}).")
+    return results
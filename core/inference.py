@@ -0,0 +1,229 @@
+import numpy as np
+import logging
+import os
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ключевые слова в именах классов модели, означающие занятый слот
+OCCUPIED_CLASS_KEYWORDS = ('occup', 'car', 'vehicle', 'busy')
+# Нижний порог уверенности детекций, передаваемый бэкенду (итоговый порог применяет движок)
+MIN_DETECTION_SCORE = 0.05
+# Бэкенды инференса: 'auto' - по расширению файла модели (.pt - PyTorch, .onnx - ONNX Runtime)
+BACKENDS = ('auto', 'torch', 'onnx', 'onnx_int8', 'opencv')
+# Суффикс модели ONNX, квантованной в int8 (см. model_tools.quantize_onnx)
+INT8_MODEL_SUFFIX = '.int8.onnx'
+
+def backend_model_path(model_path: str, backend: str = 'auto') -> str:
+    """
+    Файл модели для бэкенда: для 'onnx' и 'opencv' - экспорт .onnx рядом с весами,
+    для 'onnx_int8' - квантованная модель <имя>.int8.onnx, для 'auto'/'torch' - сам model_path.
+    """
+    if backend in ('auto', 'torch'):
+        return model_path
+    if model_path.endswith(INT8_MODEL_SUFFIX):
+        base = model_path[:-len(INT8_MODEL_SUFFIX)]
+    else:
+        base = os.path.splitext(model_path)[0]
+    return base + (INT8_MODEL_SUFFIX if backend == 'onnx_int8' else '.onnx')
+
+def _parse_names(metadata: Dict[str, str]) -> Dict[int, str]:
+    """ Имена классов из метаданных ONNX, записанных ultralytics при экспорте. """
+    import ast
+    try:
+        return {int(k): str(v) for k, v in ast.literal_eval(metadata.get('names', '{}')).items()}
+    except (ValueError, SyntaxError):
+        return {}
+
+def crop_to_rgb(crop: np.ndarray) -> np.ndarray:
+    """ Переводит вырезку растра [bands, h, w] в RGB-изображение [h, w, 3] uint8. """
+    bands = crop[:3] if crop.shape[0] >= 3 else np.repeat(crop[:1], 3, axis=0)
+    image = np.transpose(bands, (1, 2, 0))
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    return np.ascontiguousarray(image)
+
+def letterbox(image: np.ndarray, size: int) -> np.ndarray:
+    """ Масштабирует изображение с сохранением пропорций и дополняет до квадрата size x size. """
+    import cv2
+    h, w = image.shape[:2]
+    scale = size / max(h, w)
+    new_w, new_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+    top, left = (size - new_h) // 2, (size - new_w) // 2
+    canvas[top:top + new_h, left:left + new_w] = resized
+    return canvas
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> List[int]:
+    """ Жадный NMS по боксам [N, 4] в формате (x1, y1, x2, y2). Возвращает индексы оставленных боксов. """
+    order = np.argsort(-scores)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(int(i))
+        xx1 = np.maximum(boxes[i, 0], boxes[order[1:], 0])
+        yy1 = np.maximum(boxes[i, 1], boxes[order[1:], 1])
+        xx2 = np.minimum(boxes[i, 2], boxes[order[1:], 2])
+        yy2 = np.minimum(boxes[i, 3], boxes[order[1:], 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / np.maximum(areas[i] + areas[order[1:]] - inter, 1e-9)
+        order = order[1:][iou <= iou_threshold]
+    return keep
+
+def decode_yolo_output(output: np.ndarray, min_score: float, iou_threshold: float) -> List[List[Tuple[int, float]]]:
+    """
+    Декодирует сырой выход YOLOv8 [batch, 4 + nc, N] в списки (class_id, score) после NMS по классам.
+    """
+    detections = []
+    for pred in output:
+        pred = pred.T # [N, 4 + nc]
+        scores_all = pred[:, 4:]
+        class_ids = scores_all.argmax(axis=1)
+        scores = scores_all[np.arange(len(pred)), class_ids]
+        mask = scores >= min_score
+        if not mask.any():
+            detections.append([])
+            continue
+        cx, cy, w, h = pred[mask, 0], pred[mask, 1], pred[mask, 2], pred[mask, 3]
+        boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+        scores, class_ids = scores[mask], class_ids[mask]
+        dets = []
+        for cls in np.unique(class_ids):
+            idx = np.where(class_ids == cls)[0]
+            for k in nms(boxes[idx], scores[idx], iou_threshold):
+                dets.append((int(cls), float(scores[idx][k])))
+        detections.append(dets)
+    return detections
+
+class _TorchBackend:
+    """ Бэкенд PyTorch через ultralytics (файлы .pt). """
+    def __init__(self, model_path: str, num_threads: int, input_size: int):
+        import torch
+        from ultralytics import YOLO
+        torch.set_num_threads(num_threads)
+        self.model = YOLO(model_path)
+        self.names = dict(self.model.names)
+        self.input_size = input_size
+
+    def predict(self, images: List[np.ndarray], min_score: float, iou_threshold: float) -> List[List[Tuple[int, float]]]:
+        # ultralytics ожидает numpy-изображения в порядке каналов BGR
+        results = self.model.predict([img[..., ::-1] for img in images], imgsz=self.input_size,
+                                     conf=min_score, iou=iou_threshold, device='cpu', verbose=False)
+        return [list(zip(r.boxes.cls.int().tolist(), r.boxes.conf.tolist())) for r in results]
+
+class _OnnxBackend:
+    """ Бэкенд ONNX Runtime (CPU) для экспортированной модели YOLOv8 (.onnx). """
+    def __init__(self, model_path: str, num_threads: int, input_size: int):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Фиксированный размер батча в экспортированной модели -> инференс по одному изображению
+        self.fixed_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        self.input_size = model_input.shape[2] if isinstance(model_input.shape[2], int) else input_size
+        self.names = _parse_names(self.session.get_modelmeta().custom_metadata_map)
+
+    def predict(self, images: List[np.ndarray], min_score: float, iou_threshold: float) -> List[List[Tuple[int, float]]]:
+        batch = np.stack([letterbox(img, self.input_size) for img in images])
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+        if self.fixed_batch == 1:
+            outputs = [self.session.run(None, {self.input_name: batch[i:i + 1]})[0] for i in range(len(batch))]
+            output = np.concatenate(outputs, axis=0)
+        else:
+            output = self.session.run(None, {self.input_name: batch})[0]
+        return decode_yolo_output(output, min_score, iou_threshold)
+
+class _OpenCvDnnBackend:
+    """ Бэкенд OpenCV DNN (CPU) для модели ONNX: не требует onnxruntime/PyTorch на узле. """
+    def __init__(self, model_path: str, num_threads: int, input_size: int):
+        import cv2
+        cv2.setNumThreads(num_threads)
+        # Бэкенд/устройство по умолчанию - собственная реализация OpenCV на CPU
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        self.names, input_shape = self._read_onnx_metadata(model_path)
+        self.fixed_batch = input_shape[0] if input_shape and isinstance(input_shape[0], int) else None
+        self.input_size = input_shape[2] if input_shape and isinstance(input_shape[2], int) else input_size
+
+    @staticmethod
+    def _read_onnx_metadata(model_path: str) -> Tuple[Dict[int, str], Optional[List[Any]]]:
+        """ Имена классов и форма входа из файла ONNX (пакет onnx необязателен). """
+        try:
+            import onnx
+        except ImportError:
+            return {}, None
+        model = onnx.load(model_path, load_external_data=False)
+        dims = model.graph.input[0].type.tensor_type.shape.dim
+        shape = [d.dim_value if d.HasField('dim_value') else None for d in dims]
+        return _parse_names({p.key: p.value for p in model.metadata_props}), shape
+
+    def predict(self, images: List[np.ndarray], min_score: float, iou_threshold: float) -> List[List[Tuple[int, float]]]:
+        import cv2
+        letterboxed = [letterbox(img, self.input_size) for img in images]
+        # Вход [N, 3, H, W] float32 в диапазоне 0..1; изображения уже RGB
+        chunks = [letterboxed[i:i + 1] for i in range(len(letterboxed))] if self.fixed_batch == 1 else [letterboxed]
+        outputs = []
+        for chunk in chunks:
+            self.net.setInput(cv2.dnn.blobFromImages(chunk, scalefactor=1.0 / 255.0, swapRB=False))
+            outputs.append(self.net.forward())
+        return decode_yolo_output(np.concatenate(outputs, axis=0), min_score, iou_threshold)
+
+class ParkingInferenceEngine:
+    """
+    Движок пакетного инференса модели занятости парковочных мест на CPU.
+
+    Модель загружается один раз; слоты классифицируются пакетами вырезок. Статус слота
+    определяется по самой уверенной детекции после NMS: класс "занято" (см.
+    OCCUPIED_CLASS_KEYWORDS) с уверенностью не ниже confidence_threshold дает 'occupied',
+    иначе слот 'vacant' с уверенностью явной детекции "свободно" или 1 - score("занято").
+
+    backend выбирает среду выполнения (см. BACKENDS): 'onnx_int8' - тот же ONNX Runtime,
+    но для квантованного файла; путь к нужному файлу дает backend_model_path.
+    """
+    def __init__(self, model_path: str, batch_size: int = 32, num_threads: int = 4,
+                 confidence_threshold: float = 0.4, iou_threshold: float = 0.5, input_size: int = 320,
+                 backend: str = 'auto'):
+        self.model_path = model_path
+        self.batch_size = max(1, int(batch_size))
+        self.num_threads = max(1, int(num_threads))
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.input_size = input_size
+        extension = os.path.splitext(model_path)[1].lower()
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend} (expected one of {', '.join(BACKENDS)})")
+        if backend == 'auto':
+            backend = {'.onnx': 'onnx', '.pt': 'torch'}.get(extension, '')
+        if backend == 'torch' and extension == '.pt':
+            self.backend = _TorchBackend(model_path, self.num_threads, input_size)
+        elif backend in ('onnx', 'onnx_int8') and extension == '.onnx':
+            self.backend = _OnnxBackend(model_path, self.num_threads, input_size)
+        elif backend == 'opencv' and extension == '.onnx':
+            self.backend = _OpenCvDnnBackend(model_path, self.num_threads, input_size)
+        else:
+            raise ValueError(f"Unsupported model format for backend '{backend or 'auto'}': {extension}")
+        self.backend_name = backend
+        names = self.backend.names or {0: 'vacant', 1: 'occupied'}
+        self.occupied_classes = {cls for cls, name in names.items()
+                                 if any(k in str(name).lower() for k in OCCUPIED_CLASS_KEYWORDS)}
+        logger.info(f"Модель загружена ({type(self.backend).__name__}): классы {names}, "
+                    f"занятые: {sorted(self.occupied_classes)}, батч {self.batch_size}, потоков {self.num_threads}")
+
+    def classify_batch(self, images: List[np.ndarray]) -> List[Tuple[str, float]]:
+        """ Классифицирует пакет RGB-вырезок. Возвращает список (статус, уверенность). """
+        detections = self.backend.predict(images, MIN_DETECTION_SCORE, self.iou_threshold)
+        results = []
+        for dets in detections:
+            occupied = max((s for c, s in dets if c in self.occupied_classes), default=0.0)
+            vacant = max((s for c, s in dets if c not in self.occupied_classes), default=0.0)
+            if occupied >= self.confidence_threshold and occupied >= vacant:
+                results.append(('occupied', occupied))
+            elif vacant >= self.confidence_threshold:
+                results.append(('vacant', vacant))
+            else:
+                results.append(('vacant', 1.0 - occupied))
+        return results
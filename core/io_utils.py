@@ -75,6 +75,20 @@ def find_odm_results(project_output_path: str) -> Tuple[Optional[str], Optional[
 
     return ortho_path, dsm_path
 
+def find_odm_dtm(project_output_path: str) -> Optional[str]:
+    """
+    Ищет DTM ODM (odm_dem/dtm.tif), создаваемый при опции --dtm.
+
+    Returns:
+        Путь к DTM или None, если он не найден.
+    """
+    dtm_file = os.path.join(project_output_path, "odm_dem", "dtm.tif")
+    if os.path.exists(dtm_file):
+        logger.info(f"Найден DTM ODM: {dtm_file}")
+        return dtm_file
+    logger.debug(f"DTM не найден в {project_output_path}")
+    return None
+
 import json
 
 def load_json(file_path: str) -> Optional[dict]:
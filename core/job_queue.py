@@ -0,0 +1,267 @@
+import contextlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+from utils import helpers
+
+logger = logging.getLogger(__name__)
+
+# Статусы заданий
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_name TEXT NOT NULL UNIQUE,
+    image_dir TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_retries INTEGER NOT NULL DEFAULT 1,
+    cores INTEGER NOT NULL,
+    memory_gb REAL NOT NULL,
+    odm_options TEXT,
+    error TEXT,
+    owner_pid INTEGER,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_priority ON jobs (status, priority DESC, id);
+"""
+
+def project_name_from_dir(image_dir: str) -> str:
+    """ Имя проекта ODM из имени папки полета (только безопасные символы; 'images' запрещено в ODM). """
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.basename(os.path.normpath(image_dir))).strip('._') or 'flight'
+    return f"flight_{name}" if name.lower() == 'images' else name
+
+class JobQueue:
+    """
+    Персистентная очередь заданий на обработку полетов в SQLite.
+
+    Задание - папка с изображениями полета, имя проекта ODM (папка результатов в
+    OUTPUT_DIR_REL/<project_name>), приоритет, число повторов и требуемые ресурсы (ядра, ГБ).
+    Выборка следующего задания атомарна (BEGIN IMMEDIATE), поэтому очередь можно
+    наполнять из другого процесса во время работы планировщика.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # Автокоммит; транзакции открываются явно (BEGIN IMMEDIATE) там, где нужна атомарность
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job['odm_options'] = json.loads(job['odm_options']) if job['odm_options'] else None
+        return job
+
+    def submit(self, image_dir: str, project_name: Optional[str] = None, priority: int = 0,
+               max_retries: int = 1, cores: int = 1, memory_gb: float = 8.0,
+               odm_options: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Добавляет полет в очередь. Больший priority выполняется раньше; при равенстве - FIFO.
+
+        Raises:
+            ValueError: Если проект с таким именем уже есть в очереди.
+        """
+        project_name = project_name or project_name_from_dir(image_dir)
+        try:
+            with self._lock, self._connect() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (project_name, image_dir, priority, max_retries, cores, memory_gb, "
+                    "odm_options, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (project_name, os.path.abspath(image_dir), int(priority), int(max_retries), max(1, int(cores)),
+                     float(memory_gb), json.dumps(odm_options) if odm_options else None, time.time()))
+                job_id = cursor.lastrowid
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Job for project '{project_name}' already exists") from e
+        logger.info(f"Задание #{job_id} '{project_name}' добавлено в очередь (приоритет {priority}, "
+                    f"{cores} ядер, {memory_gb} ГБ).")
+        return job_id
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def list_jobs(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """ Задания в порядке выполнения (приоритет, затем время постановки). """
+        query = "SELECT * FROM jobs"
+        params: Tuple = ()
+        if status:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY priority DESC, id", params).fetchall()
+        return [self._row_to_job(r) for r in rows]
+
+    def cancel(self, job_id: int) -> bool:
+        """ Отменяет задание в очереди (выполняющиеся задания не прерываются). """
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                                  (STATUS_CANCELLED, time.time(), job_id, STATUS_QUEUED))
+        return cursor.rowcount == 1
+
+    def requeue_stale(self) -> int:
+        """ Возвращает в очередь задания 'running', чей процесс-владелец больше не существует. """
+        requeued = 0
+        with self._lock, self._connect() as conn:
+            for row in conn.execute("SELECT id, owner_pid FROM jobs WHERE status = ?", (STATUS_RUNNING,)).fetchall():
+                if row['owner_pid'] and _pid_alive(row['owner_pid']):
+                    continue
+                conn.execute("UPDATE jobs SET status = ?, owner_pid = NULL WHERE id = ?", (STATUS_QUEUED, row['id']))
+                requeued += 1
+        if requeued:
+            logger.warning(f"{requeued} прерванных заданий возвращены в очередь.")
+        return requeued
+
+    def claim_next(self, free_cores: int, free_memory_gb: float, nothing_running: bool) -> Optional[Dict[str, Any]]:
+        """
+        Атомарно берет задание с наибольшим приоритетом, укладывающееся в свободные ресурсы.
+
+        Задания, не помещающиеся сейчас, пропускаются (backfill меньшими заданиями). Если ничего
+        не выполняется, первое задание запускается даже сверх бюджета - иначе оно не выполнится никогда.
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, id",
+                                    (STATUS_QUEUED,)).fetchall()
+                chosen = next((r for r in rows if r['cores'] <= free_cores and r['memory_gb'] <= free_memory_gb), None)
+                if chosen is None and nothing_running and rows:
+                    chosen = rows[0]
+                if chosen is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?, owner_pid = ?, "
+                             "error = NULL WHERE id = ?", (STATUS_RUNNING, time.time(), os.getpid(), chosen['id']))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (chosen['id'],)).fetchone()
+        return self._row_to_job(row)
+
+    def finish(self, job_id: int, success: bool, error: Optional[str] = None) -> str:
+        """ Отмечает завершение попытки; неудачное задание возвращается в очередь, пока есть повторы. """
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT attempts, max_retries FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if success:
+                status = STATUS_SUCCEEDED
+            elif row and row['attempts'] <= row['max_retries']:
+                status = STATUS_QUEUED
+            else:
+                status = STATUS_FAILED
+            conn.execute("UPDATE jobs SET status = ?, error = ?, owner_pid = NULL, finished_at = ? WHERE id = ?",
+                         (status, error, time.time() if status != STATUS_QUEUED else None, job_id))
+        return status
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+class JobScheduler:
+    """
+    Планировщик очереди: выполняет несколько заданий одновременно в пределах общего
+    бюджета ядер и памяти узла. Каждое задание выполняется run_job(job) в отдельном потоке
+    (сама работа - контейнер ODM и анализ - идет в дочерних процессах). run_job возвращает
+    True при успехе; исключение или False считаются ошибкой попытки.
+    """
+    def __init__(self, queue: JobQueue, run_job: Callable[[Dict[str, Any]], bool], total_cores: int,
+                 total_memory_gb: float, max_parallel_jobs: int = 4, poll_interval_s: float = 5.0):
+        self.queue = queue
+        self.run_job = run_job
+        self.total_cores = max(1, int(total_cores))
+        self.total_memory_gb = float(total_memory_gb)
+        self.max_parallel_jobs = max(1, int(max_parallel_jobs))
+        self.poll_interval_s = poll_interval_s
+        self._running: Dict[int, Tuple[Dict[str, Any], Future]] = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def stop(self):
+        """ Прекращает выдачу новых заданий; выполняющиеся задания дорабатывают. """
+        self._stop.set()
+        self._wakeup.set()
+
+    def _used(self) -> Tuple[int, float]:
+        jobs = [job for job, _ in self._running.values()]
+        return sum(j['cores'] for j in jobs), sum(j['memory_gb'] for j in jobs)
+
+    def _execute(self, job: Dict[str, Any]) -> bool:
+        return bool(self.run_job(job))
+
+    def _reap(self):
+        for job_id, (job, future) in list(self._running.items()):
+            if not future.done():
+                continue
+            del self._running[job_id]
+            try:
+                success, error = future.result(), None
+                if not success:
+                    error = 'pipeline did not produce results'
+            except Exception as e:
+                success, error = False, f"{type(e).__name__}: {e}"
+            status = self.queue.finish(job_id, success, error)
+            elapsed = time.time() - (job.get('started_at') or time.time())
+            logger.info(f"Задание #{job_id} '{job['project_name']}': {status} (попытка {job['attempts']}, "
+                        f"{helpers.format_time(elapsed)}){' - ' + error if error else ''}")
+
+    def run(self, until_empty: bool = True):
+        """
+        Цикл планировщика. until_empty=True - выход, когда очередь пуста и все задания
+        завершены; иначе - работа до stop() с опросом очереди каждые poll_interval_s.
+        """
+        self.queue.requeue_stale()
+        logger.info(f"Планировщик заданий: бюджет {self.total_cores} ядер, {self.total_memory_gb} ГБ, "
+                    f"до {self.max_parallel_jobs} заданий одновременно.")
+        with ThreadPoolExecutor(max_workers=self.max_parallel_jobs, thread_name_prefix='job') as executor:
+            while True:
+                self._reap()
+                while not self._stop.is_set() and len(self._running) < self.max_parallel_jobs:
+                    used_cores, used_memory = self._used()
+                    job = self.queue.claim_next(self.total_cores - used_cores, self.total_memory_gb - used_memory,
+                                                nothing_running=not self._running)
+                    if job is None:
+                        break
+                    logger.info(f"Запуск задания #{job['id']} '{job['project_name']}' (приоритет {job['priority']}, "
+                                f"попытка {job['attempts']}/{job['max_retries'] + 1}, {job['cores']} ядер, {job['memory_gb']} ГБ).")
+                    future = executor.submit(self._execute, job)
+                    future.add_done_callback(lambda _: self._wakeup.set()) # Освободившиеся ресурсы - сразу к планированию
+                    self._running[job['id']] = (job, future)
+                if not self._running and (self._stop.is_set() or
+                                          (until_empty and not self.queue.list_jobs(STATUS_QUEUED))):
+                    break
+                self._wakeup.wait(self.poll_interval_s)
+                self._wakeup.clear()
@@ -0,0 +1,179 @@
+import logging
+import os
+import random
+import time
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio
+
+from core import inference, analysis
+
+logger = logging.getLogger(__name__)
+
+def export_onnx(weights_path: str, input_size: int = 320, dynamic_batch: bool = True) -> str:
+    """
+    Экспортирует веса ultralytics (.pt) в ONNX рядом с весами (<имя>.onnx).
+    Динамический размер пакета позволяет ONNX Runtime обрабатывать пакет за один вызов.
+    """
+    from ultralytics import YOLO
+    exported = YOLO(weights_path).export(format='onnx', imgsz=input_size, dynamic=dynamic_batch, device='cpu')
+    onnx_path = inference.backend_model_path(weights_path, 'onnx')
+    if os.path.abspath(exported) != os.path.abspath(onnx_path):
+        os.replace(exported, onnx_path)
+    logger.info(f"Модель экспортирована в ONNX: {onnx_path}")
+    return onnx_path
+
+class _CropCalibrationReader:
+    """ Источник калибровочных пакетов для статического квантования (вырезки слотов). """
+    def __init__(self, input_name: str, images: List[np.ndarray], input_size: int, batch_size: int = 8):
+        self.input_name = input_name
+        self.batches = []
+        for start in range(0, len(images), batch_size):
+            batch = np.stack([inference.letterbox(img, input_size) for img in images[start:start + batch_size]])
+            self.batches.append(np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32) / 255.0)
+        self._iter = iter(self.batches)
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        batch = next(self._iter, None)
+        return {self.input_name: batch} if batch is not None else None
+
+    def rewind(self):
+        self._iter = iter(self.batches)
+
+def quantize_onnx(onnx_path: str, calibration_images: Optional[List[np.ndarray]] = None,
+                  input_size: int = 320) -> str:
+    """
+    Квантует модель ONNX в int8 (<имя>.int8.onnx).
+
+    При наличии калибровочных вырезок - статическое квантование QDQ с весами по каналам
+    (быстрее всего на CPU для сверточных сетей), иначе - динамическое квантование весов.
+    """
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_static, quantize_dynamic, QuantFormat, QuantType
+    int8_path = inference.backend_model_path(onnx_path, 'onnx_int8')
+    if calibration_images:
+        session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+        model_input = session.get_inputs()[0]
+        size = model_input.shape[2] if isinstance(model_input.shape[2], int) else input_size
+        # Модель с фиксированным пакетом калибруется по одному изображению
+        batch_size = model_input.shape[0] if isinstance(model_input.shape[0], int) else 8
+        reader = _CropCalibrationReader(model_input.name, calibration_images, size, batch_size)
+        # Предобработка (вывод форм, слияние узлов) улучшает расстановку QDQ; без нее квантуется исходный граф
+        prepared_path = os.path.splitext(onnx_path)[0] + '.prep.onnx'
+        try:
+            from onnxruntime.quantization.shape_inference import quant_pre_process
+            quant_pre_process(onnx_path, prepared_path, skip_symbolic_shape=True)
+            source_path = prepared_path
+        except Exception as e:
+            logger.warning(f"Предобработка модели перед квантованием не удалась: {e}")
+            source_path = onnx_path
+        try:
+            quantize_static(source_path, int8_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        finally:
+            if os.path.exists(prepared_path):
+                os.remove(prepared_path)
+        method = f"статическое, калибровка по {len(calibration_images)} вырезкам"
+    else:
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+        method = "динамическое"
+    _copy_onnx_metadata(onnx_path, int8_path)
+    logger.info(f"Модель квантована в int8 ({method}): {int8_path}")
+    return int8_path
+
+def _copy_onnx_metadata(source_path: str, destination_path: str):
+    """ Переносит метаданные (имена классов ultralytics) в квантованную модель. """
+    import onnx
+    source = onnx.load(source_path, load_external_data=False)
+    destination = onnx.load(destination_path)
+    present = {p.key for p in destination.metadata_props}
+    for prop in source.metadata_props:
+        if prop.key not in present:
+            destination.metadata_props.add(key=prop.key, value=prop.value)
+    onnx.save(destination, destination_path)
+
+def split_sample_indices(slot_count: int, sample_size: int, calibration_size: int,
+                         seed: int = 0) -> Tuple[List[int], List[int]]:
+    """
+    Непересекающиеся случайные наборы индексов слотов (воспроизводимые по seed): оценочный
+    и калибровочный. Калибровка на оценочных вырезках завысила бы согласие int8 с эталоном.
+    Если слотов меньше sample_size + calibration_size, они делятся пропорционально.
+    """
+    indices = list(range(slot_count))
+    random.Random(seed).shuffle(indices)
+    requested = sample_size + calibration_size
+    if requested > slot_count:
+        sample_size = round(slot_count * sample_size / requested) if requested else 0
+        logger.warning(f"Слотов ({slot_count}) меньше запрошенных выборок ({requested}): "
+                       f"{sample_size} для сравнения, {slot_count - sample_size} для калибровки.")
+        calibration_size = slot_count - sample_size
+    return sorted(indices[:sample_size]), sorted(indices[sample_size:sample_size + calibration_size])
+
+def sample_slot_crops(orthophoto_path: str, slot_definitions, indices: Sequence[int],
+                      read_block_size: int = 512) -> List[np.ndarray]:
+    """ RGB-вырезки слотов с заданными индексами (см. split_sample_indices) для калибровки и сравнения. """
+    subset = analysis.subset_slots(slot_definitions, sorted(indices))
+    images = []
+    with rasterio.open(orthophoto_path) as src:
+        for _, _, crop, _ in analysis.iter_slot_crops(src, subset, min_read_size=read_block_size):
+            images.append(inference.crop_to_rgb(crop))
+    return images
+
+def _measure(engine: inference.ParkingInferenceEngine, images: List[np.ndarray], repeats: int):
+    """ Результаты на выборке и лучшая пропускная способность (вырезок/с) из repeats проходов. """
+    batches = [images[i:i + engine.batch_size] for i in range(0, len(images), engine.batch_size)]
+    engine.classify_batch(batches[0]) # Прогрев: выделение памяти, JIT/оптимизация графа
+    best, results = 0.0, []
+    for _ in range(max(1, repeats)):
+        started = time.perf_counter()
+        results = [r for batch in batches for r in engine.classify_batch(batch)]
+        best = max(best, len(images) / max(time.perf_counter() - started, 1e-9))
+    return results, best
+
+def benchmark_backends(model_path: str, images: List[np.ndarray], backends: Sequence[str],
+                       reference_backend: str = 'auto', batch_size: int = 32, num_threads: int = 4,
+                       confidence_threshold: float = 0.4, iou_threshold: float = 0.5, input_size: int = 320,
+                       repeats: int = 3) -> List[Dict[str, Any]]:
+    """
+    Сравнивает бэкенды на выборке вырезок: пропускная способность (вырезок/с) и согласие
+    статусов с эталоном (reference_backend для исходного файла модели).
+
+    Returns:
+        Список записей {backend, model_path, crops_per_s, agreement, mean_confidence_diff,
+        load_s, error}; первая запись - эталон.
+    """
+    if not images:
+        raise ValueError("No sample crops for backend benchmark")
+    engine_kwargs = {'batch_size': batch_size, 'num_threads': num_threads, 'input_size': input_size,
+                     'confidence_threshold': confidence_threshold, 'iou_threshold': iou_threshold}
+    reference = None
+    report = []
+    for backend in [reference_backend] + [b for b in backends if b != reference_backend]:
+        path = inference.backend_model_path(model_path, backend)
+        entry: Dict[str, Any] = {'backend': backend, 'model_path': path, 'crops_per_s': None, 'agreement': None,
+                                 'mean_confidence_diff': None, 'load_s': None, 'error': None}
+        report.append(entry)
+        try:
+            started = time.perf_counter()
+            engine = inference.ParkingInferenceEngine(path, backend=backend, **engine_kwargs)
+            entry['load_s'] = round(time.perf_counter() - started, 3)
+            results, throughput = _measure(engine, images, repeats)
+        except Exception as e: # Отсутствующий файл/библиотека или ошибка среды выполнения (cv2.error и т.п.)
+            entry['error'] = str(e)
+            if reference is None:
+                raise RuntimeError(f"Reference backend '{backend}' failed: {e}") from e
+            logger.warning(f"Бэкенд '{backend}' недоступен: {e}")
+            continue
+        entry['crops_per_s'] = round(throughput, 1)
+        if reference is None:
+            reference = results
+        entry['agreement'] = round(float(np.mean([a[0] == b[0] for a, b in zip(results, reference)])), 4)
+        entry['mean_confidence_diff'] = round(float(np.mean([abs(a[1] - b[1]) for a, b in zip(results, reference)])), 4)
+        logger.info(f"Бэкенд {backend}: {entry['crops_per_s']} вырезок/с, согласие с эталоном {entry['agreement']:.2%}")
+    return report
+
+def select_backend(report: List[Dict[str, Any]], tolerance: float = 0.02) -> Optional[str]:
+    """ Самый быстрый бэкенд, доля расхождений которого с эталоном не больше tolerance. """
+    eligible = [e for e in report if e['crops_per_s'] is not None and 1.0 - e['agreement'] <= tolerance]
+    return max(eligible, key=lambda e: e['crops_per_s'])['backend'] if eligible else None
@@ -0,0 +1,252 @@
+import json
+import logging
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Грубые априорные коэффициенты модели стоимости ODM (уточняются по истории запусков):
+# процессорное время в ядро-секундах на мегапиксель входных данных и память.
+_CORE_SECONDS_PER_MP = 8.0
+_BASE_MEMORY_GB = 2.0
+_MEMORY_GB_PER_TOTAL_MP = 0.004   # Облако точек/меш растут с общим объемом данных
+_MEMORY_GB_PER_WORKER_MP = 0.15   # Каждый поток держит в памяти изображения текущей задачи
+_FAST_ORTHOPHOTO_FACTOR = 0.4     # fast-orthophoto пропускает плотную реконструкцию
+# Множители стоимости по уровню качества (feature-quality / pc-quality)
+_QUALITY_FACTORS = {'ultra': 4.0, 'high': 2.0, 'medium': 1.0, 'low': 0.6, 'lowest': 0.4}
+# Сколько изображений открывать для оценки разрешения (в одном полете одна камера)
+_SIZE_SAMPLE = 50
+# Границы поправочного коэффициента по истории
+_CORRECTION_LIMITS = (0.2, 5.0)
+
+def _image_megapixels(path: str) -> Optional[float]:
+    """ Разрешение изображения в мегапикселях (читается только заголовок). """
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            return img.size[0] * img.size[1] / 1e6
+    except OSError:
+        return None
+
+def dataset_stats(image_paths: List[str], workers: int = 8) -> Dict[str, Any]:
+    """ Число изображений и мегапиксели (по выборке заголовков), включая оценку суммарного объема. """
+    step = max(1, len(image_paths) // _SIZE_SAMPLE)
+    sample = image_paths[::step][:_SIZE_SAMPLE]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        sizes = [mp for mp in executor.map(_image_megapixels, sample) if mp]
+    mp_per_image = statistics.median(sizes) if sizes else 12.0
+    return {'image_count': len(image_paths), 'megapixels_per_image': round(mp_per_image, 2),
+            'total_megapixels': round(mp_per_image * len(image_paths), 1)}
+
+def host_resources() -> Dict[str, Any]:
+    """ Доступные ядра и память (с учетом cgroup-лимита, если процесс в контейнере). """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    total = available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            meminfo = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in f if line.split()[1:2]}
+        total, available = meminfo.get('MemTotal'), meminfo.get('MemAvailable')
+    except (OSError, ValueError, IndexError):
+        if hasattr(os, 'sysconf'):
+            try:
+                total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            except (ValueError, OSError):
+                pass
+    for limit_path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(limit_path, 'r') as f:
+                limit = f.read().strip()
+            if limit.isdigit() and int(limit) < 2 ** 60:
+                total = min(total or int(limit), int(limit))
+                available = min(available or total, total)
+            break
+        except OSError:
+            continue
+    gb = 1024 ** 3
+    return {'cpu_cores': cores,
+            'memory_total_gb': round(total / gb, 2) if total else None,
+            'memory_available_gb': round((available or total) / gb, 2) if (available or total) else None}
+
+def _quality(options: Dict[str, Any], key: str) -> float:
+    return _QUALITY_FACTORS.get(str(options.get(key, 'medium')).lower(), 1.0)
+
+def estimate_cost(options: Dict[str, Any], dataset: Dict[str, Any], cores: int) -> Dict[str, float]:
+    """
+    Априорная оценка времени (сек) и пиковой памяти (ГБ) запуска ODM с данными опциями.
+
+    Эффективный объем данных учитывает resize-to (длинная сторона в пикселях; для
+    формата 4:3 площадь масштабируется квадратом отношения сторон).
+    """
+    mp_per_image = dataset['megapixels_per_image']
+    resize_to = options.get('resize-to')
+    if resize_to and resize_to > 0:
+        long_side = (mp_per_image * 1e6 * 4 / 3) ** 0.5
+        mp_per_image = min(mp_per_image, mp_per_image * (resize_to / long_side) ** 2)
+    total_mp = mp_per_image * dataset['image_count']
+    concurrency = max(1, min(int(options.get('max-concurrency') or cores), cores))
+    dense = _FAST_ORTHOPHOTO_FACTOR if options.get('fast-orthophoto') else _quality(options, 'pc-quality')
+    core_seconds = _CORE_SECONDS_PER_MP * total_mp * (0.5 * _quality(options, 'feature-quality') + 0.5 * dense)
+    # Масштабирование по ядрам неидеально: часть стадий однопоточные
+    time_s = core_seconds / concurrency ** 0.85
+    memory_gb = (_BASE_MEMORY_GB + _MEMORY_GB_PER_TOTAL_MP * total_mp * dense
+                 + _MEMORY_GB_PER_WORKER_MP * concurrency * mp_per_image * _quality(options, 'feature-quality'))
+    return {'time_s': time_s, 'memory_gb': memory_gb, 'effective_megapixels': total_mp}
+
+def load_history(history_path: str) -> List[Dict[str, Any]]:
+    """ Записи прошлых запусков из JSONL-файла истории (поврежденные строки пропускаются). """
+    if not os.path.exists(history_path):
+        return []
+    records = []
+    with open(history_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+    return records
+
+def history_correction(history: List[Dict[str, Any]], max_runs: int = 10) -> Dict[str, Any]:
+    """
+    Поправочные коэффициенты модели: медиана отношения фактических времени и пиковой памяти
+    к априорной оценке по последним успешным запускам.
+    """
+    time_ratios, memory_ratios = [], []
+    successful = [r for r in history if r.get('success') and r.get('dataset') and r.get('options')]
+    for record in successful[-max_runs:]:
+        predicted = estimate_cost(record['options'], record['dataset'], record.get('host', {}).get('cpu_cores') or 1)
+        if record.get('duration_s') and predicted['time_s'] > 0:
+            time_ratios.append(record['duration_s'] / predicted['time_s'])
+        if record.get('peak_memory_gb') and predicted['memory_gb'] > 0:
+            memory_ratios.append(record['peak_memory_gb'] / predicted['memory_gb'])
+    low, high = _CORRECTION_LIMITS
+    return {
+        'runs': len(successful[-max_runs:]),
+        'time': round(min(high, max(low, statistics.median(time_ratios))), 3) if time_ratios else 1.0,
+        'memory': round(min(high, max(low, statistics.median(memory_ratios))), 3) if memory_ratios else 1.0,
+    }
+
+def _candidates(base_options: Dict[str, Any], cores: int,
+                resize_ladder: List[int]) -> List[Tuple[Dict[str, Any], List[str]]]:
+    """
+    Варианты опций от лучшего качества к самому дешевому. Снижение потоков меняет только
+    время, поэтому перебирается раньше, чем уменьшение снимков и fast-orthophoto.
+    """
+    base_concurrency = max(1, min(int(base_options.get('max-concurrency') or cores), cores))
+    concurrency_steps = sorted({base_concurrency, max(1, base_concurrency // 2), max(1, base_concurrency // 4), 1},
+                               reverse=True)
+    base_resize = base_options.get('resize-to')
+    resize_steps = [base_resize] + [r for r in resize_ladder if not base_resize or r < base_resize]
+    fast_steps = [bool(base_options.get('fast-orthophoto'))] + ([] if base_options.get('fast-orthophoto') else [True])
+    candidates = []
+    for fast in fast_steps:
+        for resize in resize_steps:
+            for concurrency in concurrency_steps:
+                options = dict(base_options, **{'max-concurrency': concurrency, 'fast-orthophoto': fast})
+                if resize:
+                    options['resize-to'] = resize
+                changes = []
+                if concurrency != base_concurrency:
+                    changes.append(f"max-concurrency {base_concurrency} -> {concurrency}")
+                if resize != base_resize:
+                    changes.append(f"resize-to {base_resize or 'off'} -> {resize}")
+                if fast != bool(base_options.get('fast-orthophoto')):
+                    changes.append("fast-orthophoto on")
+                candidates.append((options, changes))
+    return candidates
+
+def select_odm_options(base_options: Dict[str, Any], image_paths: List[str], history_path: Optional[str] = None,
+                       time_budget_s: Optional[float] = None, memory_budget_gb: Optional[float] = None,
+                       memory_reserve_fraction: float = 0.8,
+                       resize_ladder: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Подбирает опции ODM под бюджет времени и памяти по размеру набора, ресурсам хоста и истории.
+
+    Бюджет памяти по умолчанию - memory_reserve_fraction от доступной памяти. Выбирается
+    первый по качеству вариант (см. _candidates), укладывающийся в оба бюджета; если таких
+    нет, берется вариант с наименьшей памятью (риск OOM хуже долгого запуска).
+
+    Returns:
+        Профиль {'options', 'changes', 'reasons', 'estimate', 'dataset', 'host', 'budget',
+        'correction', 'fits_budget'} - сохраняется вместе с запуском.
+    """
+    dataset = dataset_stats(image_paths)
+    host = host_resources()
+    history = load_history(history_path) if history_path else []
+    correction = history_correction(history)
+    if memory_budget_gb is None and host['memory_available_gb']:
+        memory_budget_gb = round(host['memory_available_gb'] * memory_reserve_fraction, 2)
+    resize_ladder = sorted(resize_ladder or [4000, 3200, 2400, 2000, 1600], reverse=True)
+
+    def corrected(options):
+        cost = estimate_cost(options, dataset, host['cpu_cores'])
+        return {'time_s': round(cost['time_s'] * correction['time'], 1),
+                'memory_gb': round(cost['memory_gb'] * correction['memory'], 2),
+                'effective_megapixels': round(cost['effective_megapixels'], 1)}
+
+    def fits(estimate):
+        return ((time_budget_s is None or estimate['time_s'] <= time_budget_s)
+                and (memory_budget_gb is None or estimate['memory_gb'] <= memory_budget_gb))
+
+    candidates = _candidates(base_options, host['cpu_cores'], resize_ladder)
+    evaluated = [(options, changes, corrected(options)) for options, changes in candidates]
+    chosen = next((item for item in evaluated if fits(item[2])), None)
+    fits_budget = chosen is not None
+    if chosen is None:
+        chosen = min(evaluated, key=lambda item: (item[2]['memory_gb'], item[2]['time_s']))
+
+    options, changes, estimate = chosen
+    base_estimate = evaluated[0][2]
+    reasons = [f"Набор: {dataset['image_count']} изображений по {dataset['megapixels_per_image']} Мп "
+               f"({dataset['total_megapixels']} Мп); хост: {host['cpu_cores']} ядер, "
+               f"{host['memory_available_gb']} ГБ доступно.",
+               f"Бюджет: время {time_budget_s if time_budget_s is not None else '-'} с, "
+               f"память {memory_budget_gb if memory_budget_gb is not None else '-'} ГБ.",
+               f"Поправка по истории ({correction['runs']} запусков): время x{correction['time']:.2f}, "
+               f"память x{correction['memory']:.2f}.",
+               f"Исходные опции: оценка {base_estimate['time_s']} с, {base_estimate['memory_gb']} ГБ."]
+    if not changes:
+        reasons.append("Исходные опции укладываются в бюджет - изменения не требуются.")
+    elif fits_budget:
+        reasons.append(f"Изменения ({', '.join(changes)}): оценка {estimate['time_s']} с, {estimate['memory_gb']} ГБ.")
+    else:
+        reasons.append(f"Ни один вариант не укладывается в бюджет; выбран самый экономный по памяти "
+                       f"({', '.join(changes) or 'без изменений'}): оценка {estimate['time_s']} с, {estimate['memory_gb']} ГБ.")
+    for reason in reasons:
+        logger.info(f"Автоподбор опций ODM: {reason}")
+    return {'options': options, 'changes': changes, 'reasons': reasons, 'estimate': estimate,
+            'dataset': dataset, 'host': host,
+            'budget': {'time_s': time_budget_s, 'memory_gb': memory_budget_gb},
+            'correction': correction, 'fits_budget': fits_budget}
+
+def record_run(history_path: str, profile: Dict[str, Any], success: bool, duration_s: Optional[float],
+               resource_summary: Optional[Dict[str, Any]] = None) -> bool:
+    """ Добавляет итог запуска (опции, набор, время, пик памяти) в JSONL-историю. """
+    peak = (resource_summary or {}).get('mem_peak_bytes')
+    record = {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'success': bool(success),
+        'duration_s': round(duration_s, 1) if duration_s is not None else None,
+        'peak_memory_gb': round(peak / 1024 ** 3, 3) if peak else None,
+        'cpu_cores_avg': (resource_summary or {}).get('cpu_cores_avg'),
+        'options': {k: v for k, v in profile['options'].items()
+                    if k in ('max-concurrency', 'resize-to', 'fast-orthophoto', 'feature-quality', 'pc-quality')},
+        'dataset': profile['dataset'],
+        'host': profile['host'],
+        'estimate': profile['estimate'],
+    }
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+        with open(history_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return True
+    except OSError as e:
+        logger.warning(f"Не удалось записать историю запусков ODM '{history_path}': {e}")
+        return False
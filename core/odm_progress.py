@@ -0,0 +1,160 @@
+import logging
+import re
+import time
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы стадий в логе ODM: "[INFO]    Running opensfm stage" / "[INFO]    Finished opensfm stage"
+_STAGE_START = re.compile(r'Running (\w+) stage')
+_STAGE_END = re.compile(r'Finished (\w+) stage')
+_PIPELINE_END = re.compile(r'ODM app finished')
+
+# Счетчики: (имя, регулярное выражение, режим). Режимы: 'set' - последнее значение,
+# 'max' - максимум, 'sum' - сумма значений, 'count' - число совпавших строк.
+COUNTER_PATTERNS: List[Tuple[str, "re.Pattern", str]] = [
+    ('images_loaded', re.compile(r'(?:Found|Loaded) (\d+) (?:usable )?images'), 'set'),
+    ('feature_images', re.compile(r'[Ee]xtracting \w+ features for image'), 'count'),
+    ('features', re.compile(r'[Ff]ound (\d+) points in'), 'sum'),
+    ('matched_pairs', re.compile(r'Matched (\d+) pairs'), 'sum'),
+    ('reconstruction_images', re.compile(r'Reconstruction \d+: (\d+) images'), 'max'),
+    ('reconstruction_points', re.compile(r'Reconstruction \d+: \d+ images, (\d+) points'), 'max'),
+    ('dense_points', re.compile(r'(?:[Pp]oint cloud has|[Ss]aved|[Ww]rote) (\d+) points'), 'max'),
+    ('tiles_done', re.compile(r'[Tt]ile (\d+)\s*(?:/|of)\s*\d+'), 'max'),
+    ('tiles_total', re.compile(r'[Tt]ile \d+\s*(?:/|of)\s*(\d+)'), 'max'),
+    ('progress_percent', re.compile(r'(\d{1,3}(?:\.\d+)?)\s*%'), 'set'),
+]
+
+class OdmProgressParser:
+    """
+    Инкрементальный разбор потока stdout ODM: границы стадий, их длительность и счетчики.
+
+    Строки подаются по мере поступления через feed(). При смене стадии и изменении
+    счетчиков вызывается progress_callback(событие), где событие - словарь с ключами
+    'event' ('stage_start' | 'stage_end' | 'counter'), 'stage', 'stage_index', 'stage_count',
+    'counters' (счетчики текущей стадии) и 'elapsed_s'.
+    """
+    def __init__(self, stage_order: Optional[List[str]] = None,
+                 progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 clock: Callable[[], float] = time.time):
+        self.stage_order = list(stage_order or [])
+        self.progress_callback = progress_callback
+        self._clock = clock
+        self.started = clock()
+        self.stages: List[Dict[str, Any]] = []
+        self.attempt = 1
+        self.lines = 0
+
+    @property
+    def current_stage(self) -> Optional[Dict[str, Any]]:
+        if self.stages and self.stages[-1]['end'] is None:
+            return self.stages[-1]
+        return None
+
+    def start_attempt(self, attempt: int):
+        """ Отмечает новый запуск процесса ODM (повтор/возобновление); открытая стадия закрывается как прерванная. """
+        self._close_stage(status='interrupted')
+        self.attempt = attempt
+
+    def feed(self, line: str):
+        """ Разбирает одну строку вывода ODM. """
+        self.lines += 1
+        match = _STAGE_START.search(line)
+        if match:
+            self._close_stage(status='finished')
+            self._open_stage(match.group(1))
+            return
+        match = _STAGE_END.search(line)
+        if match:
+            stage = self.current_stage
+            if stage is not None and stage['name'] == match.group(1):
+                self._close_stage(status='finished')
+            return
+        if _PIPELINE_END.search(line):
+            self._close_stage(status='finished')
+            return
+        stage = self.current_stage
+        if stage is None:
+            return
+        changed = False
+        for name, pattern, mode in COUNTER_PATTERNS:
+            match = pattern.search(line)
+            if not match:
+                continue
+            counters = stage['counters']
+            if mode == 'count':
+                counters[name] = counters.get(name, 0) + 1
+            else:
+                value = float(match.group(1))
+                value = int(value) if value.is_integer() else value
+                if mode == 'sum':
+                    counters[name] = counters.get(name, 0) + value
+                elif mode == 'max':
+                    counters[name] = max(counters.get(name, value), value)
+                else:
+                    counters[name] = value
+            changed = True
+        if changed:
+            self._notify('counter', stage)
+
+    def _open_stage(self, name: str):
+        stage = {'name': name, 'attempt': self.attempt, 'start': self._clock(), 'end': None,
+                 'duration_s': None, 'status': 'running', 'counters': {}}
+        self.stages.append(stage)
+        self._notify('stage_start', stage)
+
+    def _close_stage(self, status: str):
+        stage = self.current_stage
+        if stage is None:
+            return
+        stage['end'] = self._clock()
+        stage['duration_s'] = round(stage['end'] - stage['start'], 3)
+        stage['status'] = status
+        self._notify('stage_end', stage)
+
+    def _notify(self, event: str, stage: Dict[str, Any]):
+        if self.progress_callback is None:
+            return
+        index = self.stage_order.index(stage['name']) + 1 if stage['name'] in self.stage_order else None
+        try:
+            self.progress_callback({
+                'event': event,
+                'stage': stage['name'],
+                'stage_index': index,
+                'stage_count': len(self.stage_order) or None,
+                'counters': dict(stage['counters']),
+                'elapsed_s': round(self._clock() - self.started, 3),
+            })
+        except Exception as e:
+            logger.warning(f"Ошибка в обработчике прогресса ODM: {e}")
+
+    def finish(self, return_code: Optional[int] = None):
+        """ Закрывает открытую стадию по завершении процесса (ненулевой код - стадия 'failed'). """
+        self._close_stage(status='finished' if return_code in (0, None) else 'failed')
+
+    def failed_stage(self) -> Optional[str]:
+        """ Имя стадии, на которой упала последняя попытка, или None. """
+        stage = self.stages[-1] if self.stages else None
+        return stage['name'] if stage is not None and stage['status'] == 'failed' else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Сводка для сохранения в JSON: стадии с временем и счетчиками, итоговые счетчики. """
+        totals: Dict[str, Any] = {}
+        durations: Dict[str, float] = {}
+        for stage in self.stages:
+            if stage['duration_s'] is not None:
+                durations[stage['name']] = round(durations.get(stage['name'], 0.0) + stage['duration_s'], 3)
+            for name, value in stage['counters'].items():
+                if name != 'progress_percent':
+                    totals[name] = value
+        slowest = max(durations.items(), key=lambda kv: kv[1])[0] if durations else None
+        return {
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'total_s': round(self._clock() - self.started, 3),
+            'lines': self.lines,
+            'attempts': self.attempt,
+            'slowest_stage': slowest,
+            'stage_durations_s': durations,
+            'counters': totals,
+            'stages': [{k: v for k, v in stage.items() if k not in ('start', 'end')} for stage in self.stages],
+        }
@@ -2,9 +2,20 @@ import subprocess
 import os
 import logging
 import shlex
-from typing import Dict, Any, Optional
+import json
+import hashlib
+import time
+import math
+import asyncio
+import functools
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple, Callable
 # Импортируем хелперы, чтобы использовать исключение и таймер
 from utils import helpers
+from core.odm_progress import OdmProgressParser
+from core.resource_sampler import ResourceSampler
+from core import odm_worker
 try:
     import config
     # Пытаемся получить PROJECT_ROOT из config.py
@@ -23,63 +34,127 @@ except ImportError:
 # Получаем логгер для этого модуля
 logger = logging.getLogger(__name__)
 
-def run_odm(image_dir_abs: str, # Абсолютный путь к images на хосте
-            output_base_dir_abs: str, # Абсолютный путь к БАЗОВОЙ папке для вывода на хосте (напр., data/output)
-            project_name: str = "odm_processing", # Имя папки/проекта ODM для результатов
-            odm_options: Optional[Dict[str, Any]] = None,
-            run_method: str = 'docker', docker_image: str = 'opendronemap/odm:latest'):
+# Стадии пайплайна ODM (значения --rerun-from) по порядку и файлы-маркеры их завершения
+# (пути относительно папки проекта; достаточно любого из маркеров). split/merge
+# в обычном режиме ничего не делают, поэтому с них перезапуск не выполняется.
+ODM_STAGES: List[Tuple[str, Tuple[str, ...]]] = [
+    ('dataset', ('images.json',)),
+    ('opensfm', ('opensfm/undistorted/reconstruction.nvm', 'opensfm/reconstruction.topocentric.json')),
+    ('openmvs', ('opensfm/undistorted/openmvs/scene_dense_dense_filtered.ply',
+                 'opensfm/undistorted/openmvs/scene_dense.ply')),
+    ('odm_filterpoints', ('odm_filterpoints/point_cloud.ply',)),
+    ('odm_meshing', ('odm_meshing/odm_mesh.ply', 'odm_meshing/odm_25dmesh.ply')),
+    ('mvs_texturing', ('odm_texturing/odm_textured_model_geo.obj', 'odm_texturing_25d/odm_textured_model_geo.obj')),
+    ('odm_georeferencing', ('odm_georeferencing/odm_georeferenced_model.laz',)),
+    ('odm_dem', ('odm_dem/dsm.tif', 'odm_dem/dtm.tif')),
+    ('odm_orthophoto', ('odm_orthophoto/odm_orthophoto.tif',)),
+    ('odm_report', ('odm_report/report.pdf',)),
+    ('odm_postprocess', ()),
+]
+# Файл состояния запуска в папке проекта: по нему определяется, относится ли
+# незавершенный проект к тем же входным данным и опциям
+RUN_STATE_FILENAME = 'odm_run_state.json'
+# Параметры сервера задач для run_method='worker' (если config недоступен)
+DEFAULT_WORKER_PARAMS: Dict[str, Any] = {'url': 'http://127.0.0.1:3000', 'token': None, 'autostart': True,
+                                         'image': 'opendronemap/nodeodm:latest', 'container_name': 'odm-worker',
+                                         'poll_interval_s': 5.0, 'upload_parallel': 4, 'outputs': None,
+                                         'remove_after_download': True}
+# Внешние команды, уже успешно проверенные в этом процессе (docker --version, nvidia-smi)
+_AVAILABLE_COMMANDS: set = set()
+
+def command_available(*cmd: str) -> bool:
+    """ Проверяет, что команда запускается без ошибки; успешный результат кэшируется на процесс. """
+    if cmd in _AVAILABLE_COMMANDS:
+        return True
+    try:
+        subprocess.run(list(cmd), check=True, capture_output=True, text=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return False
+    _AVAILABLE_COMMANDS.add(cmd)
+    return True
+
+def _stage_marker_mtime(project_path: str, markers: Tuple[str, ...]) -> Optional[float]:
+    """ Время изменения самого свежего маркера стадии или None, если маркеров нет. """
+    mtimes = [os.path.getmtime(os.path.join(project_path, m)) for m in markers
+              if os.path.exists(os.path.join(project_path, m))]
+    return max(mtimes) if mtimes else None
+
+def find_last_completed_stage(project_path: str) -> Optional[str]:
     """
-    Запускает OpenDroneMap для обработки изображений, адаптировано под ODM v3.x+
-    (использование --project-path и позиционного аргумента для имени проекта).
+    Определяет последнюю завершенную стадию ODM по файлам-маркерам в папке проекта.
 
-    Args:
-        image_dir_abs: Абсолютный путь к папке с входными изображениями на хост-машине.
-                       Ожидается, что эта папка содержит только файлы изображений.
-        output_base_dir_abs: Абсолютный путь к папке на хост-машине, внутри которой
-                             ODM создаст папку с именем project_name для результатов.
-        odm_options: Словарь с дополнительными параметрами для ODM (ключ без '--').
-        run_method: 'docker' или 'native'.
-        docker_image: Имя Docker образа ODM 'opendronemap/odm:latest'
-
-    Returns:
-        True в случае условного успеха запуска ODM (код возврата 0 и папка создана), False иначе.
-
-    Raises:
-        helpers.PipelineError: В случае критических ошибок конфигурации или запуска.
-        ValueError: Если project_name='images'.
+    Маркеры проверяются по порядку стадий; стадия засчитывается, только если ее маркер
+    не старше маркера предыдущей завершенной стадии. Так результаты старого полного
+    запуска, не перезаписанные упавшим новым запуском, не считаются завершенными.
+    Стадии без маркеров (отключенные опциями, например odm_dem без --dsm) пропускаются.
     """
-    logger.info(f"--- Запуск OpenDroneMap для проекта '{project_name}' (метод: {run_method}) ---")
-
-    # --- Проверки входных данных ---
-    if not os.path.isdir(image_dir_abs):
-        logger.error(f"Директория с входными изображениями не найдена: {image_dir_abs}")
-        raise helpers.PipelineError(f"Input image directory not found: {image_dir_abs}")
-    if not os.listdir(image_dir_abs):
-         logger.error(f"Директория с входными изображениями пуста: {image_dir_abs}")
-         raise helpers.PipelineError(f"Input image directory is empty: {image_dir_abs}")
-    if project_name.lower() == 'images':
-         logger.error("Имя проекта ODM ('project_name') не может быть 'images'.")
-         raise ValueError("ODM project name cannot be 'images'")
-
-    # Убедимся, что базовая папка вывода существует на хосте
+    last_stage, last_mtime = None, 0.0
+    for stage, markers in ODM_STAGES:
+        mtime = _stage_marker_mtime(project_path, markers) if markers else None
+        if mtime is None:
+            continue
+        if mtime < last_mtime:
+            logger.debug(f"Маркер стадии '{stage}' старше предыдущей стадии - считается устаревшим.")
+            break
+        last_stage, last_mtime = stage, mtime
+    return last_stage
+
+def get_resume_stage(project_path: str) -> Optional[str]:
+    """ Стадия для --rerun-from после последней завершенной или None, если начинать сначала/нечего делать. """
+    last_stage = find_last_completed_stage(project_path)
+    if last_stage is None:
+        return None
+    names = [stage for stage, _ in ODM_STAGES]
+    next_index = names.index(last_stage) + 1
+    return names[next_index] if next_index < len(names) else None
+
+def _run_signature(image_dir_abs: str, odm_options: Optional[Dict[str, Any]],
+                   run_method: str, docker_image: str) -> str:
+    """ Дешевая подпись запуска: имена и размеры изображений, опции ODM, метод и образ. """
+    images = sorted((f, os.path.getsize(os.path.join(image_dir_abs, f))) for f in os.listdir(image_dir_abs)
+                    if os.path.isfile(os.path.join(image_dir_abs, f)))
+    payload = json.dumps({'images': images, 'options': odm_options or {}, 'run_method': run_method,
+                          'docker_image': docker_image}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _load_run_state(project_path: str) -> Dict[str, Any]:
+    state_path = os.path.join(project_path, RUN_STATE_FILENAME)
     try:
-        os.makedirs(output_base_dir_abs, exist_ok=True)
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def _save_run_state(project_path: str, state: Dict[str, Any]):
+    state = dict(state, updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+    try:
+        os.makedirs(project_path, exist_ok=True)
+        with open(os.path.join(project_path, RUN_STATE_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=4, ensure_ascii=False)
     except OSError as e:
-        logger.error(f"Не удалось создать базовую директорию для вывода ODM: {output_base_dir_abs} - {e}")
-        raise helpers.PipelineError(f"Could not create output base directory: {output_base_dir_abs}") from e
+        logger.warning(f"Не удалось сохранить состояние запуска ODM: {e}")
 
+def build_odm_command(image_dir_abs: str, output_base_dir_abs: str, project_name: str,
+                      odm_options: Optional[Dict[str, Any]], run_method: str,
+                      docker_image: str) -> Tuple[List[str], Optional[str]]:
+    """
+    Формирует команду запуска ODM (docker или native) и рабочую папку процесса.
+
+    Raises:
+        helpers.OdmError: Docker или скрипт ODM недоступны.
+        ValueError: Неизвестный метод запуска.
+    """
     # --- Подготовка команды ---
     cmd = []
     if run_method == 'docker':
         logger.debug(f"Использование Docker образа: {docker_image}")
         cmd = ['docker', 'run', '--rm'] # -it флаги не нужны для неинтерактивного запуска
         # Проверка доступности Docker
-        try:
-             subprocess.run(['docker', '--version'], check=True, capture_output=True, text=True)
-             logger.info("Docker доступен.")
-        except (FileNotFoundError, subprocess.CalledProcessError) as docker_e:
+        if not command_available('docker', '--version'):
              logger.fatal("Docker не найден или не запущен. Установите Docker и запустите его.")
-             raise helpers.OdmError("Docker is not available.") from docker_e
+             raise helpers.OdmError("Docker is not available.")
+        logger.debug("Docker доступен.")
 
         # --- Монтирование томов ---
         # Конвертируем пути для Docker (особенно важно для Windows)
@@ -100,11 +175,10 @@ def run_odm(image_dir_abs: str, # Абсолютный путь к images на 
         use_gpu_flag = odm_options and odm_options.get('use-gpu', False)
         if use_gpu_flag:
             logger.info("Запрос использования GPU для ODM в Docker.")
-            try:
-                 subprocess.run(['nvidia-smi'], check=True, capture_output=True, text=True)
+            if command_available('nvidia-smi'):
                  cmd.extend(['--gpus', 'all'])
                  logger.info("Добавлен флаг --gpus all.")
-            except (FileNotFoundError, subprocess.CalledProcessError):
+            else:
                  logger.warning("Команда 'nvidia-smi' не найдена или вернула ошибку в WSL. GPU не будет использоваться Docker.")
                  # Не добавляем флаг --gpus all, ODM сам решит (или упадет, если --use-gpu передано ниже)
         # ----------------------------------------------------
@@ -185,6 +259,285 @@ def run_odm(image_dir_abs: str, # Абсолютный путь к images на 
         logger.fatal(f"Неизвестный метод запуска ODM: {run_method}")
         raise ValueError(f"Unsupported ODM run method: {run_method}")
 
+    working_directory = PROJECT_ROOT_PATH if run_method == 'native' else None
+    return cmd, working_directory
+
+def run_odm(image_dir_abs: str, # Абсолютный путь к images на хосте
+            output_base_dir_abs: str, # Абсолютный путь к БАЗОВОЙ папке для вывода на хосте (напр., data/output)
+            project_name: str = "odm_processing", # Имя папки/проекта ODM для результатов
+            odm_options: Optional[Dict[str, Any]] = None,
+            run_method: str = 'docker', docker_image: str = 'opendronemap/odm:latest',
+            max_retries: int = 0, resume: bool = True,
+            metrics_path: Optional[str] = None,
+            progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+            resource_metrics_path: Optional[str] = None, resource_prom_path: Optional[str] = None,
+            resource_sample_interval_s: float = 2.0,
+            worker_params: Optional[Dict[str, Any]] = None):
+    """
+    Запускает OpenDroneMap для обработки изображений, адаптировано под ODM v3.x+
+    (использование --project-path и позиционного аргумента для имени проекта).
+
+    Args:
+        image_dir_abs: Абсолютный путь к папке с входными изображениями на хост-машине.
+                       Ожидается, что эта папка содержит только файлы изображений.
+        output_base_dir_abs: Абсолютный путь к папке на хост-машине, внутри которой
+                             ODM создаст папку с именем project_name для результатов.
+        odm_options: Словарь с дополнительными параметрами для ODM (ключ без '--').
+        run_method: 'docker', 'native' или 'worker' (задача на долгоживущем сервере NodeODM,
+                    см. worker_params).
+        docker_image: Имя Docker образа ODM 'opendronemap/odm:latest'
+        max_retries: Число автоматических повторных запусков после ошибки ODM.
+        resume: Продолжать незавершенный запуск с тем же набором изображений и опциями
+                с последней завершенной стадии (--rerun-from) вместо запуска с нуля.
+        metrics_path: Путь для JSON с длительностью и счетчиками стадий ODM (None - не сохранять).
+        progress_callback: Функция, получающая события прогресса ODM (см. OdmProgressParser).
+        resource_metrics_path: Путь для JSON с временным рядом CPU/памяти/ввода-вывода (None - не опрашивать).
+        resource_prom_path: Путь для сводки ресурсов в текстовом формате Prometheus (None - не сохранять).
+        resource_sample_interval_s: Период опроса ресурсов, сек.
+        worker_params: Параметры сервера задач для run_method='worker' (по умолчанию
+                       config.ODM_WORKER_PARAMS).
+
+    Returns:
+        True в случае условного успеха запуска ODM (код возврата 0 и папка создана), False иначе.
+
+    Raises:
+        helpers.PipelineError: В случае критических ошибок конфигурации или запуска.
+        ValueError: Если project_name='images'.
+    """
+    logger.info(f"--- Запуск OpenDroneMap для проекта '{project_name}' (метод: {run_method}) ---")
+
+    cmd, working_directory, signature, can_resume, expected_output_project_path = _prepare_run(
+        image_dir_abs, output_base_dir_abs, project_name, odm_options, run_method, docker_image, resume)
+
+    attempts = max(0, int(max_retries)) + 1
+    progress = OdmProgressParser(stage_order=[stage for stage, _ in ODM_STAGES], progress_callback=progress_callback)
+    sampler = ResourceSampler(resource_sample_interval_s) if (resource_metrics_path or resource_prom_path) else None
+    try:
+        if run_method == 'worker':
+            return _run_worker_attempts(image_dir_abs, odm_options, attempts, can_resume, signature,
+                                        expected_output_project_path, project_name, progress, sampler,
+                                        _worker_params(worker_params))
+        return _run_attempts(cmd, working_directory, attempts, can_resume, resume, signature,
+                             expected_output_project_path, project_name, progress, sampler)
+    finally:
+        _save_run_metrics(progress, sampler, metrics_path, resource_metrics_path, resource_prom_path,
+                          project_name, run_method, odm_options)
+
+def _prepare_run(image_dir_abs: str, output_base_dir_abs: str, project_name: str,
+                 odm_options: Optional[Dict[str, Any]], run_method: str, docker_image: str,
+                 resume: bool) -> Tuple[List[str], Optional[str], str, bool, str]:
+    """
+    Проверяет входные данные, формирует команду и определяет, можно ли возобновить прошлый запуск.
+
+    Returns:
+        Кортеж (команда, рабочая_папка, подпись_запуска, можно_возобновить, папка_проекта).
+    """
+    # --- Проверки входных данных ---
+    if not os.path.isdir(image_dir_abs):
+        logger.error(f"Директория с входными изображениями не найдена: {image_dir_abs}")
+        raise helpers.PipelineError(f"Input image directory not found: {image_dir_abs}")
+    if not os.listdir(image_dir_abs):
+         logger.error(f"Директория с входными изображениями пуста: {image_dir_abs}")
+         raise helpers.PipelineError(f"Input image directory is empty: {image_dir_abs}")
+    if project_name.lower() == 'images':
+         logger.error("Имя проекта ODM ('project_name') не может быть 'images'.")
+         raise ValueError("ODM project name cannot be 'images'")
+
+    # Убедимся, что базовая папка вывода существует на хосте
+    try:
+        os.makedirs(output_base_dir_abs, exist_ok=True)
+    except OSError as e:
+        logger.error(f"Не удалось создать базовую директорию для вывода ODM: {output_base_dir_abs} - {e}")
+        raise helpers.PipelineError(f"Could not create output base directory: {output_base_dir_abs}") from e
+
+    if run_method == 'worker':
+        # Команда не нужна: задача отправляется на сервер по API
+        cmd, working_directory = [], None
+    else:
+        cmd, working_directory = build_odm_command(image_dir_abs, output_base_dir_abs, project_name,
+                                                   odm_options, run_method, docker_image)
+
+    # --- Возобновление незавершенного запуска ---
+    expected_output_project_path = os.path.join(output_base_dir_abs, project_name)
+    signature = _run_signature(image_dir_abs, odm_options, run_method, docker_image)
+    state = _load_run_state(expected_output_project_path)
+    can_resume = resume and state.get('signature') == signature and state.get('status') != 'completed'
+    if resume and state and not can_resume and state.get('signature') != signature:
+        logger.info("Состояние прошлого запуска ODM относится к другим входным данным/опциям. Запуск с начала.")
+    return cmd, working_directory, signature, can_resume, expected_output_project_path
+
+def _save_run_metrics(progress: OdmProgressParser, sampler: Optional[ResourceSampler], metrics_path: Optional[str],
+                      resource_metrics_path: Optional[str], resource_prom_path: Optional[str], project_name: str,
+                      run_method: str, odm_options: Optional[Dict[str, Any]]):
+    """ Сохраняет метрики стадий и ресурсов запуска (если заданы пути). """
+    if metrics_path:
+        _save_progress_metrics(progress, metrics_path)
+    if sampler is not None:
+        sampler.stop()
+        max_concurrency = (odm_options or {}).get('max-concurrency')
+        if resource_metrics_path:
+            sampler.write_timeseries(resource_metrics_path, extra={
+                'project': project_name, 'run_method': run_method, 'max_concurrency': max_concurrency,
+                'host_cpus': os.cpu_count(), 'stage_durations_s': progress.to_dict()['stage_durations_s']})
+        if resource_prom_path:
+            sampler.write_prometheus(resource_prom_path, labels={'project': project_name, 'run_method': run_method},
+                                     max_concurrency=max_concurrency)
+
+def _save_progress_metrics(progress: OdmProgressParser, metrics_path: str):
+    """ Сохраняет сводку стадий ODM в JSON. """
+    try:
+        os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+        with open(metrics_path, 'w', encoding='utf-8') as f:
+            json.dump(progress.to_dict(), f, indent=4, ensure_ascii=False)
+        logger.info(f"Метрики стадий ODM сохранены в: {metrics_path}")
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить метрики стадий ODM '{metrics_path}': {e}")
+
+def _prepare_attempt(cmd: List[str], attempt: int, can_resume: bool, signature: str,
+                     expected_output_project_path: str, project_name: str) -> Tuple[List[str], Optional[str], Optional[str]]:
+    """ Команда попытки (с --rerun-from при возобновлении и именем контейнера). Возвращает (команда, стадия, контейнер). """
+    attempt_cmd = cmd
+    rerun_from = get_resume_stage(expected_output_project_path) if can_resume else None
+    if rerun_from:
+        # --rerun-from ставится перед позиционным именем проекта
+        attempt_cmd = cmd[:-1] + ['--rerun-from', rerun_from, cmd[-1]]
+        logger.info(f"Возобновление ODM со стадии '{rerun_from}' "
+                    f"(последняя завершенная: {find_last_completed_stage(expected_output_project_path)}).")
+    _save_run_state(expected_output_project_path, {'signature': signature, 'status': 'running',
+                                                   'attempt': attempt, 'rerun_from': rerun_from})
+
+    container_name = None
+    if attempt_cmd[:2] == ['docker', 'run']:
+        # Имя контейнера нужно сэмплеру ресурсов; уникально для каждой попытки
+        container_name = f"odm-{project_name}-{os.getpid()}-{attempt}-{int(time.time())}"
+        attempt_cmd = attempt_cmd[:2] + ['--name', container_name] + attempt_cmd[2:]
+    return attempt_cmd, rerun_from, container_name
+
+def _finish_attempt(return_code: int, attempt: int, attempts: int, rerun_from: Optional[str], signature: str,
+                    expected_output_project_path: str, project_name: str) -> bool:
+    """ Обрабатывает код возврата попытки: True - успех, False - ошибка (можно повторить). """
+    if return_code == 0:
+        # Проверяем не только код возврата, но и наличие папки результатов
+        if os.path.isdir(expected_output_project_path):
+            _save_run_state(expected_output_project_path, {'signature': signature, 'status': 'completed',
+                                                           'attempt': attempt, 'rerun_from': rerun_from})
+            logger.info(f"--- ODM для проекта '{project_name}' завершен успешно ---")
+            return True
+        logger.error(f"ODM завершился с кодом 0, но папка результатов не найдена: {expected_output_project_path}")
+        # Возможно, ODM записал вывод в другое место? Проверить логи ODM выше.
+        raise helpers.OdmError(f"ODM finished with code 0 but output project folder was not found: {expected_output_project_path}")
+
+    logger.error(f"--- ODM для проекта '{project_name}' завершен с ошибкой (код: {return_code}), "
+                 f"попытка {attempt}/{attempts} ---")
+    _save_run_state(expected_output_project_path, {'signature': signature, 'status': 'failed',
+                                                   'attempt': attempt, 'rerun_from': rerun_from,
+                                                   'return_code': return_code})
+    return False
+
+def _run_attempts(cmd: List[str], working_directory: Optional[str], attempts: int, can_resume: bool,
+                  resume: bool, signature: str, expected_output_project_path: str, project_name: str,
+                  progress: OdmProgressParser, sampler: Optional[ResourceSampler] = None) -> bool:
+    """ Запускает ODM с повторами; каждая повторная попытка возобновляется с последней завершенной стадии. """
+    return_code = -1
+    for attempt in range(1, attempts + 1):
+        attempt_cmd, rerun_from, container_name = _prepare_attempt(cmd, attempt, can_resume, signature,
+                                                                   expected_output_project_path, project_name)
+        progress.start_attempt(attempt)
+        return_code = _execute_odm(attempt_cmd, working_directory, progress, sampler, container_name)
+        progress.finish(return_code)
+        if _finish_attempt(return_code, attempt, attempts, rerun_from, signature,
+                           expected_output_project_path, project_name):
+            return True
+        # Следующая попытка продолжает с последней завершенной стадии
+        can_resume = resume
+
+    # Генерируем исключение для обработки в main.py
+    raise helpers.OdmError(f"ODM process for project '{project_name}' finished with error code {return_code}")
+
+def _worker_params(worker_params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    params = dict(DEFAULT_WORKER_PARAMS)
+    if worker_params is None and 'config' in globals():
+        worker_params = getattr(config, 'ODM_WORKER_PARAMS', None)
+    params.update(worker_params or {})
+    return params
+
+def _run_worker_attempts(image_dir_abs: str, odm_options: Optional[Dict[str, Any]], attempts: int,
+                         can_resume: bool, signature: str, expected_output_project_path: str, project_name: str,
+                         progress: OdmProgressParser, sampler: Optional[ResourceSampler],
+                         params: Dict[str, Any]) -> bool:
+    """
+    Выполняет ODM задачей на сервере NodeODM: загрузка, ожидание с трансляцией лога, скачивание.
+
+    Uuid задачи сохраняется в состоянии запуска, поэтому прерванный пайплайн с теми же
+    входными данными подключается к уже загруженной (или выполненной) задаче. Повторы
+    перезапускают задачу на сервере с упавшей стадии без повторной загрузки.
+    """
+    client = odm_worker.NodeOdmClient(params['url'], token=params.get('token'))
+    odm_worker.ensure_worker(client, autostart=params.get('autostart', True), image=params['image'],
+                             container_name=params['container_name'],
+                             port=urllib.parse.urlparse(params['url']).port or 3000,
+                             use_gpu=bool((odm_options or {}).get('use-gpu')))
+    state = _load_run_state(expected_output_project_path) if can_resume else {}
+    task_id = state.get('worker_task')
+    status_code = None
+    if task_id:
+        try:
+            status_code = client.task_info(task_id).get('status', {}).get('code')
+            logger.info(f"Подключение к задаче ODM {task_id} прошлого запуска (статус {status_code}).")
+        except helpers.OdmError:
+            logger.info(f"Задача ODM {task_id} прошлого запуска не найдена на сервере. Новая загрузка.")
+            task_id = None
+
+    for attempt in range(1, attempts + 1):
+        progress.start_attempt(attempt)
+        rerun_from = None
+        if task_id is None:
+            image_paths = sorted(os.path.join(image_dir_abs, name) for name in os.listdir(image_dir_abs)
+                                 if os.path.isfile(os.path.join(image_dir_abs, name)))
+            task_id = odm_worker.submit_task(client, project_name, image_paths, odm_options,
+                                             outputs=params.get('outputs'),
+                                             upload_parallel=params.get('upload_parallel', 4))
+        elif status_code in (odm_worker.TASK_FAILED, odm_worker.TASK_CANCELED):
+            failed_stage = progress.failed_stage()
+            rerun_from = failed_stage if failed_stage in [stage for stage, _ in ODM_STAGES] else None
+            restart_options = dict(odm_options or {}, **({'rerun-from': rerun_from} if rerun_from else {}))
+            logger.info(f"Перезапуск задачи ODM {task_id}" + (f" со стадии '{rerun_from}'." if rerun_from else "."))
+            client.restart_task(task_id, restart_options)
+        _save_run_state(expected_output_project_path, {'signature': signature, 'status': 'running', 'attempt': attempt,
+                                                       'rerun_from': rerun_from, 'worker_task': task_id})
+        if sampler is not None and params.get('container_name'):
+            # Опрашивается весь контейнер сервера задач (включая его другие задачи)
+            sampler.start(container_name=params['container_name'])
+        try:
+            info = odm_worker.wait_task(client, task_id, on_line=progress.feed,
+                                        poll_interval_s=params.get('poll_interval_s', 5.0))
+        finally:
+            if sampler is not None:
+                sampler.stop()
+        status_code = info.get('status', {}).get('code')
+        return_code = 0 if status_code == odm_worker.TASK_COMPLETED else 1
+        progress.finish(return_code)
+        if return_code == 0:
+            odm_worker.download_results(client, task_id, expected_output_project_path)
+            if params.get('remove_after_download', True):
+                try:
+                    client.remove_task(task_id)
+                except helpers.OdmError as e:
+                    logger.warning(f"Не удалось удалить задачу {task_id} на сервере ODM: {e}")
+        else:
+            logger.error(f"Задача ODM {task_id}: {info.get('status', {}).get('errorMessage', 'ошибка')}")
+        if _finish_attempt(return_code, attempt, attempts, rerun_from, signature,
+                           expected_output_project_path, project_name):
+            return True
+        _save_run_state(expected_output_project_path, {'signature': signature, 'status': 'failed', 'attempt': attempt,
+                                                       'rerun_from': rerun_from, 'worker_task': task_id})
+
+    raise helpers.OdmError(f"ODM worker task for project '{project_name}' failed (status {status_code})")
+
+def _execute_odm(cmd: List[str], working_directory: Optional[str],
+                 progress: Optional[OdmProgressParser] = None, sampler: Optional[ResourceSampler] = None,
+                 container_name: Optional[str] = None) -> int:
+    """ Запускает процесс ODM, транслирует его вывод в лог и возвращает код возврата. """
     # Формируем строку для лога
     command_str_log = " ".join(map(shlex.quote, cmd))
     logger.info(f"Итоговая команда запуска ODM:\n{command_str_log}")
@@ -194,21 +547,25 @@ def run_odm(image_dir_abs: str, # Абсолютный путь к images на 
     return_code = -1 # Инициализируем кодом ошибки
     try:
         # Используем Popen для чтения вывода в реальном времени
-        # Указываем рабочую директорию как корень проекта для консистентности,
-        # особенно если native runner ищет 'images' относительно CWD.
-        working_directory = PROJECT_ROOT_PATH if run_method == 'native' else None
-
+        # Рабочая директория - корень проекта для native runner (поиск 'images' относительно CWD).
         with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                               text=True, encoding='utf-8', errors='replace', # Добавили errors='replace'
                               bufsize=1, universal_newlines=True,
                               cwd=working_directory) as process:
+            if sampler is not None:
+                # Контейнер опрашивается по имени, нативный запуск - по дереву процессов
+                sampler.start(container_name=container_name, pid=None if container_name else process.pid)
             # Читаем вывод построчно, пока процесс не завершится
             for line in process.stdout:
                 if line: # Проверяем, что строка не пустая
                     # Выводим лог ODM с INFO уровнем
                     logger.info(f"[ODM] {line.strip()}")
+                    if progress is not None:
+                        progress.feed(line)
 
         return_code = process.returncode # Получаем код возврата после завершения
+        if sampler is not None:
+            sampler.stop()
 
     except FileNotFoundError as fnf_e:
         cmd_exec = cmd[0]
@@ -225,22 +582,286 @@ def run_odm(image_dir_abs: str, # Абсолютный путь к images на 
         # Передаем исключение выше
         raise helpers.OdmError(f"Failed to run ODM: {e}") from e
 
-    # --- Проверка результата ---
-    # Путь к папке, которую должен был создать ODM на хосте
-    expected_output_project_path = os.path.join(output_base_dir_abs, project_name)
+    return return_code
 
-    if return_code == 0:
-        # Проверяем не только код возврата, но и наличие папки результатов
-        if os.path.isdir(expected_output_project_path):
-            logger.info(f"--- ODM для проекта '{project_name}' завершен успешно ---")
-            return True
-        else:
-            logger.error(f"ODM завершился с кодом 0, но папка результатов не найдена: {expected_output_project_path}")
-            # Возможно, ODM записал вывод в другое место? Проверить логи ODM выше.
-            raise helpers.OdmError(f"ODM finished with code 0 but output project folder was not found: {expected_output_project_path}")
-    else: # return_code != 0
-         logger.error(f"--- ODM для проекта '{project_name}' завершен с ошибкой (код: {return_code}) ---")
-         # Генерируем исключение для обработки в main.py
-         raise helpers.OdmError(f"ODM process for project '{project_name}' finished with error code {return_code}")
+# --- Асинхронный запуск (для оркестратора потока полетов) ---
 
-    return False
+async def run_odm_async(image_dir_abs: str, output_base_dir_abs: str, project_name: str = "odm_processing",
+                        odm_options: Optional[Dict[str, Any]] = None, run_method: str = 'docker',
+                        docker_image: str = 'opendronemap/odm:latest', max_retries: int = 0, resume: bool = True,
+                        metrics_path: Optional[str] = None,
+                        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                        resource_metrics_path: Optional[str] = None, resource_prom_path: Optional[str] = None,
+                        resource_sample_interval_s: float = 2.0) -> bool:
+    """
+    Асинхронный аналог run_odm: процесс ODM запускается через asyncio.create_subprocess_exec,
+    поэтому цикл событий свободен для других полетов, пока идет контейнер. Повторы,
+    возобновление (--rerun-from) и метрики - как в run_odm.
+    """
+    loop = asyncio.get_running_loop()
+    if run_method == 'worker':
+        # Работа идет на сервере задач; клиент (загрузка и опрос) - в потоке
+        return await loop.run_in_executor(None, functools.partial(
+            run_odm, image_dir_abs, output_base_dir_abs, project_name, odm_options, run_method, docker_image,
+            max_retries, resume, metrics_path, progress_callback, resource_metrics_path, resource_prom_path,
+            resource_sample_interval_s))
+    logger.info(f"--- Запуск OpenDroneMap (async) для проекта '{project_name}' (метод: {run_method}) ---")
+    # Проверки и сборка команды вызывают docker/nvidia-smi синхронно - выносим из цикла событий
+    cmd, working_directory, signature, can_resume, expected_output_project_path = await loop.run_in_executor(
+        None, functools.partial(_prepare_run, image_dir_abs, output_base_dir_abs, project_name,
+                                odm_options, run_method, docker_image, resume))
+
+    attempts = max(0, int(max_retries)) + 1
+    progress = OdmProgressParser(stage_order=[stage for stage, _ in ODM_STAGES], progress_callback=progress_callback)
+    sampler = ResourceSampler(resource_sample_interval_s) if (resource_metrics_path or resource_prom_path) else None
+    try:
+        return_code = -1
+        for attempt in range(1, attempts + 1):
+            attempt_cmd, rerun_from, container_name = _prepare_attempt(cmd, attempt, can_resume, signature,
+                                                                       expected_output_project_path, project_name)
+            progress.start_attempt(attempt)
+            return_code = await _execute_odm_async(attempt_cmd, working_directory, progress, sampler, container_name)
+            progress.finish(return_code)
+            if _finish_attempt(return_code, attempt, attempts, rerun_from, signature,
+                               expected_output_project_path, project_name):
+                return True
+            can_resume = resume
+        raise helpers.OdmError(f"ODM process for project '{project_name}' finished with error code {return_code}")
+    finally:
+        _save_run_metrics(progress, sampler, metrics_path, resource_metrics_path, resource_prom_path,
+                          project_name, run_method, odm_options)
+
+async def _execute_odm_async(cmd: List[str], working_directory: Optional[str],
+                             progress: Optional[OdmProgressParser] = None, sampler: Optional[ResourceSampler] = None,
+                             container_name: Optional[str] = None) -> int:
+    """ Запускает процесс ODM асинхронно, транслирует вывод в лог и возвращает код возврата. """
+    logger.info(f"Итоговая команда запуска ODM:\n{' '.join(map(shlex.quote, cmd))}")
+    try:
+        # Строки прогресса ODM бывают длинными - увеличиваем лимит буфера строки
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT,
+                                                       cwd=working_directory, limit=1024 * 1024)
+    except FileNotFoundError as fnf_e:
+        logger.fatal(f"Команда '{cmd[0]}' не найдена. Убедитесь, что соответствующее ПО установлено и в PATH. {fnf_e}")
+        raise helpers.OdmError(f"Command '{cmd[0]}' or script not found.") from fnf_e
+    if sampler is not None:
+        sampler.start(container_name=container_name, pid=None if container_name else process.pid)
+    try:
+        async for raw_line in process.stdout:
+            line = raw_line.decode('utf-8', errors='replace').strip()
+            if line:
+                logger.info(f"[ODM] {line}")
+                if progress is not None:
+                    progress.feed(line)
+        return await process.wait()
+    except asyncio.CancelledError:
+        # Отмена задачи полета: останавливаем контейнер, а не только клиент docker
+        logger.warning(f"Запуск ODM отменен, остановка процесса{' и контейнера ' + container_name if container_name else ''}.")
+        if container_name:
+            killer = await asyncio.create_subprocess_exec('docker', 'kill', container_name,
+                                                          stdout=asyncio.subprocess.DEVNULL,
+                                                          stderr=asyncio.subprocess.DEVNULL)
+            await killer.wait()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    finally:
+        if sampler is not None:
+            # Остановка ждет поток опроса - не блокируем цикл событий
+            await asyncio.get_running_loop().run_in_executor(None, sampler.stop)
+
+# --- Режим split-merge: подмодели по GPS-кластерам в параллельных контейнерах ---
+
+SUBMODELS_DIRNAME = 'submodels'
+# Результаты подмоделей, объединяемые в итоговые файлы проекта (пути относительно папки проекта)
+_MERGED_OUTPUTS = ('odm_orthophoto/odm_orthophoto.tif', 'odm_dem/dsm.tif', 'odm_dem/dtm.tif')
+
+def _local_xy(metas: List[Dict[str, Any]]) -> List[Tuple[float, float]]:
+    """ Координаты точек съемки в метрах (равнопромежуточная проекция вокруг центра набора). """
+    lat0 = math.radians(sum(m['lat'] for m in metas) / len(metas))
+    lon0 = sum(m['lon'] for m in metas) / len(metas)
+    return [(math.radians(m['lon'] - lon0) * math.cos(lat0) * 6371000.0, math.radians(m['lat']) * 6371000.0)
+            for m in metas]
+
+def cluster_images_by_gps(metas: List[Dict[str, Any]], max_images: int,
+                          overlap_m: float) -> List[List[Dict[str, Any]]]:
+    """
+    Делит снимки на пространственные кластеры рекурсивной бисекцией по медиане вдоль
+    длинной стороны охвата, пока в кластере не больше max_images снимков. Затем каждый
+    кластер дополняется снимками в пределах overlap_m от его охвата, чтобы соседние
+    подмодели перекрывались и стыковались при объединении.
+
+    Returns:
+        Списки метаданных снимков по подмоделям (снимки в зоне перекрытия входят в несколько).
+    """
+    xy = _local_xy(metas)
+    points = list(range(len(metas)))
+
+    def bisect(indices: List[int]) -> List[List[int]]:
+        if len(indices) <= max_images:
+            return [indices]
+        xs = [xy[i][0] for i in indices]
+        ys = [xy[i][1] for i in indices]
+        axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+        ordered = sorted(indices, key=lambda i: xy[i][axis])
+        middle = len(ordered) // 2
+        return bisect(ordered[:middle]) + bisect(ordered[middle:])
+
+    clusters = []
+    for core in bisect(points):
+        min_x = min(xy[i][0] for i in core) - overlap_m
+        max_x = max(xy[i][0] for i in core) + overlap_m
+        min_y = min(xy[i][1] for i in core) - overlap_m
+        max_y = max(xy[i][1] for i in core) + overlap_m
+        members = [i for i in points if min_x <= xy[i][0] <= max_x and min_y <= xy[i][1] <= max_y]
+        clusters.append([metas[i] for i in members])
+    return clusters
+
+def merge_rasters(source_paths: List[str], destination_path: str, block_size: int = 4096) -> bool:
+    """
+    Объединяет перекрывающиеся растры подмоделей в один GeoTIFF поблочно (память
+    ограничена размером блока). В зонах перекрытия берется первый растр с данными
+    (маска/альфа-канал/nodata исходников учитываются rasterio.merge).
+    """
+    import rasterio
+    from rasterio.merge import merge
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window, bounds as window_bounds
+
+    sources = [rasterio.open(p) for p in source_paths]
+    try:
+        first = sources[0]
+        if any(src.crs != first.crs for src in sources):
+            raise helpers.OdmError(f"Submodel rasters have different CRS: {sorted({str(s.crs) for s in sources})}")
+        res_x, res_y = first.res
+        left = min(src.bounds.left for src in sources)
+        bottom = min(src.bounds.bottom for src in sources)
+        right = max(src.bounds.right for src in sources)
+        top = max(src.bounds.top for src in sources)
+        width = int(math.ceil((right - left) / res_x))
+        height = int(math.ceil((top - bottom) / res_y))
+        transform = from_origin(left, top, res_x, res_y)
+        profile = first.profile.copy()
+        profile.update(driver='GTiff', width=width, height=height, transform=transform, tiled=True,
+                       blockxsize=512, blockysize=512, compress='deflate', BIGTIFF='IF_SAFER')
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        tmp_path = destination_path + '.tmp.tif'
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for row in range(0, height, block_size):
+                for col in range(0, width, block_size):
+                    window = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+                    data, _ = merge(sources, bounds=window_bounds(window, transform), res=(res_x, res_y),
+                                    nodata=first.nodata, method='first')
+                    dst.write(data[:, :window.height, :window.width], window=window)
+        os.replace(tmp_path, destination_path)
+    finally:
+        for src in sources:
+            src.close()
+    logger.info(f"Объединено {len(source_paths)} растров подмоделей в: {destination_path}")
+    return True
+
+def _submodel_completed(project_path: str, signature: str) -> bool:
+    """ Подмодель уже посчитана с теми же входными данными и опциями. """
+    state = _load_run_state(project_path)
+    return (state.get('status') == 'completed' and state.get('signature') == signature
+            and os.path.exists(os.path.join(project_path, _MERGED_OUTPUTS[0])))
+
+def run_odm_split(image_dir_abs: str, output_base_dir_abs: str, project_name: str = "odm_processing",
+                  odm_options: Optional[Dict[str, Any]] = None, run_method: str = 'docker',
+                  docker_image: str = 'opendronemap/odm:latest', max_images_per_submodel: int = 400,
+                  overlap_m: float = 50.0, max_parallel: int = 2, memory_budget_gb: Optional[float] = None,
+                  min_images: int = 1000, metrics_path: Optional[str] = None,
+                  resource_metrics_path: Optional[str] = None, resource_prom_path: Optional[str] = None,
+                  **run_kwargs) -> bool:
+    """
+    Запускает ODM в режиме split-merge: снимки делятся на перекрывающиеся GPS-кластеры,
+    подмодели считаются параллельными контейнерами в общем бюджете ядер и памяти,
+    а их ортофото и DSM/DTM объединяются в стандартные пути проекта
+    (output_base_dir_abs/project_name/odm_orthophoto/odm_orthophoto.tif и odm_dem/*.tif),
+    поэтому find_odm_results и дальнейший пайплайн не меняются.
+
+    Бюджет ядер - max-concurrency из odm_options; он делится между одновременными подмоделями.
+    Число одновременных подмоделей ограничено max_parallel и оценкой памяти подмодели
+    (odm_profile.estimate_cost) относительно memory_budget_gb. Уже посчитанные подмодели
+    с теми же входными данными пропускаются. Небольшие наборы (< min_images) и наборы
+    со снимками без GPS обрабатываются обычным run_odm.
+
+    Returns:
+        True при успешном расчете всех подмоделей и объединении результатов.
+
+    Raises:
+        helpers.OdmError: Если подмодель завершилась с ошибкой или результаты не удалось объединить.
+    """
+    from core import preingest, odm_profile
+    odm_options = dict(odm_options or {})
+    single_kwargs = dict(run_kwargs, metrics_path=metrics_path, resource_metrics_path=resource_metrics_path,
+                         resource_prom_path=resource_prom_path)
+    image_paths = sorted(os.path.join(image_dir_abs, f) for f in os.listdir(image_dir_abs)
+                         if os.path.isfile(os.path.join(image_dir_abs, f)))
+    if len(image_paths) < max(min_images, max_images_per_submodel + 1):
+        logger.info(f"Split-merge: {len(image_paths)} снимков - разбиение не требуется, обычный запуск ODM.")
+        return run_odm(image_dir_abs, output_base_dir_abs, project_name, odm_options, run_method, docker_image,
+                       **single_kwargs)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        metas = list(executor.map(preingest.read_image_metadata, image_paths))
+    if any(m.get('lat') is None or m.get('lon') is None for m in metas):
+        logger.warning("Split-merge: есть снимки без GPS, кластеризация невозможна. Обычный запуск ODM.")
+        return run_odm(image_dir_abs, output_base_dir_abs, project_name, odm_options, run_method, docker_image,
+                       **single_kwargs)
+
+    clusters = cluster_images_by_gps(metas, max_images_per_submodel, overlap_m)
+    project_path = os.path.join(output_base_dir_abs, project_name)
+    submodels_base = os.path.join(project_path, SUBMODELS_DIRNAME)
+
+    # Бюджет ядер делится между одновременными подмоделями; параллелизм ограничен памятью
+    cpu_budget = max(1, int(odm_options.get('max-concurrency') or os.cpu_count() or 1))
+    parallel = max(1, min(max_parallel, len(clusters), cpu_budget))
+    largest = max(clusters, key=len)
+    megapixels = [m['width'] * m['height'] / 1e6 for m in largest if m.get('width') and m.get('height')]
+    dataset = {'image_count': len(largest), 'megapixels_per_image': sum(megapixels) / len(megapixels) if megapixels else 12.0}
+    while parallel > 1 and memory_budget_gb is not None:
+        sub_options = dict(odm_options, **{'max-concurrency': max(1, cpu_budget // parallel)})
+        if parallel * odm_profile.estimate_cost(sub_options, dataset, cpu_budget)['memory_gb'] <= memory_budget_gb:
+            break
+        parallel -= 1
+    sub_options = dict(odm_options, **{'max-concurrency': max(1, cpu_budget // parallel)})
+    logger.info(f"Split-merge: {len(image_paths)} снимков -> {len(clusters)} подмоделей "
+                f"(до {max_images_per_submodel} снимков, перекрытие {overlap_m} м), "
+                f"одновременно {parallel} по {sub_options['max-concurrency']} потоков.")
+
+    def run_submodel(index: int, cluster: List[Dict[str, Any]]) -> str:
+        name = f"submodel_{index:04d}"
+        sub_image_dir = os.path.join(submodels_base, 'images', name)
+        preingest.stage_images(cluster, sub_image_dir)
+        sub_project = os.path.join(submodels_base, name)
+        signature = _run_signature(sub_image_dir, sub_options, run_method, docker_image)
+        if _submodel_completed(sub_project, signature):
+            logger.info(f"Split-merge: подмодель {name} уже посчитана - пропуск.")
+            return sub_project
+        sub_kwargs = dict(run_kwargs)
+        for key, path in (('metrics_path', metrics_path), ('resource_metrics_path', resource_metrics_path),
+                          ('resource_prom_path', resource_prom_path)):
+            if path:
+                sub_kwargs[key] = os.path.join(sub_project, os.path.basename(path))
+        run_odm(sub_image_dir, submodels_base, name, sub_options, run_method, docker_image, **sub_kwargs)
+        return sub_project
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(run_submodel, i, cluster) for i, cluster in enumerate(clusters)]
+        sub_projects = [f.result() for f in futures] # Ошибка подмодели (OdmError) пробрасывается
+
+    # --- Объединение результатов в стандартные пути проекта ---
+    for relative in _MERGED_OUTPUTS:
+        parts = [os.path.join(p, relative) for p in sub_projects if os.path.exists(os.path.join(p, relative))]
+        if not parts:
+            continue
+        try:
+            merge_rasters(parts, os.path.join(project_path, relative))
+        except Exception as e:
+            raise helpers.OdmError(f"Failed to merge submodel outputs '{relative}': {e}") from e
+    if not os.path.exists(os.path.join(project_path, _MERGED_OUTPUTS[0])):
+        raise helpers.OdmError("Split-merge finished but no submodel produced an orthophoto.")
+    logger.info(f"--- Split-merge ODM для проекта '{project_name}' завершен: {len(sub_projects)} подмоделей ---")
+    return True
@@ -0,0 +1,293 @@
+import http.client
+import json
+import logging
+import mimetypes
+import os
+import socket
+import subprocess
+import time
+import urllib.parse
+import uuid as uuid_lib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, Iterator
+
+from utils import helpers
+
+logger = logging.getLogger(__name__)
+
+# Коды статуса задачи NodeODM (/task/<uuid>/info -> status.code)
+TASK_QUEUED = 10
+TASK_RUNNING = 20
+TASK_FAILED = 30
+TASK_COMPLETED = 40
+TASK_CANCELED = 50
+TASK_FINISHED_CODES = (TASK_FAILED, TASK_COMPLETED, TASK_CANCELED)
+
+_UPLOAD_CHUNK_SIZE = 1024 * 1024
+_UPLOAD_ATTEMPTS = 3
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP поверх Unix-сокета (для сервера задач, слушающего unix:///path/to.sock). """
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class NodeOdmClient:
+    """
+    Клиент API задач NodeODM (совместимого сервера) - долгоживущего процесса с "теплым" ODM.
+
+    Изображения загружаются по одному файлу (/task/new/init -> upload -> commit), поэтому
+    набор не держится в памяти и загрузку можно распараллелить. Адрес - 'http://host:port'
+    или 'unix:///path/to.sock'.
+
+    Raises:
+        helpers.OdmError: Сервер недоступен или вернул ошибку (во всех методах).
+    """
+    def __init__(self, url: str, token: Optional[str] = None, timeout: float = 60.0):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        parsed = urllib.parse.urlparse(url)
+        self._scheme = parsed.scheme
+        if parsed.scheme == 'unix':
+            self._socket_path = parsed.path
+        elif parsed.scheme in ('http', 'https'):
+            self._host, self._port = parsed.hostname or 'localhost', parsed.port
+        else:
+            raise ValueError(f"Unsupported ODM worker URL: {url}")
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self._scheme == 'unix':
+            return _UnixHTTPConnection(self._socket_path, self.timeout)
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self.timeout)
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+
+    def _path(self, path: str, query: Optional[Dict[str, Any]] = None) -> str:
+        query = dict(query or {})
+        if self.token:
+            query['token'] = self.token
+        return path + ('?' + urllib.parse.urlencode(query) if query else '')
+
+    def _request(self, method: str, path: str, body: Any = None, headers: Optional[Dict[str, str]] = None,
+                 query: Optional[Dict[str, Any]] = None, stream_to: Optional[str] = None) -> Any:
+        """ Выполняет запрос; возвращает разобранный JSON (или путь файла при stream_to). """
+        conn = self._connection()
+        try:
+            conn.request(method, self._path(path, query), body=body, headers=headers or {})
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise helpers.OdmError(f"ODM worker {method} {path} failed: HTTP {response.status} "
+                                       f"{response.read(500).decode('utf-8', 'replace')}")
+            if stream_to:
+                with open(stream_to, 'wb') as f:
+                    for chunk in iter(lambda: response.read(_UPLOAD_CHUNK_SIZE), b''):
+                        f.write(chunk)
+                return stream_to
+            payload = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise helpers.OdmError(f"ODM worker {self.url} is not reachable: {e}") from e
+        finally:
+            conn.close()
+        try:
+            data = json.loads(payload) if payload else {}
+        except ValueError as e:
+            raise helpers.OdmError(f"ODM worker {method} {path} returned invalid JSON") from e
+        if isinstance(data, dict) and data.get('error'):
+            raise helpers.OdmError(f"ODM worker {method} {path} failed: {data['error']}")
+        return data
+
+    def _post_form(self, path: str, fields: Dict[str, Any]) -> Any:
+        body = urllib.parse.urlencode({k: v for k, v in fields.items() if v is not None})
+        return self._request('POST', path, body=body,
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def _post_multipart(self, path: str, fields: Dict[str, Any], file_field: Optional[str] = None,
+                        file_path: Optional[str] = None) -> Any:
+        """ multipart/form-data с потоковой передачей файла (Content-Length считается заранее). """
+        boundary = uuid_lib.uuid4().hex
+        head = b''.join(
+            (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode('utf-8')
+            for name, value in fields.items() if value is not None)
+        tail = f'--{boundary}--\r\n'.encode('utf-8')
+        file_head, file_size = b'', 0
+        if file_path:
+            file_name = os.path.basename(file_path)
+            content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+            file_head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                         f'filename="{file_name}"\r\nContent-Type: {content_type}\r\n\r\n').encode('utf-8')
+            file_size = os.path.getsize(file_path)
+
+        def body() -> Iterator[bytes]:
+            yield head
+            if file_path:
+                yield file_head
+                with open(file_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(_UPLOAD_CHUNK_SIZE), b''):
+                        yield chunk
+                yield b'\r\n'
+            yield tail
+
+        length = len(head) + len(tail) + (len(file_head) + file_size + 2 if file_path else 0)
+        return self._request('POST', path, body=body(), headers={
+            'Content-Type': f'multipart/form-data; boundary={boundary}', 'Content-Length': str(length)})
+
+    # --- Методы API ---
+
+    def info(self) -> Dict[str, Any]:
+        """ Сведения о сервере (версия, число задач в очереди, max_parallel_tasks). """
+        return self._request('GET', '/info')
+
+    def is_alive(self) -> bool:
+        try:
+            self.info()
+            return True
+        except helpers.OdmError:
+            return False
+
+    def create_task(self, name: str, odm_options: Optional[Dict[str, Any]] = None,
+                    outputs: Optional[List[str]] = None) -> str:
+        """ Создает задачу для пофайловой загрузки; outputs ограничивает состав all.zip. Возвращает uuid. """
+        fields = {'name': name, 'options': json.dumps(to_task_options(odm_options)),
+                  'outputs': json.dumps(outputs) if outputs else None}
+        return self._post_multipart('/task/new/init', fields)['uuid']
+
+    def upload_image(self, task_id: str, image_path: str):
+        self._post_multipart(f'/task/new/upload/{task_id}', {}, file_field='images', file_path=image_path)
+
+    def commit_task(self, task_id: str):
+        """ Завершает загрузку - задача встает в очередь сервера. """
+        self._request('POST', f'/task/new/commit/{task_id}')
+
+    def task_info(self, task_id: str) -> Dict[str, Any]:
+        return self._request('GET', f'/task/{task_id}/info')
+
+    def task_output(self, task_id: str, line: int = 0) -> List[str]:
+        """ Строки лога ODM задачи, начиная с номера line. """
+        return self._request('GET', f'/task/{task_id}/output', query={'line': line}) or []
+
+    def restart_task(self, task_id: str, odm_options: Optional[Dict[str, Any]] = None):
+        """ Перезапуск задачи на уже загруженных изображениях (промежуточные результаты сохраняются на сервере). """
+        self._post_form('/task/restart', {'uuid': task_id,
+                                          'options': json.dumps(to_task_options(odm_options)) if odm_options else None})
+
+    def cancel_task(self, task_id: str):
+        self._post_form('/task/cancel', {'uuid': task_id})
+
+    def remove_task(self, task_id: str):
+        self._post_form('/task/remove', {'uuid': task_id})
+
+    def download(self, task_id: str, destination_path: str, asset: str = 'all.zip') -> str:
+        """ Скачивает результат задачи потоком в файл. """
+        return self._request('GET', f'/task/{task_id}/download/{asset}', stream_to=destination_path)
+
+def to_task_options(odm_options: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ Опции ODM {ключ: значение} в формат API задач [{'name', 'value'}] (False/None пропускаются). """
+    options = []
+    for key, value in (odm_options or {}).items():
+        if key in ('orthophoto-tif', 'name', 'project-name', 'project-path') or value is None or value is False:
+            continue
+        options.append({'name': key, 'value': value})
+    return options
+
+def ensure_worker(client: NodeOdmClient, autostart: bool = True, image: str = 'opendronemap/nodeodm:latest',
+                  container_name: str = 'odm-worker', port: int = 3000, use_gpu: bool = False,
+                  startup_timeout_s: float = 120.0):
+    """
+    Проверяет, что сервер задач отвечает; при autostart поднимает его контейнер.
+
+    Контейнер запускается без --rm и остается работать между полетами, поэтому ODM
+    не стартует заново для каждого запуска.
+
+    Raises:
+        helpers.OdmError: Сервер недоступен и не может быть запущен.
+    """
+    if client.is_alive():
+        return
+    if not autostart:
+        raise helpers.OdmError(f"ODM worker is not reachable at {client.url}")
+    logger.info(f"Сервер задач ODM недоступен ({client.url}). Запуск контейнера '{container_name}' ({image})...")
+    try:
+        # Сначала пробуем остановленный контейнер - образ и его состояние уже на месте
+        started = subprocess.run(['docker', 'start', container_name], capture_output=True, text=True).returncode == 0
+        if not started:
+            cmd = ['docker', 'run', '-d', '--restart', 'unless-stopped', '--name', container_name,
+                   '-p', f'{port}:3000']
+            if use_gpu:
+                cmd.extend(['--gpus', 'all'])
+            subprocess.run(cmd + [image], check=True, capture_output=True, text=True)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        raise helpers.OdmError(f"Could not start ODM worker container '{container_name}': {e}") from e
+    deadline = time.monotonic() + startup_timeout_s
+    while time.monotonic() < deadline:
+        if client.is_alive():
+            logger.info(f"Сервер задач ODM запущен: {client.url}")
+            return
+        time.sleep(1.0)
+    raise helpers.OdmError(f"ODM worker did not become ready at {client.url} within {startup_timeout_s:.0f} s")
+
+def submit_task(client: NodeOdmClient, name: str, image_paths: List[str], odm_options: Optional[Dict[str, Any]] = None,
+                outputs: Optional[List[str]] = None, upload_parallel: int = 4) -> str:
+    """ Создает задачу, загружает изображения параллельно (с повторами каждого файла) и ставит ее в очередь. """
+    task_id = client.create_task(name, odm_options, outputs)
+    logger.info(f"Задача ODM {task_id}: загрузка {len(image_paths)} изображений на {client.url}...")
+
+    def upload(path: str):
+        for attempt in range(1, _UPLOAD_ATTEMPTS + 1):
+            try:
+                client.upload_image(task_id, path)
+                return
+            except helpers.OdmError as e:
+                if attempt == _UPLOAD_ATTEMPTS:
+                    raise
+                logger.warning(f"Повтор загрузки '{os.path.basename(path)}' ({attempt}/{_UPLOAD_ATTEMPTS}): {e}")
+                time.sleep(attempt)
+
+    with helpers.Timer("Загрузка изображений на сервер задач ODM", image_count=len(image_paths)):
+        with ThreadPoolExecutor(max_workers=max(1, upload_parallel)) as executor:
+            list(executor.map(upload, image_paths))
+    client.commit_task(task_id)
+    return task_id
+
+def wait_task(client: NodeOdmClient, task_id: str, on_line: Optional[Callable[[str], None]] = None,
+              poll_interval_s: float = 5.0) -> Dict[str, Any]:
+    """
+    Ждет завершения задачи, передавая новые строки лога ODM в on_line.
+
+    Returns:
+        Последний ответ /task/<uuid>/info (status.code - один из TASK_*).
+    """
+    line = 0
+    while True:
+        info = client.task_info(task_id)
+        output = client.task_output(task_id, line)
+        line += len(output)
+        for text in output:
+            logger.info(f"[ODM] {text}")
+            if on_line is not None:
+                on_line(text)
+        if info.get('status', {}).get('code') in TASK_FINISHED_CODES:
+            return info
+        time.sleep(poll_interval_s)
+
+def download_results(client: NodeOdmClient, task_id: str, project_path: str):
+    """ Скачивает all.zip задачи и распаковывает в папку проекта (структура как у локального ODM). """
+    os.makedirs(project_path, exist_ok=True)
+    archive_path = os.path.join(project_path, f'.{task_id}.all.zip')
+    try:
+        with helpers.Timer("Скачивание результатов ODM"):
+            client.download(task_id, archive_path)
+        with zipfile.ZipFile(archive_path) as archive:
+            archive.extractall(project_path)
+    except zipfile.BadZipFile as e:
+        raise helpers.OdmError(f"ODM worker returned a corrupt archive for task {task_id}") from e
+    finally:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
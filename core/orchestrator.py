@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Union
+
+logger = logging.getLogger(__name__)
+
+StageFunc = Callable[[Dict[str, Any]], Union[Optional[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]]
+
+class Stage:
+    """
+    Стадия обработки полета с собственным лимитом одновременных выполнений.
+
+    func получает контекст полета и возвращает словарь обновлений контекста (или None).
+    Корутины выполняются в цикле событий (например, контейнер ODM через
+    create_subprocess_exec); обычные функции - в пуле потоков стадии.
+    """
+    def __init__(self, name: str, func: StageFunc, concurrency: int = 1):
+        self.name = name
+        self.func = func
+        self.concurrency = max(1, int(concurrency))
+        self.is_async = asyncio.iscoroutinefunction(func)
+        self.busy_s = 0.0
+
+class FlightOrchestrator:
+    """
+    Конвейер стадий для потока полетов: каждый полет проходит стадии по порядку, а разные
+    полеты находятся на разных стадиях одновременно (ODM полета N+1 идет параллельно с
+    анализом полета N). Пропускная способность ограничена самой медленной стадией,
+    а не суммой стадий. Ошибка стадии останавливает только свой полет.
+    """
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+
+    async def _process_flight(self, flight: Dict[str, Any], semaphores: Dict[str, asyncio.Semaphore],
+                              executors: Dict[str, ThreadPoolExecutor]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        flight.setdefault('timings', {})
+        flight['status'] = 'running'
+        for stage in self.stages:
+            async with semaphores[stage.name]:
+                started = time.perf_counter()
+                logger.info(f"[{flight['project_name']}] Стадия '{stage.name}' начата.")
+                try:
+                    if stage.is_async:
+                        updates = await stage.func(flight)
+                    else:
+                        updates = await loop.run_in_executor(executors[stage.name], stage.func, flight)
+                except Exception as e:
+                    flight['status'] = 'failed'
+                    flight['error'] = f"{stage.name}: {type(e).__name__}: {e}"
+                    logger.error(f"[{flight['project_name']}] Стадия '{stage.name}' завершилась ошибкой: {e}", exc_info=True)
+                    return flight
+                finally:
+                    elapsed = time.perf_counter() - started
+                    flight['timings'][stage.name] = round(elapsed, 3)
+                    stage.busy_s += elapsed
+                if updates:
+                    flight.update(updates)
+                if flight.get('stop'):
+                    # Стадия решила, что продолжать нечего (например, нет ортофото)
+                    flight['status'] = 'skipped'
+                    logger.warning(f"[{flight['project_name']}] Обработка остановлена после стадии '{stage.name}'.")
+                    return flight
+                logger.info(f"[{flight['project_name']}] Стадия '{stage.name}' завершена за {elapsed:.1f} с.")
+        flight['status'] = 'succeeded'
+        return flight
+
+    async def run_async(self, flights: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """ Обрабатывает полеты конвейером. Возвращает {'flights', 'wall_s', 'stage_busy_s', 'serial_s'}. """
+        semaphores = {stage.name: asyncio.Semaphore(stage.concurrency) for stage in self.stages}
+        executors = {stage.name: ThreadPoolExecutor(max_workers=stage.concurrency, thread_name_prefix=stage.name)
+                     for stage in self.stages if not stage.is_async}
+        for stage in self.stages:
+            stage.busy_s = 0.0
+        started = time.perf_counter()
+        try:
+            results = await asyncio.gather(*(self._process_flight(f, semaphores, executors) for f in flights))
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        wall = time.perf_counter() - started
+        summary = {
+            'flights': results,
+            'wall_s': round(wall, 3),
+            'stage_busy_s': {stage.name: round(stage.busy_s, 3) for stage in self.stages},
+            # Время последовательной обработки тех же полетов (сумма всех стадий)
+            'serial_s': round(sum(sum(f['timings'].values()) for f in results), 3),
+        }
+        logger.info(f"Конвейер: {len(flights)} полетов за {wall:.1f} с (последовательно: {summary['serial_s']:.1f} с; "
+                    f"загрузка стадий: {summary['stage_busy_s']}).")
+        return summary
+
+    def run(self, flights: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """ Синхронная обертка над run_async. """
+        return asyncio.run(self.run_async(flights))
@@ -0,0 +1,302 @@
+import json
+import logging
+import math
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Теги EXIF
+_EXIF_IFD = 0x8769
+_GPS_IFD = 0x8825
+_TAG_DATETIME_ORIGINAL = 36867
+_TAG_FOCAL_LENGTH = 37386
+_TAG_FOCAL_LENGTH_35MM = 41989
+_TAG_MAKE = 271
+_TAG_MODEL = 272
+# Относительная высота над точкой взлета в XMP (DJI и совместимые)
+_XMP_RELATIVE_ALTITUDE = re.compile(rb'RelativeAltitude\s*=\s*"([+-]?[0-9.]+)"|<[^>]*RelativeAltitude>([+-]?[0-9.]+)<')
+_XMP_SCAN_BYTES = 256 * 1024
+# Длинная сторона изображения для оценки резкости и перцептивного хэша
+_ANALYSIS_SIDE = 1024
+# Манифест staging: с какими исходником и параметрами подготовлен каждый файл
+_STAGING_MANIFEST = '.staging_manifest.json'
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+def _dms_to_degrees(dms, ref) -> Optional[float]:
+    """ Переводит EXIF-координату (градусы, минуты, секунды) в десятичные градусы. """
+    try:
+        degrees = float(dms[0]) + float(dms[1]) / 60.0 + float(dms[2]) / 3600.0
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        return None
+    if isinstance(ref, bytes):
+        ref = ref.decode('ascii', 'ignore')
+    return -degrees if str(ref).strip().upper() in ('S', 'W') else degrees
+
+def _read_relative_altitude(path: str) -> Optional[float]:
+    """ Относительная высота полета из XMP в начале файла или None. """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(_XMP_SCAN_BYTES)
+    except OSError:
+        return None
+    match = _XMP_RELATIVE_ALTITUDE.search(head)
+    if not match:
+        return None
+    return _to_float((match.group(1) or match.group(2)).decode('ascii'))
+
+def read_image_metadata(path: str) -> Dict[str, Any]:
+    """
+    Читает EXIF/GPS изображения через Pillow.
+
+    Returns:
+        Словарь {'path', 'name', 'width', 'height', 'lat', 'lon', 'alt', 'relative_alt',
+        'datetime', 'focal_length', 'focal_length_35mm', 'camera'}. Отсутствующие поля = None.
+    """
+    from PIL import Image
+    meta: Dict[str, Any] = {'path': path, 'name': os.path.basename(path), 'width': None, 'height': None,
+                            'lat': None, 'lon': None, 'alt': None, 'relative_alt': None, 'datetime': None,
+                            'focal_length': None, 'focal_length_35mm': None, 'camera': None}
+    with Image.open(path) as img:
+        meta['width'], meta['height'] = img.size
+        exif = img.getexif()
+        meta['camera'] = " ".join(str(exif.get(t, '')).strip() for t in (_TAG_MAKE, _TAG_MODEL)).strip() or None
+        exif_ifd = exif.get_ifd(_EXIF_IFD)
+        meta['datetime'] = exif_ifd.get(_TAG_DATETIME_ORIGINAL)
+        meta['focal_length'] = _to_float(exif_ifd.get(_TAG_FOCAL_LENGTH))
+        meta['focal_length_35mm'] = _to_float(exif_ifd.get(_TAG_FOCAL_LENGTH_35MM))
+        gps = exif.get_ifd(_GPS_IFD)
+        if gps:
+            meta['lat'] = _dms_to_degrees(gps.get(2), gps.get(1, 'N'))
+            meta['lon'] = _dms_to_degrees(gps.get(4), gps.get(3, 'E'))
+            alt = _to_float(gps.get(6))
+            if alt is not None and gps.get(5) in (1, b'\x01'):
+                alt = -alt # Ниже уровня моря
+            meta['alt'] = alt
+    meta['relative_alt'] = _read_relative_altitude(path)
+    return meta
+
+def _load_analysis_gray(path: str) -> np.ndarray:
+    """ Быстро декодирует изображение в оттенках серого с длинной стороной около _ANALYSIS_SIDE. """
+    from PIL import Image
+    with Image.open(path) as img:
+        # draft() позволяет JPEG-декодеру сразу масштабировать через DCT (в разы быстрее полного декодирования)
+        img.draft('L', (_ANALYSIS_SIDE, _ANALYSIS_SIDE))
+        gray = img.convert('L')
+        gray.thumbnail((_ANALYSIS_SIDE, _ANALYSIS_SIDE))
+        return np.asarray(gray)
+
+def blur_score(gray: np.ndarray) -> float:
+    """ Резкость кадра: дисперсия лапласиана (меньше - размытее). """
+    import cv2
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+def perceptual_hash(gray: np.ndarray, hash_size: int = 8) -> int:
+    """ pHash: знаки низкочастотных коэффициентов DCT относительно медианы, упакованные в int. """
+    import cv2
+    small = cv2.resize(gray, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:hash_size, :hash_size].ravel()
+    bits = low[1:] > np.median(low[1:])
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+def gps_distance_m(a: Dict[str, Any], b: Dict[str, Any]) -> Optional[float]:
+    """ Расстояние между точками съемки (м, равнопромежуточное приближение) или None без GPS. """
+    if None in (a.get('lat'), a.get('lon'), b.get('lat'), b.get('lon')):
+        return None
+    lat = math.radians((a['lat'] + b['lat']) / 2.0)
+    dx = math.radians(b['lon'] - a['lon']) * math.cos(lat) * 6371000.0
+    dy = math.radians(b['lat'] - a['lat']) * 6371000.0
+    return math.hypot(dx, dy)
+
+def scan_image(path: str) -> Dict[str, Any]:
+    """ Задача процесса: метаданные, оценка резкости и перцептивный хэш одного изображения. """
+    try:
+        meta = read_image_metadata(path)
+        gray = _load_analysis_gray(path)
+        meta['blur_score'] = round(blur_score(gray), 2)
+        meta['phash'] = perceptual_hash(gray)
+        meta['error'] = None
+    except Exception as e:
+        meta = {'path': path, 'name': os.path.basename(path), 'error': str(e)}
+    return meta
+
+def scan_images(image_paths: List[str], workers: int = 4) -> List[Dict[str, Any]]:
+    """ Параллельно сканирует изображения в пуле процессов; порядок результатов = порядок путей. """
+    workers = max(1, min(workers, len(image_paths)))
+    if workers == 1:
+        return [scan_image(p) for p in image_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_image, image_paths, chunksize=max(1, len(image_paths) // (workers * 4))))
+
+def select_images(scans: List[Dict[str, Any]], blur_threshold: float = 50.0,
+                  duplicate_hash_distance: int = 4,
+                  duplicate_max_distance_m: float = 2.0) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Отбирает кадры для ODM: отбрасывает нечитаемые, размытые и почти дубликаты.
+
+    Дубликатом считается кадр, чей pHash отличается от последнего принятого кадра не более
+    чем на duplicate_hash_distance бит, а точка съемки (если есть GPS) не дальше
+    duplicate_max_distance_m - типичная ситуация при зависании дрона. Кадры сравниваются
+    в порядке времени съемки (или имени файла).
+
+    Returns:
+        Кортеж (принятые, отброшенные); у отброшенных заполнено поле 'reject_reason'.
+    """
+    kept, rejected = [], []
+    ordered = sorted(scans, key=lambda m: (m.get('datetime') or '', m['name']))
+    last_kept = None
+    for meta in ordered:
+        if meta.get('error'):
+            rejected.append(dict(meta, reject_reason='unreadable'))
+            continue
+        if blur_threshold and meta['blur_score'] < blur_threshold:
+            rejected.append(dict(meta, reject_reason='blurry'))
+            continue
+        if last_kept is not None and duplicate_hash_distance >= 0:
+            distance = gps_distance_m(last_kept, meta)
+            if (hamming_distance(last_kept['phash'], meta['phash']) <= duplicate_hash_distance
+                    and (distance is None or distance <= duplicate_max_distance_m)):
+                rejected.append(dict(meta, reject_reason='duplicate', duplicate_of=last_kept['name']))
+                continue
+        kept.append(meta)
+        last_kept = meta
+    return kept, rejected
+
+def _load_staging_manifest(staging_dir: str) -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(os.path.join(staging_dir, _STAGING_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def _save_staging_manifest(staging_dir: str, manifest: Dict[str, Dict[str, Any]]):
+    path = os.path.join(staging_dir, _STAGING_MANIFEST)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+def _staging_signature(source: str, max_side: Optional[int], jpeg_quality: int) -> Dict[str, Any]:
+    """ Исходник (путь, размер, mtime) и параметры подготовки; качество важно только при уменьшении. """
+    stat = os.stat(source)
+    return {'source': os.path.abspath(source), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'max_side': max_side or None, 'jpeg_quality': jpeg_quality if max_side else None}
+
+def _stage_image(source: str, destination: str, max_side: Optional[int], jpeg_quality: int,
+                 manifest: Dict[str, Dict[str, Any]]):
+    """
+    Кладет изображение в staging: уменьшенная копия с EXIF или жесткая ссылка/копия.
+    Файл пересоздается, если запись манифеста (исходник и параметры) не совпадает с текущей.
+    """
+    name = os.path.basename(destination)
+    if os.path.realpath(source) == os.path.realpath(destination):
+        return # Кадр уже в staging (повторный отбор по подготовленным файлам)
+    signature = _staging_signature(source, max_side, jpeg_quality)
+    if os.path.exists(destination) and manifest.get(name) == signature:
+        return # Уже подготовлено с теми же параметрами, исходник не менялся
+    if os.path.exists(destination):
+        os.remove(destination)
+    manifest.pop(name, None)
+    _write_staged_image(source, destination, max_side, jpeg_quality)
+    manifest[name] = signature
+
+def _write_staged_image(source: str, destination: str, max_side: Optional[int], jpeg_quality: int):
+    if max_side:
+        from PIL import Image
+        with Image.open(source) as img:
+            if max(img.size) > max_side:
+                exif = img.info.get('exif')
+                xmp = img.info.get('xmp')
+                img.draft(img.mode, (max_side, max_side))
+                resized = img.copy()
+                resized.thumbnail((max_side, max_side), Image.LANCZOS)
+                save_kwargs = {'quality': jpeg_quality} if img.format == 'JPEG' else {}
+                if exif:
+                    save_kwargs['exif'] = exif # EXIF/GPS нужны ODM для геопривязки
+                if xmp and img.format == 'JPEG':
+                    save_kwargs['xmp'] = xmp
+                resized.save(destination, format=img.format, **save_kwargs)
+                return
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def stage_images(kept: List[Dict[str, Any]], staging_dir: str, max_side: Optional[int] = None,
+                 jpeg_quality: int = 95) -> List[str]:
+    """
+    Готовит папку staging с принятыми кадрами (ее монтирует ODM вместо исходной папки).
+    Файлы, не входящие в текущий набор, удаляются из staging.
+    Файлы, подготовленные из другого исходника или с другими max_side/jpeg_quality, пересоздаются.
+
+    Returns:
+        Список путей к подготовленным изображениям.
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    manifest = _load_staging_manifest(staging_dir)
+    keep_names = {m['name'] for m in kept}
+    for fname in os.listdir(staging_dir):
+        fpath = os.path.join(staging_dir, fname)
+        if os.path.isfile(fpath) and fname not in keep_names and fname != _STAGING_MANIFEST:
+            os.remove(fpath)
+            manifest.pop(fname, None)
+    staged = []
+    try:
+        for meta in kept:
+            destination = os.path.join(staging_dir, meta['name'])
+            _stage_image(meta['path'], destination, max_side, jpeg_quality, manifest)
+            staged.append(destination)
+    finally:
+        _save_staging_manifest(staging_dir, manifest)
+    return staged
+
+def stage_image(meta: Dict[str, Any], staging_dir: str, max_side: Optional[int] = None,
+                jpeg_quality: int = 95) -> str:
+    """ Кладет один принятый кадр в staging (без удаления остальных файлов). Возвращает путь в staging. """
+    os.makedirs(staging_dir, exist_ok=True)
+    manifest = _load_staging_manifest(staging_dir)
+    destination = os.path.join(staging_dir, meta['name'])
+    try:
+        _stage_image(meta['path'], destination, max_side, jpeg_quality, manifest)
+    finally:
+        _save_staging_manifest(staging_dir, manifest)
+    return destination
+
+def summarize(input_count: int, kept: List[Dict[str, Any]], rejected: List[Dict[str, Any]]) -> Dict[str, int]:
+    """ Сводка отбора: число входных и принятых кадров и отброшенных по причинам. """
+    summary = {'input': input_count, 'kept': len(kept)}
+    for meta in rejected:
+        summary[meta['reject_reason']] = summary.get(meta['reject_reason'], 0) + 1
+    return summary
+
+def run_preingest(image_paths: List[str], staging_dir: str, workers: int = 4, blur_threshold: float = 50.0,
+                  duplicate_hash_distance: int = 4, duplicate_max_distance_m: float = 2.0,
+                  downscale_max_side: Optional[int] = None, jpeg_quality: int = 95) -> Dict[str, Any]:
+    """
+    Этап предварительной обработки снимков перед ODM.
+
+    Returns:
+        Отчет {'staging_dir', 'staged_images', 'kept', 'rejected', 'summary'}.
+    """
+    logger.info(f"Предобработка {len(image_paths)} изображений в {workers} процессах...")
+    scans = scan_images(image_paths, workers)
+    kept, rejected = select_images(scans, blur_threshold, duplicate_hash_distance, duplicate_max_distance_m)
+    staged = stage_images(kept, staging_dir, downscale_max_side, jpeg_quality)
+    summary = summarize(len(image_paths), kept, rejected)
+    logger.info(f"Предобработка завершена: {summary}. Папка для ODM: {staging_dir}")
+    return {'staging_dir': staging_dir, 'staged_images': staged, 'kept': kept, 'rejected': rejected,
+            'summary': summary}
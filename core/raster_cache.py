@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Any, Optional
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.windows import Window
+
+from core import run_cache
+
+logger = logging.getLogger(__name__)
+
+# Версия формата кэша: меняется при изменении раскладки массива/сайдкара
+_CACHE_VERSION = 1
+_SIDECAR_SUFFIX = '.json'
+_DECODE_TILE_SIZE = 1024
+
+class CachedRaster:
+    """
+    Декодированный растр в памяти-отображении (np.memmap) с интерфейсом набора данных
+    rasterio, достаточным для analysis.iter_slot_crops: transform, width, height, crs,
+    count, block_shapes, overviews и read(window=...).
+
+    Пиксели хранятся в порядке [h, w, bands]: строки вырезки слота лежат в файле подряд.
+    read() возвращает представление [bands, h, w] без копирования - данные подгружаются
+    из страничного кэша ОС при обращении.
+    """
+    def __init__(self, array_path: str, meta: Dict[str, Any]):
+        self.name = array_path
+        self.array = np.load(array_path, mmap_mode='r')
+        self.meta = meta
+        self.height, self.width, self.count = self.array.shape
+        self.transform = Affine(*meta['transform'])
+        self.crs = meta.get('crs')
+        self.block_shapes = [tuple(meta['block_shape'])] * self.count
+        self.dtypes = (str(self.array.dtype),) * self.count
+
+    def overviews(self, band: int = 1):
+        """ Факторы обзоров исходного файла (сами обзоры читаются из него, см. open_raster). """
+        return list(self.meta.get('overviews', []))
+
+    def read(self, indexes=None, window: Optional[Window] = None) -> np.ndarray:
+        if window is None:
+            view = self.array
+        else:
+            (r0, r1), (c0, c1) = window.toranges()
+            view = self.array[max(r0, 0):r1, max(c0, 0):c1]
+        view = view.transpose(2, 0, 1)
+        if indexes is None:
+            return view
+        if isinstance(indexes, int):
+            return view[indexes - 1]
+        return view[[i - 1 for i in indexes]]
+
+    def close(self):
+        self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_raster(path: str, overview_level: Optional[int] = None):
+    """
+    Открывает растр для чтения вырезок: файл кэша (.npy) - как CachedRaster, остальное - rasterio.
+
+    Уровни обзоров в кэше не хранятся: при overview_level читается исходный файл (его путь
+    записан в сайдкаре), уменьшенные уровни декодируются быстро.
+    """
+    if path.endswith('.npy'):
+        meta = _read_sidecar(path)
+        if meta is None:
+            raise rasterio.RasterioIOError(f"Decoded raster cache sidecar missing or invalid: {path}")
+        if overview_level is not None:
+            return rasterio.open(meta['source_path'], overview_level=overview_level)
+        return CachedRaster(path, meta)
+    if overview_level is not None:
+        return rasterio.open(path, overview_level=overview_level)
+    # rasterio.open(..., overview_level=None) скрывает список обзоров набора данных
+    return rasterio.open(path)
+
+def source_signature(source_path: str) -> Dict[str, Any]:
+    """ Размер и mtime исходного файла (быстрая проверка актуальности без хэширования). """
+    stat = os.stat(source_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def cache_path_for(source_path: str, cache_dir: str) -> str:
+    """ Путь файла кэша: имя исходника + хэш абсолютного пути (разные площадки не пересекаются). """
+    source_path = os.path.abspath(source_path)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    key = hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{stem}_{key}.npy")
+
+def _sidecar_path(array_path: str) -> str:
+    return os.path.splitext(array_path)[0] + _SIDECAR_SUFFIX
+
+def _read_sidecar(array_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_sidecar_path(array_path), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == _CACHE_VERSION else None
+
+def _write_sidecar(array_path: str, meta: Dict[str, Any]):
+    path = _sidecar_path(array_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, path)
+
+def is_valid(array_path: str, source_path: str) -> bool:
+    """
+    Кэш соответствует исходнику: совпадают размер и mtime, а при другом mtime (файл
+    перезаписан или скопирован заново) - SHA-256 содержимого. В последнем случае
+    сайдкар обновляется, чтобы не хэшировать файл повторно.
+    """
+    meta = _read_sidecar(array_path)
+    if meta is None or not os.path.exists(array_path) or not os.path.exists(source_path):
+        return False
+    signature = source_signature(source_path)
+    if signature['size'] != meta.get('source_size'):
+        return False
+    if signature['mtime_ns'] == meta.get('source_mtime_ns'):
+        return True
+    if run_cache.file_sha256(source_path) != meta.get('source_sha256'):
+        return False
+    meta['source_mtime_ns'] = signature['mtime_ns']
+    _write_sidecar(array_path, meta)
+    return True
+
+def decode_to_cache(source_path: str, array_path: str) -> Dict[str, Any]:
+    """
+    Декодирует растр блоками (окна кратны внутренним блокам, не больше _DECODE_TILE_SIZE)
+    в .npy [h, w, bands] и пишет сайдкар: transform, CRS, блок, обзоры, размер/mtime/SHA-256
+    исходника. Растр целиком в память не загружается. Возвращает содержимое сайдкара.
+    """
+    os.makedirs(os.path.dirname(array_path) or '.', exist_ok=True)
+    signature = source_signature(source_path)
+    # Старый сайдкар удаляется заранее: прерванная перезапись не оставит пару "новый массив - старые метаданные"
+    if os.path.exists(_sidecar_path(array_path)):
+        os.remove(_sidecar_path(array_path))
+    tmp_path = array_path + '.tmp.npy'
+    try:
+        with rasterio.open(source_path) as src:
+            block_h, block_w = (max(int(v), 1) for v in src.block_shapes[0])
+            tile_h = block_h * max(1, _DECODE_TILE_SIZE // block_h)
+            tile_w = block_w * max(1, _DECODE_TILE_SIZE // block_w)
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(src.dtypes[0]),
+                                              shape=(src.height, src.width, src.count))
+            for row in range(0, src.height, tile_h):
+                for col in range(0, src.width, tile_w):
+                    window = Window(col, row, min(tile_w, src.width - col), min(tile_h, src.height - row))
+                    array[row:row + window.height, col:col + window.width] = np.moveaxis(src.read(window=window), 0, -1)
+            array.flush()
+            del array
+            meta = {
+                'version': _CACHE_VERSION,
+                'source_path': os.path.abspath(source_path),
+                'source_size': signature['size'],
+                'source_mtime_ns': signature['mtime_ns'],
+                'source_sha256': run_cache.file_sha256(source_path),
+                'transform': list(src.transform)[:6],
+                'crs': src.crs.to_string() if src.crs else None,
+                'block_shape': [block_h, block_w],
+                'overviews': list(src.overviews(1)),
+                'nodata': src.nodata,
+            }
+        os.replace(tmp_path, array_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _write_sidecar(array_path, meta)
+    return meta
+
+def _estimated_size(source_path: str) -> int:
+    with rasterio.open(source_path) as src:
+        return src.width * src.height * src.count * np.dtype(src.dtypes[0]).itemsize
+
+def evict(cache_dir: str, max_bytes: int, keep: Optional[str] = None) -> int:
+    """
+    Удаляет самые давно использованные записи (по mtime сайдкара), пока суммарный размер
+    кэша больше max_bytes. Запись keep не удаляется. Возвращает число освобожденных байт.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npy') or name.endswith('.tmp.npy'):
+            continue
+        path = os.path.join(cache_dir, name)
+        sidecar = _sidecar_path(path)
+        try:
+            size = os.path.getsize(path)
+            last_used = os.path.getmtime(sidecar) if os.path.exists(sidecar) else 0.0
+        except OSError:
+            continue
+        entries.append((last_used, path, size))
+    total = sum(size for _, _, size in entries)
+    freed = 0
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        for victim in (path, _sidecar_path(path)):
+            if os.path.exists(victim):
+                os.remove(victim)
+        logger.info(f"Кэш растров: удалена запись {os.path.basename(path)} ({size / 1024**2:.0f} МБ).")
+        total -= size
+        freed += size
+    return freed
+
+def get_cached_raster(source_path: str, cache_dir: str, max_bytes: Optional[int] = None) -> Optional[str]:
+    """
+    Путь к актуальному декодированному кэшу растра (создается при первом обращении).
+
+    Растр, который в одиночку больше max_bytes, не кэшируется. После создания записи
+    старые записи вытесняются до max_bytes. Ошибки кэша не прерывают анализ: возвращается
+    None, и вызывающий код читает исходный файл.
+    """
+    array_path = cache_path_for(source_path, cache_dir)
+    try:
+        if is_valid(array_path, source_path):
+            # Отметка использования для вытеснения давно неиспользуемых записей
+            os.utime(_sidecar_path(array_path))
+            logger.info(f"Декодированный растр из кэша: {array_path}")
+            return array_path
+        if max_bytes is not None and _estimated_size(source_path) > max_bytes:
+            logger.warning(f"Растр '{os.path.basename(source_path)}' больше лимита кэша "
+                           f"({max_bytes / 1024**3:.1f} ГБ). Чтение без кэша.")
+            return None
+        started = time.monotonic()
+        decode_to_cache(source_path, array_path)
+        logger.info(f"Растр декодирован в кэш за {time.monotonic() - started:.1f} с: {array_path}")
+        if max_bytes is not None:
+            evict(cache_dir, max_bytes, keep=array_path)
+        return array_path
+    except (OSError, ValueError, rasterio.RasterioIOError) as e:
+        logger.warning(f"Кэш декодированного растра недоступен ({e}). Чтение исходного файла.")
+        return None
@@ -0,0 +1,368 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Корень cgroup-фс и варианты размещения cgroup контейнера Docker (v2 systemd / v2 cgroupfs / v1)
+CGROUP_ROOT = '/sys/fs/cgroup'
+_CGROUP_V2_CANDIDATES = ('system.slice/docker-{id}.scope', 'docker/{id}')
+_CGROUP_V1_CONTROLLERS = ('cpuacct', 'memory', 'blkio', 'pids')
+
+_SIZE_UNITS = {
+    'b': 1, 'kb': 1000, 'mb': 1000 ** 2, 'gb': 1000 ** 3, 'tb': 1000 ** 4,
+    'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3, 'tib': 1024 ** 4,
+}
+_SIZE_PATTERN = re.compile(r'([0-9.]+)\s*([a-zA-Z]*)')
+
+def parse_size(text: str) -> Optional[int]:
+    """ Переводит размер из вывода docker stats ('1.5GiB', '12.3MB', '0B') в байты. """
+    match = _SIZE_PATTERN.match(text.strip())
+    if not match:
+        return None
+    unit = _SIZE_UNITS.get((match.group(2) or 'b').lower())
+    return int(float(match.group(1)) * unit) if unit else None
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+        return None if value == 'max' else int(value)
+    except (OSError, ValueError):
+        return None
+
+def _read_keyed(path: str) -> Dict[str, int]:
+    """ Файл вида 'ключ значение' построчно (cpu.stat, memory.stat). """
+    values = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1].isdigit():
+                    values[parts[0]] = int(parts[1])
+    except OSError:
+        pass
+    return values
+
+def _read_keyed_colon(path: str) -> Dict[str, int]:
+    """ Файл вида 'ключ: значение' (/proc/<pid>/io). """
+    values = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if value.strip().isdigit():
+                    values[key.strip()] = int(value.strip())
+    except OSError:
+        pass
+    return values
+
+class _CgroupSource:
+    """ Счетчики cgroup контейнера (v2 или v1): процессорное время, память, блочный ввод-вывод. """
+    def __init__(self, paths: Dict[str, str], version: int):
+        self.paths = paths
+        self.version = version
+
+    @classmethod
+    def for_container(cls, container_id: str, root: str = CGROUP_ROOT) -> Optional["_CgroupSource"]:
+        for pattern in _CGROUP_V2_CANDIDATES:
+            path = os.path.join(root, pattern.format(id=container_id))
+            if os.path.exists(os.path.join(path, 'cpu.stat')):
+                return cls({c: path for c in _CGROUP_V1_CONTROLLERS}, version=2)
+        paths = {c: os.path.join(root, c, 'docker', container_id) for c in _CGROUP_V1_CONTROLLERS}
+        if os.path.isdir(paths['cpuacct']) and os.path.isdir(paths['memory']):
+            return cls(paths, version=1)
+        return None
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        if self.version == 2:
+            base = self.paths['cpuacct']
+            cpu = _read_keyed(os.path.join(base, 'cpu.stat'))
+            if 'usage_usec' not in cpu:
+                return None # cgroup удален (контейнер завершился)
+            read_bytes = write_bytes = 0
+            try:
+                with open(os.path.join(base, 'io.stat'), 'r') as f:
+                    for line in f:
+                        fields = dict(kv.split('=', 1) for kv in line.split()[1:] if '=' in kv)
+                        read_bytes += int(fields.get('rbytes', 0))
+                        write_bytes += int(fields.get('wbytes', 0))
+            except (OSError, ValueError):
+                pass
+            return {'cpu_seconds': cpu['usage_usec'] / 1e6,
+                    'mem_bytes': _read_int(os.path.join(base, 'memory.current')),
+                    'mem_limit_bytes': _read_int(os.path.join(base, 'memory.max')),
+                    'mem_peak_bytes': _read_int(os.path.join(base, 'memory.peak')),
+                    'blk_read_bytes': read_bytes, 'blk_write_bytes': write_bytes,
+                    'pids': _read_int(os.path.join(base, 'pids.current'))}
+        usage_ns = _read_int(os.path.join(self.paths['cpuacct'], 'cpuacct.usage'))
+        if usage_ns is None:
+            return None
+        read_bytes = write_bytes = 0
+        try:
+            with open(os.path.join(self.paths['blkio'], 'blkio.throttle.io_service_bytes'), 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[1] == 'Read':
+                        read_bytes += int(parts[2])
+                    elif len(parts) == 3 and parts[1] == 'Write':
+                        write_bytes += int(parts[2])
+        except (OSError, ValueError):
+            pass
+        limit = _read_int(os.path.join(self.paths['memory'], 'memory.limit_in_bytes'))
+        return {'cpu_seconds': usage_ns / 1e9,
+                'mem_bytes': _read_int(os.path.join(self.paths['memory'], 'memory.usage_in_bytes')),
+                # В v1 "без лимита" - огромное число, кратное странице
+                'mem_limit_bytes': limit if limit is not None and limit < 2 ** 60 else None,
+                'mem_peak_bytes': _read_int(os.path.join(self.paths['memory'], 'memory.max_usage_in_bytes')),
+                'blk_read_bytes': read_bytes, 'blk_write_bytes': write_bytes,
+                'pids': _read_int(os.path.join(self.paths['pids'], 'pids.current'))}
+
+class _DockerStatsSource:
+    """ Запасной источник: 'docker stats --no-stream' (если cgroup контейнера недоступна с хоста, например WSL). """
+    def __init__(self, container_name: str):
+        self.container_name = container_name
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        try:
+            result = subprocess.run(['docker', 'stats', '--no-stream', '--format', '{{json .}}', self.container_name],
+                                    capture_output=True, text=True, timeout=15)
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            return None
+        if result.returncode != 0 or not result.stdout.strip():
+            return None
+        try:
+            stats = json.loads(result.stdout.strip().splitlines()[0])
+            mem_used, _, mem_limit = stats.get('MemUsage', '').partition('/')
+            blk_read, _, blk_write = stats.get('BlockIO', '').partition('/')
+            return {'cpu_percent': float(stats.get('CPUPerc', '0').rstrip('%') or 0),
+                    'mem_bytes': parse_size(mem_used), 'mem_limit_bytes': parse_size(mem_limit),
+                    'mem_peak_bytes': None,
+                    'blk_read_bytes': parse_size(blk_read) or 0, 'blk_write_bytes': parse_size(blk_write) or 0,
+                    'pids': int(stats['PIDs']) if str(stats.get('PIDs', '')).isdigit() else None}
+        except (ValueError, KeyError, IndexError) as e:
+            logger.debug(f"Не удалось разобрать вывод docker stats: {e}")
+            return None
+
+class _ProcessTreeSource:
+    """ Нативный запуск: суммарные счетчики процесса ODM и всех его потомков по /proc (Linux). """
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self._page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def _descendants(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', 'r') as f:
+                    # Имя процесса в скобках может содержать пробелы - разбираем после ')'
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, ValueError, IndexError):
+                continue
+        tree, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            tree.append(pid)
+            stack.extend(children.get(pid, []))
+        return tree
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(f'/proc/{self.pid}'):
+            return None
+        cpu_ticks = rss_pages = read_bytes = write_bytes = 0
+        pids = 0
+        for pid in self._descendants():
+            try:
+                with open(f'/proc/{pid}/stat', 'r') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                cpu_ticks += int(fields[11]) + int(fields[12]) # utime + stime
+                with open(f'/proc/{pid}/statm', 'r') as f:
+                    rss_pages += int(f.read().split()[1])
+                pids += 1
+                io = _read_keyed_colon(f'/proc/{pid}/io')
+                read_bytes += io.get('read_bytes', 0)
+                write_bytes += io.get('write_bytes', 0)
+            except (OSError, ValueError, IndexError):
+                continue # Процесс завершился между чтениями
+        return {'cpu_seconds': cpu_ticks / float(self._ticks), 'mem_bytes': rss_pages * self._page,
+                'mem_limit_bytes': None, 'mem_peak_bytes': None,
+                'blk_read_bytes': read_bytes, 'blk_write_bytes': write_bytes, 'pids': pids}
+
+def _resolve_container_id(container_name: str) -> Optional[str]:
+    try:
+        result = subprocess.run(['docker', 'inspect', '--format', '{{.Id}}', container_name],
+                                capture_output=True, text=True, timeout=15)
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+class ResourceSampler:
+    """
+    Фоновый опрос потребления ресурсов запуска ODM: загрузка CPU (в ядрах), память,
+    блочный ввод-вывод и число процессов.
+
+    Для Docker-запуска читаются счетчики cgroup контейнера (дешево и точно), а если
+    cgroup недоступна с хоста - 'docker stats'. Для нативного запуска суммируются
+    счетчики дерева процессов из /proc. Один сэмплер ведет все попытки запуска;
+    каждая попытка начинается вызовом start() и завершается stop().
+    """
+    def __init__(self, interval_s: float = 2.0, cgroup_root: str = CGROUP_ROOT):
+        self.interval_s = max(0.1, float(interval_s))
+        self.cgroup_root = cgroup_root
+        self.samples: List[Dict[str, Any]] = []
+        self.attempt = 0
+        self.source_kind: Optional[str] = None
+        self.started: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def start(self, container_name: Optional[str] = None, pid: Optional[int] = None):
+        """ Начинает опрос контейнера container_name или дерева процессов pid. """
+        self.stop()
+        self.attempt += 1
+        if self.started is None:
+            self.started = time.time()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(container_name, pid),
+                                        name='odm-resource-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def _make_source(self, container_name: Optional[str], pid: Optional[int]):
+        if container_name:
+            container_id = _resolve_container_id(container_name)
+            if container_id is None:
+                return None # Контейнер еще не создан - повторим на следующем шаге
+            source = _CgroupSource.for_container(container_id, self.cgroup_root)
+            if source is not None:
+                self.source_kind = f'cgroup_v{source.version}'
+                return source
+            self.source_kind = 'docker_stats'
+            return _DockerStatsSource(container_name)
+        if pid is not None and os.path.isdir('/proc'):
+            self.source_kind = 'proc'
+            return _ProcessTreeSource(pid)
+        return None
+
+    def _run(self, container_name: Optional[str], pid: Optional[int]):
+        source = None
+        previous = None
+        while not self._stop_event.is_set():
+            try:
+                if source is None:
+                    source = self._make_source(container_name, pid)
+                reading = source.read() if source is not None else None
+            except Exception as e:
+                logger.debug(f"Ошибка опроса ресурсов ODM: {e}")
+                reading = None
+            if reading is not None:
+                now = time.time()
+                if 'cpu_seconds' in reading:
+                    # Загрузка CPU как доля ядра по приросту процессорного времени между опросами
+                    cpu_percent = None
+                    if previous is not None and now > previous[0]:
+                        cpu_percent = max(0.0, (reading['cpu_seconds'] - previous[1]) / (now - previous[0]) * 100.0)
+                    previous = (now, reading['cpu_seconds'])
+                    reading['cpu_percent'] = round(cpu_percent, 1) if cpu_percent is not None else None
+                self.samples.append(dict(reading, t=round(now, 3), elapsed_s=round(now - self.started, 3),
+                                         attempt=self.attempt))
+            self._stop_event.wait(self.interval_s)
+
+    def summary(self) -> Dict[str, Any]:
+        """ Сводка: средняя/пиковая загрузка CPU (ядра), пик памяти, итоговый ввод-вывод. """
+        cpu = sorted(s['cpu_percent'] for s in self.samples if s.get('cpu_percent') is not None)
+        mem = [s['mem_bytes'] for s in self.samples if s.get('mem_bytes') is not None]
+        peaks = [s['mem_peak_bytes'] for s in self.samples if s.get('mem_peak_bytes') is not None]
+        limits = [s['mem_limit_bytes'] for s in self.samples if s.get('mem_limit_bytes')]
+        # Счетчики ввода-вывода накопительные в пределах попытки - суммируем максимумы попыток
+        blk_read = blk_write = 0
+        for attempt in sorted({s['attempt'] for s in self.samples}):
+            attempt_samples = [s for s in self.samples if s['attempt'] == attempt]
+            blk_read += max(s.get('blk_read_bytes') or 0 for s in attempt_samples)
+            blk_write += max(s.get('blk_write_bytes') or 0 for s in attempt_samples)
+        return {
+            'source': self.source_kind,
+            'interval_s': self.interval_s,
+            'samples': len(self.samples),
+            'attempts': self.attempt,
+            'duration_s': round(self.samples[-1]['elapsed_s'], 3) if self.samples else 0.0,
+            'cpu_cores_avg': round(sum(cpu) / len(cpu) / 100.0, 2) if cpu else None,
+            'cpu_cores_p95': round(cpu[min(len(cpu) - 1, int(len(cpu) * 0.95))] / 100.0, 2) if cpu else None,
+            'cpu_cores_max': round(cpu[-1] / 100.0, 2) if cpu else None,
+            'mem_peak_bytes': max(mem + peaks) if mem or peaks else None,
+            'mem_limit_bytes': min(limits) if limits else None,
+            'blk_read_bytes': blk_read,
+            'blk_write_bytes': blk_write,
+            'pids_max': max((s.get('pids') or 0 for s in self.samples), default=None),
+        }
+
+    def write_timeseries(self, path: str, extra: Optional[Dict[str, Any]] = None) -> bool:
+        """ Сохраняет сводку и временной ряд опросов в JSON. """
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(dict(extra or {}, summary=self.summary(), samples=self.samples), f, indent=4, ensure_ascii=False)
+            logger.info(f"Временной ряд ресурсов ODM сохранен в: {path}")
+            return True
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить ресурсы ODM '{path}': {e}")
+            return False
+
+    def write_prometheus(self, path: str, labels: Optional[Dict[str, str]] = None,
+                         max_concurrency: Optional[int] = None) -> bool:
+        """
+        Сохраняет сводку в текстовом формате Prometheus (для node_exporter textfile collector).
+        Загрузка ядер сравнивается с max-concurrency ODM и числом ядер хоста.
+        """
+        summary = self.summary()
+        label_str = ','.join(f'{k}="{str(v)}"' for k, v in sorted((labels or {}).items()))
+        label_str = '{' + label_str + '}' if label_str else ''
+        metrics = [
+            ('odm_run_duration_seconds', 'Wall time covered by resource samples.', summary['duration_s']),
+            ('odm_run_attempts', 'Number of ODM process attempts in this run.', summary['attempts']),
+            ('odm_cpu_cores_avg', 'Average CPU cores busy.', summary['cpu_cores_avg']),
+            ('odm_cpu_cores_p95', '95th percentile of CPU cores busy.', summary['cpu_cores_p95']),
+            ('odm_cpu_cores_max', 'Maximum CPU cores busy.', summary['cpu_cores_max']),
+            ('odm_memory_peak_bytes', 'Peak memory usage.', summary['mem_peak_bytes']),
+            ('odm_memory_limit_bytes', 'Container memory limit.', summary['mem_limit_bytes']),
+            ('odm_blkio_read_bytes', 'Block device bytes read.', summary['blk_read_bytes']),
+            ('odm_blkio_write_bytes', 'Block device bytes written.', summary['blk_write_bytes']),
+            ('odm_pids_max', 'Maximum number of processes.', summary['pids_max']),
+            ('odm_max_concurrency', 'Configured ODM max-concurrency.', max_concurrency),
+            ('odm_host_cpus', 'CPU cores available on the host.', os.cpu_count()),
+        ]
+        lines = []
+        for name, help_text, value in metrics:
+            if value is None:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{label_str} {value}')
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # Запись через временный файл: textfile collector не должен видеть файл наполовину
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, path)
+            logger.info(f"Метрики ресурсов ODM (Prometheus) сохранены в: {path}")
+            return True
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить метрики Prometheus '{path}': {e}")
+            return False
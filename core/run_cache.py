@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+from core import io_utils
+
+logger = logging.getLogger(__name__)
+
+# Файл записи кэша внутри папки проекта ODM
+CACHE_RECORD_FILENAME = 'run_cache.json'
+_HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+def file_sha256(path: str) -> str:
+    """ SHA-256 содержимого файла (чтение блоками). """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_set_fingerprint(image_paths: List[str],
+                          previous_files: Optional[Dict[str, Dict[str, Any]]] = None,
+                          max_workers: int = 4) -> Dict[str, Dict[str, Any]]:
+    """
+    Отпечаток набора изображений: имя, размер и SHA-256 содержимого каждого файла.
+
+    Дайджест файла берется из previous_files без перечитывания, если имя, размер и
+    mtime не изменились; остальные файлы хэшируются параллельно в пуле потоков.
+
+    Returns:
+        Словарь {имя_файла: {'size', 'mtime_ns', 'sha256'}}.
+    """
+    previous_files = previous_files or {}
+    files: Dict[str, Dict[str, Any]] = {}
+    to_hash: List[Tuple[str, str]] = []
+    for path in image_paths:
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        prev = previous_files.get(name)
+        if prev and prev.get('size') == entry['size'] and prev.get('mtime_ns') == entry['mtime_ns'] and prev.get('sha256'):
+            entry['sha256'] = prev['sha256']
+        else:
+            to_hash.append((name, path))
+        files[name] = entry
+    if to_hash:
+        logger.info(f"Хэширование {len(to_hash)} изображений для ключа кэша ODM...")
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for (name, _), digest in zip(to_hash, executor.map(file_sha256, [p for _, p in to_hash])):
+                files[name]['sha256'] = digest
+    return files
+
+def resolve_docker_image_digest(docker_image: str) -> str:
+    """ ID локального Docker-образа ODM (sha256:...), либо имя образа, если docker недоступен. """
+    try:
+        result = subprocess.run(['docker', 'image', 'inspect', '--format', '{{.Id}}', docker_image],
+                                check=True, capture_output=True, text=True)
+        image_id = result.stdout.strip()
+        if image_id:
+            return image_id
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Не удалось получить digest образа '{docker_image}': {e}. В ключе кэша используется имя образа.")
+    return docker_image
+
+def compute_run_key(files: Dict[str, Dict[str, Any]], odm_options: Optional[Dict[str, Any]],
+                    run_method: str, docker_image: Optional[str]) -> str:
+    """ Ключ запуска ODM: хэш набора изображений, действующих опций ODM и digest образа. """
+    payload = {
+        'images': sorted((name, f['size'], f['sha256']) for name, f in files.items()),
+        'odm_options': odm_options or {},
+        'run_method': run_method,
+        'docker_image': resolve_docker_image_digest(docker_image) if run_method == 'docker' and docker_image else None,
+    }
+    canonical = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def load_cache_record(project_path: str) -> Optional[Dict[str, Any]]:
+    """ Запись кэша из папки проекта ODM или None. """
+    record_path = os.path.join(project_path, CACHE_RECORD_FILENAME)
+    if not os.path.exists(record_path):
+        return None
+    record = io_utils.load_json(record_path)
+    return record if isinstance(record, dict) else None
+
+def check_run_cache(project_path: str, image_paths: List[str], odm_options: Optional[Dict[str, Any]],
+                    run_method: str, docker_image: Optional[str]) -> Tuple[bool, str, Dict[str, Dict[str, Any]]]:
+    """
+    Проверяет, можно ли пропустить ODM: ключ совпадает с записью кэша и результаты на месте.
+
+    Returns:
+        Кортеж (попадание_в_кэш, ключ_запуска, отпечаток_изображений).
+    """
+    record = load_cache_record(project_path) or {}
+    files = image_set_fingerprint(image_paths, previous_files=record.get('files'))
+    key = compute_run_key(files, odm_options, run_method, docker_image)
+
+    if not record:
+        logger.info(f"Кэш ODM: промах (нет записи кэша в {project_path}). Ключ {key[:12]}.")
+        return False, key, files
+    if record.get('key') != key:
+        logger.info(f"Кэш ODM: промах (входные данные или опции изменились: {str(record.get('key'))[:12]} -> {key[:12]}).")
+        return False, key, files
+    ortho_path, _ = io_utils.find_odm_results(project_path)
+    if not ortho_path:
+        logger.info(f"Кэш ODM: промах (ключ {key[:12]} совпал, но ортофотоплан не найден).")
+        return False, key, files
+    logger.info(f"Кэш ODM: попадание (ключ {key[:12]}, запуск от {record.get('created', 'N/A')}). ODM будет пропущен.")
+    return True, key, files
+
+def save_run_cache(project_path: str, key: str, files: Dict[str, Dict[str, Any]]) -> bool:
+    """ Сохраняет запись кэша после успешного запуска ODM. """
+    record = {
+        'key': key,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'image_count': len(files),
+        'files': files,
+    }
+    return io_utils.save_json(record, os.path.join(project_path, CACHE_RECORD_FILENAME))
+
+def invalidate_run_cache(project_path: str):
+    """ Удаляет запись кэша перед запуском ODM, чтобы прерванный запуск не давал ложного попадания. """
+    record_path = os.path.join(project_path, CACHE_RECORD_FILENAME)
+    try:
+        if os.path.exists(record_path):
+            os.remove(record_path)
+    except OSError as e:
+        logger.warning(f"Не удалось удалить запись кэша ODM '{record_path}': {e}")
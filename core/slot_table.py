@@ -0,0 +1,229 @@
+import hashlib
+import json
+import logging
+import os
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Sequence
+
+import numpy as np
+from affine import Affine
+
+from core import io_utils, run_cache
+
+logger = logging.getLogger(__name__)
+
+# Версия формата кэша: меняется при изменении набора/смысла массивов
+_CACHE_VERSION = 1
+
+class SlotTable:
+    """
+    Разметка слотов в непрерывных массивах NumPy.
+
+    Вершины всех полигонов лежат в одном массиве coords [V, 2], слот i занимает
+    coords[offsets[i]:offsets[i + 1]] (пустой диапазон - геометрия отсутствует или
+    некорректна). Для растра, к сетке которого таблица подготовлена (to_pixel_grid),
+    хранятся пиксельные bbox [N, 4] (row_start, col_start, row_stop, col_stop; пустой bbox -
+    слот вне растра). Для совместимости таблица ведет себя как список словарей слотов
+    {'id', 'geometry'}, поэтому ее можно передавать везде, где ожидается slot_definitions.
+    """
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray, coords: np.ndarray,
+                 transform: Optional[Affine] = None, shape: Optional[Tuple[int, int]] = None,
+                 crs: Optional[str] = None, bboxes: Optional[np.ndarray] = None):
+        self.ids = ids
+        self.offsets = offsets
+        self.coords = coords
+        self.transform = transform
+        self.shape = shape
+        self.crs = crs
+        self.bboxes = bboxes
+
+    @classmethod
+    def from_slots(cls, slot_definitions: List[Dict[str, Any]]) -> "SlotTable":
+        """ Строит таблицу из списка словарей разметки (один проход). """
+        ids, counts, parts = [], [], []
+        for slot in slot_definitions:
+            ids.append(slot.get('id', 'unknown_slot'))
+            try:
+                coords = np.asarray(slot.get('geometry') or [], dtype=np.float64)
+            except (TypeError, ValueError):
+                coords = np.empty((0, 2))
+            if coords.ndim != 2 or coords.shape[0] < 3 or coords.shape[1] < 2:
+                counts.append(0)
+                continue
+            counts.append(coords.shape[0])
+            parts.append(coords[:, :2])
+        # Целочисленные id сохраняются как int64, остальные - строками (npz без pickle)
+        if ids and all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            id_array = np.asarray(ids, dtype=np.int64)
+        else:
+            id_array = np.asarray([str(i) for i in ids])
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        coords = np.concatenate(parts) if parts else np.empty((0, 2), dtype=np.float64)
+        return cls(id_array, offsets, coords)
+
+    # --- Интерфейс списка слотов ---
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return {'id': self.slot_id(index), 'geometry': self.coords[start:stop].tolist() if stop > start else None}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def slot_id(self, index: int) -> Any:
+        return self.ids[index].item()
+
+    def subset(self, indices: Sequence[int]) -> "SlotTable":
+        """ Таблица из слотов indices (в этом порядке) с сохранением подготовленных bbox. """
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = np.diff(self.offsets)[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # Индексы вершин выбранных слотов одним вызовом: начало слота + позиция внутри слота
+        vertex_index = np.repeat(self.offsets[indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return SlotTable(self.ids[indices], offsets, self.coords[vertex_index], self.transform, self.shape, self.crs,
+                         self.bboxes[indices] if self.bboxes is not None else None)
+
+    def bounds(self) -> Optional[Tuple[float, float, float, float]]:
+        """ Охват всех геометрий (в координатах таблицы) или None. """
+        if not len(self.coords):
+            return None
+        (min_x, min_y), (max_x, max_y) = self.coords.min(axis=0), self.coords.max(axis=0)
+        return float(min_x), float(min_y), float(max_x), float(max_y)
+
+    # --- Пиксельная сетка ---
+
+    def pixel_boxes(self, transform: Affine, width: int, height: int) -> np.ndarray:
+        """
+        Пиксельные bbox всех слотов [N, 4] для сетки растра (векторно; для сетки, к которой
+        таблица подготовлена, - из кэша). Слоты вне растра и без геометрии получают пустой bbox.
+        """
+        if self.bboxes is not None and self.transform == transform and self.shape == (height, width):
+            return self.bboxes
+        boxes = np.zeros((len(self), 4), dtype=np.int64)
+        counts = np.diff(self.offsets)
+        present = np.flatnonzero(counts > 0)
+        if not len(present):
+            return boxes
+        inv = ~transform
+        xs, ys = self.coords[:, 0], self.coords[:, 1]
+        cols = inv.a * xs + inv.b * ys + inv.c
+        rows = inv.d * xs + inv.e * ys + inv.f
+        starts = self.offsets[present]
+        row_start = np.maximum(np.floor(np.minimum.reduceat(rows, starts)), 0)
+        col_start = np.maximum(np.floor(np.minimum.reduceat(cols, starts)), 0)
+        row_stop = np.minimum(np.ceil(np.maximum.reduceat(rows, starts)), height)
+        col_stop = np.minimum(np.ceil(np.maximum.reduceat(cols, starts)), width)
+        inside = (row_stop > row_start) & (col_stop > col_start)
+        boxes[present[inside]] = np.stack([row_start, col_start, row_stop, col_stop], axis=1)[inside].astype(np.int64)
+        return boxes
+
+    def to_pixel_grid(self, transform: Affine, width: int, height: int, crs: Optional[str] = None,
+                      layout_crs: Optional[str] = None) -> "SlotTable":
+        """
+        Таблица в CRS растра с подготовленными пиксельными bbox. Если layout_crs задан и
+        отличается от crs, все вершины перепроецируются одним вызовом rasterio.warp.transform.
+        """
+        coords = self.coords
+        if layout_crs and crs and len(coords):
+            from rasterio.crs import CRS
+            from rasterio.warp import transform as warp_transform
+            if CRS.from_user_input(layout_crs) != CRS.from_user_input(crs):
+                xs, ys = warp_transform(layout_crs, crs, coords[:, 0], coords[:, 1])
+                coords = np.column_stack([xs, ys])
+        table = SlotTable(self.ids, self.offsets, coords, transform, (height, width), crs)
+        table.bboxes = table.pixel_boxes(transform, width, height)
+        return table
+
+    # --- Сохранение ---
+
+    def save(self, path: str):
+        """ Атомарно сохраняет таблицу в .npz (без pickle). """
+        meta = {'version': _CACHE_VERSION, 'crs': self.crs, 'shape': list(self.shape) if self.shape else None,
+                'transform': list(self.transform)[:6] if self.transform is not None else None}
+        arrays = {'ids': self.ids, 'offsets': self.offsets, 'coords': self.coords, 'meta': np.asarray(json.dumps(meta))}
+        if self.bboxes is not None:
+            arrays['bboxes'] = self.bboxes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SlotTable":
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version') != _CACHE_VERSION:
+                raise ValueError(f"Unsupported slot table cache version: {meta.get('version')}")
+            return cls(data['ids'], data['offsets'], data['coords'],
+                       transform=Affine(*meta['transform']) if meta.get('transform') else None,
+                       shape=tuple(meta['shape']) if meta.get('shape') else None, crs=meta.get('crs'),
+                       bboxes=data['bboxes'] if 'bboxes' in data.files else None)
+
+def load_slot_table(layout_path: str, orthophoto_path: Optional[str] = None, cache_dir: Optional[str] = None,
+                    layout_crs: Optional[str] = None) -> Optional[SlotTable]:
+    """
+    Загружает разметку как SlotTable, подготовленную к сетке ортофото, через кэш .npz.
+
+    Кэш двухуровневый: таблица разметки по хэшу файла (без разбора JSON при повторе) и
+    таблица в пиксельной сетке по ключу (хэш разметки, transform, размер, CRS растра,
+    CRS разметки). Без cache_dir кэш не используется.
+
+    Returns:
+        SlotTable или None, если разметка не найдена или некорректна.
+    """
+    if not os.path.isfile(layout_path):
+        logger.error(f"Файл разметки не найден: {layout_path}")
+        return None
+    layout_hash = run_cache.file_sha256(layout_path)
+    grid = None
+    if orthophoto_path:
+        import rasterio
+        with rasterio.open(orthophoto_path) as src:
+            grid = (src.transform, src.width, src.height, src.crs.to_string() if src.crs else None)
+    grid_path = layout_cache_path = None
+    if cache_dir:
+        layout_cache_path = os.path.join(cache_dir, f"slot_layout_{layout_hash[:20]}.npz")
+        if grid is not None:
+            grid_key = json.dumps([layout_hash, list(grid[0])[:6], grid[1], grid[2], grid[3], layout_crs])
+            grid_path = os.path.join(cache_dir, f"slot_table_{hashlib.sha256(grid_key.encode('utf-8')).hexdigest()[:20]}.npz")
+    table = None
+    if grid_path and os.path.exists(grid_path):
+        table = _load_cache(grid_path)
+        if table is not None:
+            logger.info(f"Разметка ({len(table)} слотов) загружена из кэша: {grid_path}")
+            return table
+    if layout_cache_path and os.path.exists(layout_cache_path):
+        table = _load_cache(layout_cache_path)
+
+    if table is None:
+        slot_definitions = io_utils.load_json(layout_path)
+        if not isinstance(slot_definitions, list):
+            logger.error(f"Файл разметки '{layout_path}' должен содержать список JSON объектов.")
+            return None
+        table = SlotTable.from_slots(slot_definitions)
+        if layout_cache_path:
+            _save_cache(table, layout_cache_path)
+    if grid is not None:
+        table = table.to_pixel_grid(grid[0], grid[1], grid[2], crs=grid[3], layout_crs=layout_crs)
+        if grid_path:
+            _save_cache(table, grid_path)
+    return table
+
+def _load_cache(path: str) -> Optional[SlotTable]:
+    try:
+        return SlotTable.load(path)
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning(f"Кэш разметки '{path}' поврежден: {e}. Пересоздание.")
+        return None
+
+def _save_cache(table: SlotTable, path: str):
+    try:
+        table.save(path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить кэш разметки '{path}': {e}")
@@ -0,0 +1,319 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Optional, Callable, Set, Tuple
+
+from core import io_utils, preingest
+
+logger = logging.getLogger(__name__)
+
+# Маска inotify: создание, запись, закрытие после записи, перемещение в папку, удаление
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+# Временные файлы копирования (rsync, браузеры, WinSCP/robocopy) не считаются снимками
+_PARTIAL_SUFFIXES = ('.part', '.partial', '.tmp', '.crdownload', '.filepart', '.!sync')
+_JPEG_TAIL_BYTES = 64 * 1024
+# JPEG без маркера конца (EOI) признается стабильным только после stable_s * этот множитель
+# (некоторые камеры дописывают данные после EOI)
+_NO_EOI_STABLE_FACTOR = 6
+
+class _InotifyWatcher:
+    """ Ожидание изменений в папке через inotify (Linux, через libc без внешних зависимостей). """
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout: float) -> bool:
+        """ Ждет событий не дольше timeout. Возвращает True, если в папке что-то изменилось. """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass # Сами события не разбираются: по любому событию папка пересканируется
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class _PollingWatcher:
+    """ Опрос по таймеру: сетевые папки и WSL (/mnt/c) не присылают событий inotify. """
+    def wait(self, timeout: float) -> bool:
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+def create_watcher(directory: str, use_inotify: bool = True):
+    """ inotify, если доступен, иначе опрос. Папка все равно пересканируется по таймеру. """
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            watcher = _InotifyWatcher(directory)
+            logger.info(f"Наблюдение за папкой '{directory}' через inotify.")
+            return watcher
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify недоступен ({e}), используется опрос папки.")
+    return _PollingWatcher()
+
+def is_candidate_image(name: str) -> bool:
+    """ Файл с расширением снимка, не скрытый и не временный файл копирования. """
+    lower = name.lower()
+    return (not name.startswith(('.', '~')) and not lower.endswith(_PARTIAL_SUFFIXES)
+            and lower.endswith(io_utils.IMAGE_FORMATS))
+
+def jpeg_has_eoi(path: str) -> bool:
+    """ JPEG начинается с SOI и содержит маркер EOI в хвосте (файл дописан до конца). """
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return False
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - _JPEG_TAIL_BYTES))
+        return b'\xff\xd9' in f.read()
+
+class StableFileTracker:
+    """
+    Отслеживает файлы папки и выдает те, чьи размер и mtime не менялись stable_s секунд.
+
+    ignored - сигнатуры (имя, размер, mtime_ns) уже обработанных файлов прошлых полетов:
+    перезаписанный файл с тем же именем получает новую сигнатуру и обрабатывается снова.
+    """
+    def __init__(self, stable_s: float = 10.0, ignored: Optional[Set[Tuple[str, int, int]]] = None):
+        self.stable_s = stable_s
+        self.ignored = set(ignored or ())
+        self.last_activity: Optional[float] = None
+        self._observed: Dict[str, Tuple[int, int, float]] = {} # имя -> (размер, mtime_ns, с какого момента)
+        self._stable: Set[str] = set()
+
+    def update(self, directory: str, now: Optional[float] = None) -> List[Tuple[str, Tuple[str, int, int]]]:
+        """ Пересканирует папку. Возвращает новые стабильные файлы: (путь, сигнатура). """
+        now = time.monotonic() if now is None else now
+        current: Dict[str, Tuple[int, int]] = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not is_candidate_image(entry.name) or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        newly_stable = []
+        for name, (size, mtime_ns) in current.items():
+            signature = (name, size, mtime_ns)
+            if signature in self.ignored:
+                continue
+            observed = self._observed.get(name)
+            if observed is None or observed[:2] != (size, mtime_ns):
+                self._observed[name] = (size, mtime_ns, now)
+                self._stable.discard(name) # Файл дописывается или заменен
+                self.last_activity = now
+                continue
+            if name in self._stable or size == 0:
+                continue
+            path = os.path.join(directory, name)
+            required = self.stable_s
+            try:
+                if name.lower().endswith(('.jpg', '.jpeg')) and not jpeg_has_eoi(path):
+                    required = self.stable_s * _NO_EOI_STABLE_FACTOR
+            except OSError:
+                continue
+            if now - observed[2] >= required:
+                self._stable.add(name)
+                newly_stable.append((path, signature))
+        for name in set(self._observed) - set(current):
+            del self._observed[name]
+            self._stable.discard(name)
+        return newly_stable
+
+    @property
+    def unstable_count(self) -> int:
+        return len(self._observed) - len(self._stable)
+
+def read_manifest(path: str) -> Optional[Set[str]]:
+    """
+    Список ожидаемых снимков полета: JSON-список имен, JSON {"images": [...]} или текст
+    (имя на строку, '#' - комментарий). Сравниваются только имена файлов. None - манифеста нет.
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        return None
+    try:
+        data = json.loads(text)
+        names = data.get('images', []) if isinstance(data, dict) else data
+    except ValueError:
+        names = [line.strip() for line in text.splitlines() if line.strip() and not line.lstrip().startswith('#')]
+    return {os.path.basename(str(n)) for n in names}
+
+class FlightIngest:
+    """
+    Инкрементальная предобработка одного полета по мере поступления снимков.
+
+    Стабильные файлы сканируются (EXIF, резкость, pHash) в пуле процессов и сразу
+    кладутся в staging, если читаемы и резкие. Отбор дубликатов (зависит от порядка
+    съемки) выполняется один раз при запуске - по уже собранным метаданным, без
+    повторного чтения файлов.
+    """
+    def __init__(self, watch_dir: str, staging_dir: str, executor: ProcessPoolExecutor,
+                 preingest_params: Dict[str, Any], stable_s: float = 10.0,
+                 ignored: Optional[Set[Tuple[str, int, int]]] = None):
+        self.watch_dir = watch_dir
+        self.staging_dir = staging_dir
+        self.executor = executor
+        self.params = preingest_params
+        self.tracker = StableFileTracker(stable_s, ignored)
+        self.scans: Dict[str, Dict[str, Any]] = {}
+        self.signatures: Set[Tuple[str, int, int]] = set()
+        self._pending: Dict[Future, Tuple[str, int, int]] = {}
+
+    def poll(self, now: Optional[float] = None):
+        """ Пересканирует папку, ставит новые стабильные файлы в пул и собирает готовые результаты. """
+        for path, signature in self.tracker.update(self.watch_dir, now):
+            self._pending[self.executor.submit(preingest.scan_image, path)] = signature
+        for future in [f for f in self._pending if f.done()]:
+            self._record(future.result(), self._pending.pop(future))
+
+    def _record(self, meta: Dict[str, Any], signature: Tuple[str, int, int]):
+        self.scans[meta['name']] = meta
+        self.signatures.add(signature)
+        blur_threshold = self.params.get('blur_threshold')
+        if meta.get('error'):
+            logger.warning(f"Снимок '{meta['name']}' не читается: {meta['error']}")
+        elif not blur_threshold or meta['blur_score'] >= blur_threshold:
+            preingest.stage_image(meta, self.staging_dir, self.params.get('downscale_max_side'),
+                                  self.params.get('jpeg_quality', 95))
+        logger.info(f"Принят снимок {meta['name']} (всего {len(self.scans)}, в ожидании {self.tracker.unstable_count})")
+
+    def ready_reason(self, quiet_period_s: Optional[float] = None, expected_count: Optional[int] = None,
+                     manifest: Optional[Set[str]] = None, min_images: int = 1,
+                     now: Optional[float] = None) -> Optional[str]:
+        """
+        Причина запуска ODM или None: все снимки манифеста обработаны, набрано expected_count
+        снимков или quiet_period_s без новых/меняющихся файлов. Если манифест есть, тишина
+        запуск не вызывает (ожидаются перечисленные в нем файлы). Файлы, копирующиеся после
+        выполнения манифеста или числа снимков, относятся к следующему полету.
+        """
+        now = time.monotonic() if now is None else now
+        if self._pending or len(self.scans) < max(1, min_images):
+            return None
+        if manifest is not None and not manifest - set(self.scans):
+            return f"все {len(manifest)} снимков манифеста получены"
+        if expected_count and len(self.scans) >= expected_count:
+            return f"получено ожидаемое число снимков ({len(self.scans)})"
+        if (manifest is None and quiet_period_s is not None and not self.tracker.unstable_count
+                and now - self.tracker.last_activity >= quiet_period_s):
+            return f"{quiet_period_s:.0f} с без новых файлов ({len(self.scans)} снимков)"
+        return None
+
+    def finalize(self) -> Dict[str, Any]:
+        """ Отбор дубликатов по собранным метаданным и итоговый staging (формат preingest.run_preingest). """
+        for future in list(self._pending):
+            self._record(future.result(), self._pending.pop(future))
+        kept, rejected = preingest.select_images(
+            list(self.scans.values()), self.params.get('blur_threshold', 50.0),
+            self.params.get('duplicate_hash_distance', 4), self.params.get('duplicate_max_distance_m', 2.0))
+        # Отброшенные дубли удаляются из staging; подготовленные при приеме файлы не перезаписываются
+        for meta in rejected:
+            path = os.path.join(self.staging_dir, meta['name'])
+            if os.path.isfile(path):
+                os.remove(path)
+        staged = []
+        for meta in kept:
+            path = os.path.join(self.staging_dir, meta['name'])
+            staged.append(path if os.path.isfile(path) else preingest.stage_image(
+                meta, self.staging_dir, self.params.get('downscale_max_side'), self.params.get('jpeg_quality', 95)))
+        summary = preingest.summarize(len(self.scans), kept, rejected)
+        logger.info(f"Предобработка полета завершена: {summary}. Папка для ODM: {self.staging_dir}")
+        return {'staging_dir': self.staging_dir, 'staged_images': staged, 'kept': kept, 'rejected': rejected,
+                'summary': summary}
+
+def watch_and_ingest(watch_dir: str, staging_base_dir: str, on_ready: Callable[[Dict[str, Any]], Any],
+                     preingest_params: Dict[str, Any], poll_interval_s: float = 5.0, use_inotify: bool = True,
+                     stable_s: float = 10.0, quiet_period_s: Optional[float] = 300.0,
+                     expected_count: Optional[int] = None, manifest_filename: Optional[str] = None,
+                     min_images: int = 5, once: bool = False, stop: Optional[Callable[[], bool]] = None):
+    """
+    Режим наблюдения: снимки предобрабатываются по мере копирования, а при выполнении
+    условия полноты (см. FlightIngest.ready_reason) вызывается on_ready(отчет).
+
+    on_ready (пайплайн полета, часы работы ODM) выполняется в отдельном потоке по одному
+    полету за раз, а цикл продолжает принимать снимки следующего полета. Каждый полет
+    получает staging-папку staging_base_dir/<flight_id> (время начала наблюдения за
+    полетом). В отчет добавляются 'flight_id', 'ready_reason', 'idle_s' - сколько прошло
+    от последнего изменения в папке до готовности, и 'last_activity' (time.monotonic()).
+    Файлы обработанного полета игнорируются. once=True - выход после первого полета
+    (по завершении его on_ready). stop - функция, по True которой прием снимков
+    прекращается (для тестов и остановки по сигналу); запущенный пайплайн дорабатывает.
+    """
+    os.makedirs(watch_dir, exist_ok=True)
+    watcher = create_watcher(watch_dir, use_inotify)
+    processed: Set[Tuple[str, int, int]] = set()
+    workers = max(1, preingest_params.get('workers', 4))
+    logger.info(f"Ожидание снимков в '{watch_dir}' (стабильность {stable_s} с, тишина {quiet_period_s} с, "
+                f"ожидаемое число {expected_count}, манифест {manifest_filename})")
+    # Один пайплайн за раз: ODM занимает все ядра, полеты ждут в очереди исполнителя
+    pipelines = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flight')
+    interrupted = False
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                flight_id = time.strftime('%Y%m%d_%H%M%S')
+                if os.path.exists(os.path.join(staging_base_dir, flight_id)):
+                    flight_id += f"_{time.monotonic_ns() % 1000000:06d}" # Два полета за одну секунду
+                ingest = FlightIngest(watch_dir, os.path.join(staging_base_dir, flight_id), executor,
+                                      preingest_params, stable_s, ignored=processed)
+                reason = None
+                while reason is None:
+                    if stop is not None and stop():
+                        return
+                    watcher.wait(poll_interval_s)
+                    ingest.poll()
+                    manifest = read_manifest(os.path.join(watch_dir, manifest_filename)) if manifest_filename else None
+                    reason = ingest.ready_reason(quiet_period_s, expected_count, manifest, min_images)
+                last_activity = ingest.tracker.last_activity
+                logger.info(f"Полет {flight_id} готов к обработке: {reason}.")
+                report = ingest.finalize()
+                report.update(flight_id=flight_id, ready_reason=reason, last_activity=last_activity,
+                              idle_s=round(time.monotonic() - last_activity, 1))
+                processed |= ingest.signatures
+                pipelines.submit(on_ready, report).add_done_callback(_log_pipeline_error)
+                if once:
+                    return
+    except BaseException:
+        interrupted = True
+        raise
+    finally:
+        watcher.close()
+        # Ожидание запущенного пайплайна; при прерывании еще не начатые полеты отменяются
+        pipelines.shutdown(wait=True, cancel_futures=interrupted)
+
+def _log_pipeline_error(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Ошибка обработки полета: {future.exception()}", exc_info=future.exception())
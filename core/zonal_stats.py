@@ -0,0 +1,187 @@
+import numpy as np
+import logging
+import os
+from typing import List, Dict, Any, Optional, Tuple
+import rasterio
+from rasterio import features
+from rasterio.windows import Window, transform as window_transform
+
+logger = logging.getLogger(__name__)
+
+def _slot_shapes(slot_definitions: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], int]]:
+    """
+    Готовит пары (GeoJSON-полигон, метка) для rasterio.features.rasterize.
+    Метка слота = его индекс в разметке + 1 (0 зарезервирован под фон).
+    """
+    shapes = []
+    for idx, slot in enumerate(slot_definitions):
+        geometry = slot.get('geometry')
+        if not geometry or len(geometry) < 3:
+            logger.warning(f"Отсутствует или некорректна геометрия для слота ID: {slot.get('id', 'unknown_slot')}")
+            continue
+        ring = [tuple(map(float, pt[:2])) for pt in geometry]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0]) # Замыкаем кольцо полигона
+        shapes.append(({'type': 'Polygon', 'coordinates': [ring]}, idx + 1))
+    return shapes
+
+def _label_extent(src, shapes: List[Tuple[Dict[str, Any], int]]) -> Tuple[Optional[Window], List[Tuple[Dict[str, Any], int]]]:
+    """
+    Окно растра, покрывающее все полигоны слотов (выровненное по внутренним блокам),
+    и список полигонов, пересекающих растр. Слоты вне растра не раздувают охват.
+    """
+    inv = ~src.transform
+    kept, boxes = [], []
+    for geom, label in shapes:
+        coords = np.asarray(geom['coordinates'][0], dtype=np.float64)
+        cols = inv.a * coords[:, 0] + inv.b * coords[:, 1] + inv.c
+        rows = inv.d * coords[:, 0] + inv.e * coords[:, 1] + inv.f
+        box = (max(int(np.floor(rows.min())), 0), max(int(np.floor(cols.min())), 0),
+               min(int(np.ceil(rows.max())), src.height), min(int(np.ceil(cols.max())), src.width))
+        if box[2] > box[0] and box[3] > box[1]:
+            kept.append((geom, label))
+            boxes.append(box)
+    if not boxes:
+        return None, kept
+    block_h, block_w = src.block_shapes[0]
+    boxes_arr = np.asarray(boxes)
+    row_start = (int(boxes_arr[:, 0].min()) // block_h) * block_h
+    col_start = (int(boxes_arr[:, 1].min()) // block_w) * block_w
+    row_stop, col_stop = int(boxes_arr[:, 2].max()), int(boxes_arr[:, 3].max())
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start), kept
+
+def _histogram_range(dtype, histogram_range: Optional[Tuple[float, float]]) -> Optional[Tuple[float, float]]:
+    """ Диапазон гистограмм: явно заданный или полный диапазон целочисленного типа растра. """
+    if histogram_range is not None:
+        return float(histogram_range[0]), float(histogram_range[1])
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(np.dtype(dtype))
+        return float(info.min), float(info.max) + 1.0
+    return None
+
+def compute_zonal_stats(
+    orthophoto_path: str,
+    slot_definitions: List[Dict[str, Any]],
+    bands: Optional[List[int]] = None,
+    histogram_bins: int = 16,
+    histogram_range: Optional[Tuple[float, float]] = None,
+    strip_rows: int = 512
+) -> List[Dict[str, Any]]:
+    """
+    Считает статистику по всем слотам за один проход по растру.
+
+    Все полигоны один раз растеризуются в целочисленный растр меток, выровненный по
+    трансформации ортофото (только в пределах охвата разметки). Затем растр читается
+    полосами по внутренним блокам, и для каждой полосы статистика всех слотов
+    накапливается векторными np.bincount по меткам. Стоимость O(пикселей охвата),
+    а не O(слотов x окно). Пиксели nodata (маска набора данных / альфа-канал)
+    не учитываются. При перекрытии полигонов пиксель относится к последнему слоту.
+
+    Args:
+        orthophoto_path: Путь к ортофотоплану.
+        slot_definitions: Список слотов с ключами 'id' и 'geometry' (координаты в CRS растра).
+        bands: Номера каналов (с 1) для статистики. По умолчанию все, кроме альфа-канала.
+        histogram_bins: Число бинов гистограммы на канал (0 - без гистограмм).
+        histogram_range: Диапазон гистограмм [min, max). По умолчанию - диапазон типа данных.
+        strip_rows: Минимальная высота полосы чтения в строках.
+
+    Returns:
+        Список словарей {'slot_id', 'pixel_count', 'mean', 'std', 'histogram'} в порядке разметки.
+        Слоты без валидных пикселей получают pixel_count=0 и пустые mean/std.
+    """
+    results: List[Dict[str, Any]] = []
+    if not slot_definitions:
+        logger.warning("Определения парковочных слотов не предоставлены. Расчет статистики невозможен.")
+        return results
+    if not os.path.exists(orthophoto_path):
+        logger.error(f"Файл ортофотоплана не найден: {orthophoto_path}. Расчет статистики невозможен.")
+        return results
+
+    shapes = _slot_shapes(slot_definitions)
+    if not shapes:
+        return results
+    n_labels = len(slot_definitions) + 1
+
+    try:
+        with rasterio.open(orthophoto_path) as src:
+            if bands is None:
+                bands = [i for i, ci in zip(src.indexes, src.colorinterp)
+                         if ci != rasterio.enums.ColorInterp.alpha]
+            extent, shapes = _label_extent(src, shapes)
+            if extent is None:
+                logger.warning("Ни один слот не попадает в охват ортофотоплана.")
+                return results
+
+            # Растр меток: минимальный целочисленный тип, вмещающий все метки
+            label_dtype = 'uint16' if n_labels <= np.iinfo(np.uint16).max else 'int32'
+            labels = features.rasterize(
+                shapes,
+                out_shape=(int(extent.height), int(extent.width)),
+                transform=window_transform(extent, src.transform),
+                fill=0,
+                dtype=label_dtype
+            )
+            logger.info(f"Растр меток слотов: {labels.shape[0]}x{labels.shape[1]} px, {len(shapes)} полигонов.")
+
+            hist_range = _histogram_range(src.dtypes[0], histogram_range) if histogram_bins > 0 else None
+            if histogram_bins > 0 and hist_range is None:
+                logger.warning("Диапазон гистограмм не задан для вещественного растра. Гистограммы не считаются.")
+
+            n_bands = len(bands)
+            counts = np.zeros(n_labels, dtype=np.int64)
+            sums = np.zeros((n_bands, n_labels), dtype=np.float64)
+            sq_sums = np.zeros((n_bands, n_labels), dtype=np.float64)
+            hists = (np.zeros((n_bands, n_labels * histogram_bins), dtype=np.int64)
+                     if hist_range is not None else None)
+
+            block_h = src.block_shapes[0][0]
+            strip_h = block_h * max(1, -(-strip_rows // block_h))
+            row0, col0 = int(extent.row_off), int(extent.col_off)
+            for strip_start in range(0, labels.shape[0], strip_h):
+                strip_stop = min(strip_start + strip_h, labels.shape[0])
+                window = Window(col0, row0 + strip_start, labels.shape[1], strip_stop - strip_start)
+                strip_labels = labels[strip_start:strip_stop].ravel()
+                valid = strip_labels > 0
+                if not valid.any():
+                    continue
+                valid &= src.dataset_mask(window=window).ravel() > 0
+                lab = strip_labels[valid].astype(np.int64)
+                counts += np.bincount(lab, minlength=n_labels)
+
+                data = src.read(bands, window=window)
+                for b in range(n_bands):
+                    values = data[b].ravel()[valid].astype(np.float64)
+                    sums[b] += np.bincount(lab, weights=values, minlength=n_labels)
+                    sq_sums[b] += np.bincount(lab, weights=values * values, minlength=n_labels)
+                    if hists is not None:
+                        lo, hi = hist_range
+                        bin_idx = np.floor((values - lo) * histogram_bins / (hi - lo)).astype(np.int64)
+                        np.clip(bin_idx, 0, histogram_bins - 1, out=bin_idx)
+                        hists[b] += np.bincount(lab * histogram_bins + bin_idx,
+                                                minlength=n_labels * histogram_bins)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+            stds = np.sqrt(np.maximum(sq_sums / counts - means * means, 0.0))
+
+        for idx, slot in enumerate(slot_definitions):
+            label = idx + 1
+            count = int(counts[label])
+            entry = {
+                'slot_id': slot.get('id', 'unknown_slot'),
+                'pixel_count': count,
+                'mean': [round(float(v), 3) for v in means[:, label]] if count else [],
+                'std': [round(float(v), 3) for v in stds[:, label]] if count else [],
+            }
+            if hists is not None:
+                entry['histogram'] = hists[:, label * histogram_bins:(label + 1) * histogram_bins].tolist()
+            results.append(entry)
+
+        logger.info(f"Статистика рассчитана для {sum(1 for r in results if r['pixel_count'])} из {len(results)} слотов.")
+
+    except rasterio.RasterioIOError as rio_e:
+        logger.error(f"Ошибка чтения ортофотоплана '{os.path.basename(orthophoto_path)}': {rio_e}")
+    except Exception as e:
+        logger.error(f"Ошибка при расчете статистики слотов: {e}", exc_info=True)
+
+    return results
@@ -1,17 +1,20 @@
 import os
+import sys
 import time
+import asyncio
+import functools
 import logging
-import numpy as np
+import argparse
 
 import json # Нужен для сохранения/загрузки результатов анализа и разметки
-import subprocess # Нужен для проверки Docker/nvidia-smi
 from typing import Optional, Dict, Any, List # Добавили импорты типов
-import shutil # Для копирования/перемещения файлов ODM
 
 # Импортируем конфигурацию и модули
 import config # Загружаем наш config.py
 # Основные рабочие модули для этого пайплайна:
-from core import io_utils, analysis, odm_runner
+# Легкие модули; numpy/rasterio (анализ, COG, предобработка) импортируются в функциях,
+# которые их используют, - справка и легкие подкоманды запускаются без них
+from core import io_utils, odm_runner, run_cache, odm_profile, job_queue, orchestrator
 # Вспомогательные функции и логгер:
 from utils import helpers
 
@@ -30,7 +33,6 @@ try:
 except Exception as log_e:
      # Используем print, так как логгер мог не инициализироваться
      print(f"FATAL: Failed to setup logging - {log_e}", file=sys.stderr)
-     import sys
      sys.exit(1) # Завершаемся, если логгер не настроен
 
 # Получаем логгер для этого модуля ПОСЛЕ настройки
@@ -38,68 +40,171 @@ logger = logging.getLogger(__name__)
 
 # --- Вспомогательные функции ---
 
-def run_analysis(orthophoto_path: str, output_dir: str) -> Optional[List[Dict[str, Any]]]:
+def run_analysis(orthophoto_path: str, output_dir: str,
+                 dsm_path: Optional[str] = None, dtm_path: Optional[str] = None,
+                 layout_path: Optional[str] = None, force: bool = False) -> Optional[List[Dict[str, Any]]]:
     """
     Запускает этап анализа парковочных мест
 
     Args:
         orthophoto_path: Абсолютный путь к итоговому ортофотоплану.
         output_dir: Абсолютный путь к папке для сохранения результатов анализа.
+        dsm_path: Абсолютный путь к DSM (нужен для режимов 'dsm' и 'fused').
+        dtm_path: Абсолютный путь к DTM (необязательно, иначе земля оценивается по DSM).
+        layout_path: Файл разметки слотов (по умолчанию - slot_filename из config).
+        force: Анализ запрошен явно (подкоманда analyze) - RUN_PARKING_ANALYSIS не проверяется.
 
     Returns:
         Список словарей с результатами анализа или None в случае ошибки/пропуска.
     """
-    if not config.RUN_PARKING_ANALYSIS:
+    if not config.RUN_PARKING_ANALYSIS and not force:
         logger.info("Анализ парковочных мест отключен в конфигурации.")
         return None # Возвращаем None, если анализ не запускался
 
     logger.info("--- Этап: Анализ парковочных мест ---")
+    from core import analysis, zonal_stats, dsm_occupancy, incremental_analysis, slot_table
     analysis_results = [] # Инициализируем пустым списком
     # Используем таймер из helpers
-    with helpers.Timer("Анализ парковочных мест"):
+    with helpers.Timer("Анализ парковочных мест") as analysis_timer:
         model = None
         slot_definitions = None
         try:
+            # Режим определения занятости: 'image' (модель), 'dsm' (высоты) или 'fused' (оба сигнала)
+            occupancy_mode = config.PARKING_ANALYSIS_PARAMS.get('occupancy_mode', 'image')
+            if occupancy_mode not in ('image', 'dsm', 'fused'):
+                raise helpers.AnalysisError(f"Unsupported occupancy mode: {occupancy_mode}")
+            confidence_threshold = config.PARKING_ANALYSIS_PARAMS.get('confidence_threshold', 0.7)
+            analysis_timer.set_attribute('occupancy_mode', occupancy_mode)
+
             # --- Загрузка модели ---
             model_dir_abs = os.path.join(config.PROJECT_ROOT, config.MODELS_DIR_REL)
             model_filename = config.PARKING_ANALYSIS_PARAMS.get('model_filename')
-            if model_filename:
+            if occupancy_mode == 'dsm':
+                logger.info("Режим анализа по DSM: модель не загружается.")
+            elif model_filename:
                 # analysis.load_parking_model должен вернуть None при ошибке
-                model = analysis.load_parking_model(model_dir_abs, model_filename)
+                with helpers.Timer("Загрузка модели", model=model_filename):
+                    model = analysis.load_parking_model(
+                        model_dir_abs, model_filename,
+                        batch_size=config.PARKING_ANALYSIS_PARAMS.get('batch_size', 32),
+                        num_threads=config.PARKING_ANALYSIS_PARAMS.get('num_threads', 4),
+                        confidence_threshold=confidence_threshold,
+                        iou_threshold=config.PARKING_ANALYSIS_PARAMS.get('iou_threshold', 0.5),
+                        input_size=config.PARKING_ANALYSIS_PARAMS.get('input_size', 320),
+                        backend=config.PARKING_ANALYSIS_PARAMS.get('backend', 'auto')
+                    )
             else:
                 logger.warning("Имя файла модели не указано в config.PARKING_ANALYSIS_PARAMS.")
 
             # --- Загрузка разметки слотов ---
             layout_dir_abs = os.path.join(config.PROJECT_ROOT, config.PARKING_LAYOUT_DIR_REL)
             slot_filename = config.PARKING_ANALYSIS_PARAMS.get('slot_filename')
+            if layout_path:
+                slot_filename = os.path.basename(layout_path)
             if slot_filename:
-                slots_path_abs = os.path.join(layout_dir_abs, slot_filename)
-                # io_utils.load_json должен вернуть None при ошибке
-                slot_definitions = io_utils.load_json(slots_path_abs)
-                if slot_definitions is not None and not isinstance(slot_definitions, list):
-                     logger.error(f"Файл разметки '{slots_path_abs}' должен содержать список JSON объектов.")
-                     slot_definitions = None # Считаем невалидным
+                slots_path_abs = layout_path or os.path.join(layout_dir_abs, slot_filename)
+                if config.PARKING_ANALYSIS_PARAMS.get('slot_table_cache'):
+                    # Массивы NumPy; пиксельные bbox для этого ортофото берутся из кэша .npz
+                    slot_definitions = slot_table.load_slot_table(
+                        slots_path_abs,
+                        orthophoto_path if os.path.exists(orthophoto_path) else None,
+                        cache_dir=os.path.join(config.PROJECT_ROOT, config.SLOT_TABLE_CACHE_DIR_REL),
+                        layout_crs=config.LAYOUT_CRS,
+                    )
+                else:
+                    # io_utils.load_json должен вернуть None при ошибке
+                    slot_definitions = io_utils.load_json(slots_path_abs)
+                    if slot_definitions is not None and not isinstance(slot_definitions, list):
+                         logger.error(f"Файл разметки '{slots_path_abs}' должен содержать список JSON объектов.")
+                         slot_definitions = None # Считаем невалидным
+                if slot_definitions:
+                    analysis_timer.set_attribute('slot_count', len(slot_definitions))
             else:
                 logger.warning("Имя файла разметки слотов не указано в config.PARKING_ANALYSIS_PARAMS.")
 
             # --- Выполнение анализа ---
-            if model and slot_definitions and os.path.exists(orthophoto_path):
-                logger.info("Запуск основного алгоритма анализа...")
-                # В analysis.py нужно реализовать логику анализа
-                # Эта функция должна вернуть список или None/пустой список при ошибке
-                analysis_results = analysis.analyze_parking_slots(
-                    orthophoto_path=orthophoto_path,
-                    model=model,
-                    slot_definitions=slot_definitions,
-                    confidence_threshold=config.PARKING_ANALYSIS_PARAMS.get('confidence_threshold', 0.7)
-                    # Можно передать и другие параметры из PARKING_ANALYSIS_PARAMS
-                )
-                if analysis_results is None: analysis_results = [] # Гарантируем список
-                logger.info(f"Анализ завершен. Определен статус для {len(analysis_results)} слотов.")
-            elif not os.path.exists(orthophoto_path):
-                 logger.error(f"Ортофотоплан не найден для анализа: {orthophoto_path}")
-            else:
-                logger.warning("Пропуск анализа парковок: модель или разметка слотов не загружены/не найдены.")
+            image_results = None
+            if occupancy_mode != 'dsm':
+                if model and slot_definitions and os.path.exists(orthophoto_path):
+                    logger.info("Запуск основного алгоритма анализа...")
+                    cascade_params = None
+                    if config.PARKING_ANALYSIS_PARAMS.get('cascade'):
+                        cascade_params = {
+                            'overview_factor': config.PARKING_ANALYSIS_PARAMS.get('cascade_overview_factor', 4),
+                            'uncertainty_band': tuple(config.PARKING_ANALYSIS_PARAMS.get('cascade_uncertainty_band', (0.2, 0.8))),
+                            'min_slot_px': config.PARKING_ANALYSIS_PARAMS.get('cascade_min_slot_px', 12),
+                        }
+                    decoded_cache_params = None
+                    if config.PARKING_ANALYSIS_PARAMS.get('decoded_cache'):
+                        # Повторные анализы того же ортофото читают вырезки из декодированного .npy
+                        decoded_cache_params = {
+                            'cache_dir': os.path.join(config.PROJECT_ROOT, config.DECODED_RASTER_CACHE_DIR_REL),
+                            'max_bytes': int(config.PARKING_ANALYSIS_PARAMS.get('decoded_cache_max_gb', 20) * 1024**3),
+                        }
+                    analysis_stats: Dict[str, Any] = {}
+                    analyze_function = analysis.analyze_parking_slots
+                    incremental_kwargs = {}
+                    if config.PARKING_ANALYSIS_PARAMS.get('incremental'):
+                        # Повторный полет той же площадки: модель только для изменившихся слотов.
+                        # Отпечатки общие для всех полетов с этой разметкой (корневая папка вывода)
+                        analyze_function = incremental_analysis.analyze_parking_slots_incremental
+                        incremental_kwargs = {
+                            'state_path': os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL,
+                                                       os.path.splitext(slot_filename)[0] + config.SLOT_FINGERPRINTS_SUFFIX),
+                            'change_threshold': config.PARKING_ANALYSIS_PARAMS.get('incremental_change_threshold', 0.08),
+                            'fingerprint_size': config.PARKING_ANALYSIS_PARAMS.get('incremental_fingerprint_size', 8),
+                            'max_reuse': config.PARKING_ANALYSIS_PARAMS.get('incremental_max_reuse', 5),
+                        }
+                    # В analysis.py нужно реализовать логику анализа
+                    # Эта функция должна вернуть список или None/пустой список при ошибке
+                    image_results = analyze_function(
+                        orthophoto_path=orthophoto_path,
+                        model=model,
+                        slot_definitions=slot_definitions,
+                        confidence_threshold=confidence_threshold,
+                        read_block_size=config.PARKING_ANALYSIS_PARAMS.get('read_block_size', 512),
+                        prefetch_batches=config.PARKING_ANALYSIS_PARAMS.get('prefetch_batches', 2),
+                        num_workers=config.ANALYSIS_NUM_WORKERS,
+                        tile_size=config.ANALYSIS_TILE_SIZE,
+                        cascade_params=cascade_params,
+                        stats=analysis_stats,
+                        decoded_cache_params=decoded_cache_params,
+                        **incremental_kwargs
+                        # Можно передать и другие параметры из PARKING_ANALYSIS_PARAMS
+                    )
+                    # Слоты по уровням каскада и перенесенные/пересчитанные слоты - в профиль
+                    for key, value in analysis_stats.items():
+                        analysis_timer.set_attribute(key, value)
+                    if image_results is None: image_results = [] # Гарантируем список
+                elif not os.path.exists(orthophoto_path):
+                     logger.error(f"Ортофотоплан не найден для анализа: {orthophoto_path}")
+                else:
+                    logger.warning("Пропуск анализа парковок: модель или разметка слотов не загружены/не найдены.")
+
+            dsm_results = None
+            if occupancy_mode != 'image':
+                if slot_definitions and dsm_path and os.path.exists(dsm_path):
+                    with helpers.Timer("Анализ занятости по DSM"):
+                        dsm_results = dsm_occupancy.analyze_parking_slots_dsm(
+                            dsm_path=dsm_path,
+                            slot_definitions=slot_definitions,
+                            confidence_threshold=confidence_threshold,
+                            dtm_path=dtm_path,
+                            min_vehicle_height=config.PARKING_ANALYSIS_PARAMS.get('dsm_min_vehicle_height', 1.0),
+                            max_vehicle_height=config.PARKING_ANALYSIS_PARAMS.get('dsm_max_vehicle_height', 4.0),
+                            ground_margin=config.PARKING_ANALYSIS_PARAMS.get('dsm_ground_margin', 3.0),
+                            read_block_size=config.PARKING_ANALYSIS_PARAMS.get('read_block_size', 512)
+                        )
+                else:
+                    logger.warning("Пропуск анализа по DSM: DSM или разметка слотов не найдены.")
+
+            if occupancy_mode == 'fused' and image_results is not None and dsm_results is not None:
+                analysis_results = dsm_occupancy.fuse_occupancy(image_results, dsm_results, confidence_threshold)
+            elif image_results is not None:
+                analysis_results = image_results
+            elif dsm_results is not None:
+                analysis_results = dsm_results
+            logger.info(f"Анализ завершен (режим: {occupancy_mode}). Определен статус для {len(analysis_results)} слотов.")
 
             # --- Сохранение результатов анализа ---
             if analysis_results: # Сохраняем, даже если пустой список (но анализ запускался)
@@ -107,6 +212,19 @@ def run_analysis(orthophoto_path: str, output_dir: str) -> Optional[List[Dict[st
                 results_path_abs = os.path.join(output_dir, config.ANALYSIS_RESULTS_FILENAME)
                 io_utils.save_json(analysis_results, results_path_abs)
 
+            # --- Статистика по слотам (один проход по растру) ---
+            if config.PARKING_ANALYSIS_PARAMS.get('zonal_stats') and slot_definitions and os.path.exists(orthophoto_path):
+                with helpers.Timer("Статистика по слотам", slot_count=len(slot_definitions)):
+                    slot_stats = zonal_stats.compute_zonal_stats(
+                        orthophoto_path=orthophoto_path,
+                        slot_definitions=slot_definitions,
+                        histogram_bins=config.PARKING_ANALYSIS_PARAMS.get('histogram_bins', 16),
+                        strip_rows=config.PARKING_ANALYSIS_PARAMS.get('read_block_size', 512)
+                    )
+                if slot_stats:
+                    stats_path_abs = os.path.join(output_dir, config.ZONAL_STATS_FILENAME)
+                    io_utils.save_json(slot_stats, stats_path_abs)
+
         except KeyError as ke:
              logger.error(f"Отсутствует необходимый параметр в config.PARKING_ANALYSIS_PARAMS: {ke}")
         except helpers.AnalysisError as ae: # Ловим специфичное исключение анализа
@@ -116,6 +234,27 @@ def run_analysis(orthophoto_path: str, output_dir: str) -> Optional[List[Dict[st
 
     return analysis_results # Возвращаем результаты (может быть пустым списком или None)
 
+def log_odm_progress(event: Dict[str, Any]):
+    """ Обработчик прогресса ODM: пишет в лог смену стадий с их порядковым номером и счетчиками. """
+    if event['event'] == 'stage_start':
+        position = f" ({event['stage_index']}/{event['stage_count']})" if event.get('stage_index') else ""
+        logger.info(f"[ODM progress] Стадия '{event['stage']}'{position}, прошло {helpers.format_time(event['elapsed_s'])}")
+    elif event['event'] == 'stage_end' and event['counters']:
+        logger.info(f"[ODM progress] Стадия '{event['stage']}' завершена: {event['counters']}")
+
+def record_odm_history(profile: Optional[Dict[str, Any]], success: bool, started: float, output_dir: str):
+    """ Записывает итог запуска ODM (время, пик памяти) в историю для автоподбора опций. """
+    if profile is None:
+        return
+    resource_summary = None
+    metrics_path = os.path.join(output_dir, config.ODM_RESOURCE_METRICS_FILENAME)
+    if config.ODM_RESOURCE_SAMPLING and os.path.exists(metrics_path):
+        resource_summary = (io_utils.load_json(metrics_path) or {}).get('summary')
+    # История общая для всех полетов - лежит в корневой папке вывода
+    history_path = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL, config.ODM_RUN_HISTORY_FILENAME)
+    odm_profile.record_run(history_path, profile, success,
+                           time.time() - started, resource_summary)
+
 def generate_report(stats: dict, output_dir: str):
     """
     (Опционально) Генерирует текстовый отчет с использованием LLM.
@@ -183,10 +322,165 @@ def generate_report(stats: dict, output_dir: str):
              logger.error(f"Ошибка при генерации отчета LLM: {llm_e}", exc_info=True)
 
 
+def export_orthophoto(source_path: str, destination_path: str) -> str:
+    """
+    Публикует ортофото ODM в папке вывода: COG (тайлы, сжатие, обзоры) или, если конвертация
+    отключена, жесткая ссылка/reflink без копирования данных.
+
+    Returns:
+        Путь для анализа (исходный путь ODM, если экспорт не удался).
+    """
+    if os.path.abspath(source_path) == os.path.abspath(destination_path):
+        return source_path
+    from core import cog
+    try:
+        if config.ORTHO_COG_ENABLED:
+            # COG актуален, если записан после ортофото ODM (повторный запуск с кэшем ODM)
+            if (os.path.exists(destination_path) and os.path.getmtime(destination_path) >= os.path.getmtime(source_path)
+                    and cog.is_cog(destination_path)):
+                logger.info(f"Ортофотоплан COG актуален: {destination_path}")
+                return destination_path
+            with helpers.Timer("Конвертация ортофотоплана в COG"):
+                cog.write_cog(source_path, destination_path, **config.ORTHO_COG_PARAMS)
+            logger.info(f"Ортофотоплан COG сохранен: {destination_path}")
+            return destination_path
+        if cog.link_file(source_path, destination_path):
+            logger.info(f"Ортофотоплан связан (без копирования): {destination_path}")
+            return destination_path
+        logger.info(f"Ссылка на ортофотоплан невозможна (другая файловая система). "
+                    f"Анализ использует исходный путь ODM: {source_path}")
+    except Exception as export_e:
+        logger.warning(f"Не удалось экспортировать ортофотоплан: {export_e}. "
+                       f"Анализ будет использовать исходный путь ODM: {source_path}")
+    return source_path
+
+def prepare_odm_outputs(odm_project_path: str, output_dir: str) -> Dict[str, Optional[str]]:
+    """
+    Находит результаты ODM в папке проекта и готовит ортофото для анализа в папке вывода.
+
+    Returns:
+        Словарь {'ortho_path', 'dsm_path', 'dtm_path', 'analysis_ortho_path'} (None - не найдено).
+    """
+    logger.info(f"Поиск результатов ODM в папке: {odm_project_path}")
+    # Ищем результаты в папке, которую должен был создать ODM
+    orthophoto_path_odm, dsm_path_odm = io_utils.find_odm_results(odm_project_path)
+    dtm_path_odm = io_utils.find_odm_dtm(odm_project_path)
+
+    # Путь к ортофото для передачи в анализ (может быть None)
+    final_ortho_path_for_analysis = None
+
+    if orthophoto_path_odm:
+         final_ortho_path_for_analysis = export_orthophoto(orthophoto_path_odm,
+                                                           os.path.join(output_dir, config.ORTHO_OUTPUT_FILENAME))
+    else:
+         logger.error("Не удалось найти итоговый ортофотоплан ODM. Анализ парковок невозможен.")
+    return {'ortho_path': orthophoto_path_odm, 'dsm_path': dsm_path_odm, 'dtm_path': dtm_path_odm,
+            'analysis_ortho_path': final_ortho_path_for_analysis}
+
 # --- Основной Пайплайн ---
 
-def main_pipeline():
-    """ Основной пайплайн обработки. """
+def prepare_odm_inputs(input_images: List[str], input_dir_abs: str, staging_dir_abs: str, output_dir_abs: str,
+                       odm_options: Optional[Dict[str, Any]] = None,
+                       preingest_report: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Подготовка снимков и опций полета к ODM - общая для main_pipeline и конвейера полетов:
+    предобработка (PREINGEST_ENABLED или готовый preingest_report), отбор снимков по
+    области интереса (ROI_FILTER_ENABLED) и подбор опций ODM (ODM_AUTOTUNE_ENABLED).
+    Отчеты этапов сохраняются в output_dir_abs.
+
+    Returns:
+        {'images', 'image_dir', 'odm_options', 'profile', 'stats'} или None, если снимков для ODM нет.
+    """
+    from core import preingest, footprint_index
+    project_root_abs = config.PROJECT_ROOT
+    stats: Dict[str, Any] = {}
+
+    # --- Предобработка снимков (EXIF, резкость, дубликаты, уменьшение) ---
+    odm_image_dir_abs = input_dir_abs
+    if preingest_report is None and config.PREINGEST_ENABLED:
+        try:
+            with helpers.Timer("Предобработка изображений"):
+                preingest_report = preingest.run_preingest(input_images, staging_dir_abs, **config.PREINGEST_PARAMS)
+        except Exception as pre_e:
+            logger.fatal(f"Ошибка предобработки изображений: {pre_e}", exc_info=True)
+            return None
+    if preingest_report is not None:
+        staging_dir_abs = preingest_report['staging_dir']
+        io_utils.save_json(preingest_report, os.path.join(output_dir_abs, config.PREINGEST_REPORT_FILENAME))
+        stats["preingest"] = preingest_report['summary']
+        input_images = preingest_report['staged_images']
+        odm_image_dir_abs = staging_dir_abs
+        stats["image_count"] = len(input_images)
+        if not input_images:
+            logger.fatal("После предобработки не осталось изображений для ODM. Завершение работы.")
+            return None
+
+    # --- Отбор снимков, покрывающих разметку парковки ---
+    if config.ROI_FILTER_ENABLED:
+        roi_params = dict(config.ROI_FILTER_PARAMS)
+        layout_path_abs = os.path.join(project_root_abs, config.PARKING_LAYOUT_DIR_REL,
+                                       config.PARKING_ANALYSIS_PARAMS.get('slot_filename', ''))
+        slot_definitions_roi = io_utils.load_json(layout_path_abs) if os.path.isfile(layout_path_abs) else None
+        roi = footprint_index.layout_bounds(slot_definitions_roi) if isinstance(slot_definitions_roi, list) else None
+        if roi is None:
+            logger.warning(f"Разметка '{layout_path_abs}' не найдена или пуста. Отбор по области интереса пропущен.")
+        else:
+            try:
+                with helpers.Timer("Отбор снимков по области интереса"):
+                    if preingest_report is not None:
+                        # Метаданные уже прочитаны предобработкой; пути указывают на staging
+                        metas = [dict(m, path=os.path.join(odm_image_dir_abs, m['name']))
+                                 for m in preingest_report['kept']]
+                    else:
+                        metas = footprint_index.read_metadata(input_images)
+                    selected = footprint_index.select_images_for_roi(metas, roi, config.LAYOUT_CRS,
+                                                                     **roi_params)
+                    if len(selected) < len(metas):
+                        input_images = preingest.stage_images(selected, staging_dir_abs)
+                        odm_image_dir_abs = staging_dir_abs
+                        stats["image_count"] = len(input_images)
+                stats["roi_selected_images"] = len(selected)
+            except Exception as roi_e:
+                logger.error(f"Ошибка отбора снимков по области интереса: {roi_e}. Используются все снимки.", exc_info=True)
+
+    # --- Подбор опций ODM под бюджет времени и памяти ---
+    odm_options = dict(odm_options if odm_options is not None else config.ODM_OPTIONS)
+    selected_profile = None
+    if config.ODM_AUTOTUNE_ENABLED:
+        try:
+            with helpers.Timer("Подбор опций ODM"):
+                selected_profile = odm_profile.select_odm_options(
+                    odm_options, input_images,
+                    history_path=os.path.join(project_root_abs, config.OUTPUT_DIR_REL, config.ODM_RUN_HISTORY_FILENAME),
+                    **config.ODM_AUTOTUNE_PARAMS
+                )
+            odm_options = selected_profile['options']
+            io_utils.save_json(selected_profile, os.path.join(output_dir_abs, config.ODM_PROFILE_FILENAME))
+            stats["odm_profile_changes"] = selected_profile['changes']
+        except Exception as tune_e:
+            logger.error(f"Ошибка автоподбора опций ODM: {tune_e}. Используются опции из config.", exc_info=True)
+
+    return {'images': input_images, 'image_dir': odm_image_dir_abs, 'odm_options': odm_options,
+            'profile': selected_profile, 'stats': stats}
+
+def main_pipeline(input_dir_abs: Optional[str] = None, project_name: Optional[str] = None,
+                  results_dir_abs: Optional[str] = None, staging_dir_abs: Optional[str] = None,
+                  odm_options: Optional[Dict[str, Any]] = None, analyze: bool = True,
+                  preingest_report: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Основной пайплайн обработки одного полета.
+
+    Без аргументов обрабатывает папку и проект из config. Очередь заданий передает свои
+    значения: проект ODM создается в OUTPUT_DIR_REL/project_name, результаты анализа пишутся
+    в results_dir_abs, staging - в staging_dir_abs, опции ODM берутся из odm_options.
+    analyze=False останавливает пайплайн после подготовки результатов ODM (подкоманда odm).
+    preingest_report - готовый отчет предобработки (снимки уже отобраны и лежат в staging,
+    например, режимом наблюдения за папкой); повторное сканирование не выполняется.
+
+    Returns:
+        Статистика пайплайна или None, если пайплайн прерван до завершения.
+    """
+    project_name = project_name or config.ODM_PROJECT_NAME
     global_start_time = time.time()
     logger.info("=" * 60)
     logger.info("=== ЗАПУСК ПАЙПЛАЙНА СОЗДАНИЯ ОРТОФОТОПЛАНА (ODM) И АНАЛИЗА ===")
@@ -197,12 +491,13 @@ def main_pipeline():
         # Абсолютный путь к корневой папке проекта
         project_root_abs = config.PROJECT_ROOT
         # Абсолютный путь к папке с входными изображениями (например, project_root/images)
-        input_dir_abs = os.path.join(project_root_abs, config.INPUT_IMAGE_DIR_REL)
-        # Абсолютный путь к папке для вывода результатов анализа и логов (например, project_root/data/output)
-        output_analysis_dir_abs = os.path.join(project_root_abs, config.OUTPUT_DIR_REL)
+        input_dir_abs = input_dir_abs or os.path.join(project_root_abs, config.INPUT_IMAGE_DIR_REL)
+        # Путь к папке, ГДЕ ODM создаст папку проекта (например, project_root/data/output)
+        odm_output_base_dir_on_host = os.path.join(project_root_abs, config.OUTPUT_DIR_REL)
+        # Абсолютный путь к папке для вывода результатов анализа и логов
+        output_analysis_dir_abs = results_dir_abs or odm_output_base_dir_on_host
         os.makedirs(output_analysis_dir_abs, exist_ok=True) # Создаем папку вывода анализа/логов
-        # Путь к папке, ГДЕ ODM создаст папку проекта (в соответствии с простым вариантом README ODM - это корень проекта)
-        odm_output_base_dir_on_host = project_root_abs
+        staging_dir_abs = staging_dir_abs or os.path.join(project_root_abs, config.STAGING_DIR_REL)
     except AttributeError as attr_e:
          logger.fatal(f"Ошибка доступа к настройкам путей в config.py: {attr_e}. Убедитесь, что переменные определены.")
          return
@@ -220,23 +515,71 @@ def main_pipeline():
         logger.fatal(f"Входные изображения не найдены в '{input_dir_abs}'. Завершение работы.")
         return
 
+    # --- Шаг 0: Предобработка, отбор по области интереса, подбор опций ODM ---
+    prepared = prepare_odm_inputs(input_images, input_dir_abs, staging_dir_abs, output_analysis_dir_abs,
+                                  odm_options, preingest_report)
+    if prepared is None:
+        return
+    pipeline_stats.update(prepared['stats'])
+    input_images, odm_image_dir_abs = prepared['images'], prepared['image_dir']
+    odm_options, selected_profile = prepared['odm_options'], prepared['profile']
+
     # --- Шаг 1: Запуск ODM ---
     # Папка, которую создаст ODM внутри odm_output_base_dir_on_host
-    odm_project_output_path_on_host = os.path.join(odm_output_base_dir_on_host, config.ODM_PROJECT_NAME)
+    odm_project_output_path_on_host = os.path.join(odm_output_base_dir_on_host, project_name)
     odm_success = False
+    odm_cache_hit = False
+    run_key, run_files = None, None
+    if config.ODM_RUN_CACHE:
+        try:
+            with helpers.Timer("Проверка кэша ODM"):
+                odm_cache_hit, run_key, run_files = run_cache.check_run_cache(
+                    odm_project_output_path_on_host, input_images, odm_options,
+                    config.ODM_RUN_METHOD, config.ODM_DOCKER_IMAGE
+                )
+        except OSError as cache_e:
+            logger.warning(f"Не удалось проверить кэш ODM: {cache_e}. ODM будет запущен.")
+    pipeline_stats["odm_cache_hit"] = odm_cache_hit
+    odm_started = time.time()
     try:
-        with helpers.Timer("Выполнение OpenDroneMap"):
-            odm_success = odm_runner.run_odm(
-                image_dir_abs=input_dir_abs,
-                output_base_dir_abs=output_analysis_dir_abs,
-                project_name=config.ODM_PROJECT_NAME,
-                odm_options=config.ODM_OPTIONS,
-                run_method=config.ODM_RUN_METHOD,
-                docker_image=config.ODM_DOCKER_IMAGE
-                # image_dir_abs и output_base_dir_abs больше не нужны как аргументы для этой версии run_odm
-            )
+        if odm_cache_hit:
+            odm_success = True
+        else:
+            if run_key:
+                run_cache.invalidate_run_cache(odm_project_output_path_on_host)
+            # Большие полеты можно считать подмоделями параллельно (результаты объединяются в те же пути)
+            odm_run_function = odm_runner.run_odm
+            odm_split_kwargs = {}
+            if config.ODM_SPLIT_ENABLED:
+                odm_run_function = odm_runner.run_odm_split
+                odm_split_kwargs = config.ODM_SPLIT_PARAMS
+            with helpers.Timer("Выполнение OpenDroneMap", image_count=len(input_images),
+                               split_merge=config.ODM_SPLIT_ENABLED):
+                odm_success = odm_run_function(
+                    image_dir_abs=odm_image_dir_abs,
+                    output_base_dir_abs=odm_output_base_dir_on_host,
+                    project_name=project_name,
+                    odm_options=odm_options,
+                    run_method=config.ODM_RUN_METHOD,
+                    docker_image=config.ODM_DOCKER_IMAGE,
+                    max_retries=config.ODM_MAX_RETRIES,
+                    resume=config.ODM_RESUME,
+                    metrics_path=os.path.join(output_analysis_dir_abs, config.ODM_METRICS_FILENAME),
+                    progress_callback=log_odm_progress,
+                    resource_metrics_path=(os.path.join(output_analysis_dir_abs, config.ODM_RESOURCE_METRICS_FILENAME)
+                                           if config.ODM_RESOURCE_SAMPLING else None),
+                    resource_prom_path=(os.path.join(output_analysis_dir_abs, config.ODM_RESOURCE_PROM_FILENAME)
+                                        if config.ODM_RESOURCE_SAMPLING else None),
+                    resource_sample_interval_s=config.ODM_RESOURCE_SAMPLE_INTERVAL_S,
+                    **odm_split_kwargs
+                    # image_dir_abs и output_base_dir_abs больше не нужны как аргументы для этой версии run_odm
+                )
+            record_odm_history(selected_profile, odm_success, odm_started, output_analysis_dir_abs)
+            if odm_success and run_key:
+                run_cache.save_run_cache(odm_project_output_path_on_host, run_key, run_files)
     except helpers.OdmError as odm_e:
          logger.fatal(f"Критическая ошибка ODM: {odm_e}")
+         record_odm_history(selected_profile, False, odm_started, output_analysis_dir_abs)
          return # Завершаем пайплайн
     except Exception as e:
          logger.fatal(f"Непредвиденная ошибка при запуске ODM: {e}", exc_info=True)
@@ -247,40 +590,26 @@ def main_pipeline():
         return
 
     # --- Шаг 2: Поиск результатов ODM ---
-    logger.info(f"Поиск результатов ODM в папке: {odm_project_output_path_on_host}")
-    # Ищем результаты в папке, которую должен был создать ODM
-    orthophoto_path_odm, dsm_path_odm = io_utils.find_odm_results(odm_project_output_path_on_host)
+    odm_outputs = prepare_odm_outputs(odm_project_output_path_on_host, output_analysis_dir_abs)
+    orthophoto_path_odm = odm_outputs['ortho_path']
+    dsm_path_odm, dtm_path_odm = odm_outputs['dsm_path'], odm_outputs['dtm_path']
+    final_ortho_path_for_analysis = odm_outputs['analysis_ortho_path']
 
     pipeline_stats["ortho_found"] = bool(orthophoto_path_odm)
     pipeline_stats["dsm_found"] = bool(dsm_path_odm)
-    pipeline_stats["odm_resolution"] = config.ODM_OPTIONS.get("orthophoto-resolution", "N/A")
-
-    # Путь к ортофото для передачи в анализ (может быть None)
-    final_ortho_path_for_analysis = None
-
-    if orthophoto_path_odm:
-         # Опционально: Копируем ортофото в папку output_analysis_dir_abs для удобства
-         try:
-             # Формируем имя файла в папке вывода анализа
-             final_ortho_filename = config.OUTPUT_FILENAME + ".tif"
-             destination_path = os.path.join(output_analysis_dir_abs, final_ortho_filename)
-             logger.info(f"Копирование ортофотоплана из '{orthophoto_path_odm}' в '{destination_path}'...")
-             shutil.copyfile(orthophoto_path_odm, destination_path)
-             logger.info(f"Ортофотоплан скопирован успешно.")
-             final_ortho_path_for_analysis = destination_path # Используем скопированный путь
-         except Exception as copy_e:
-              logger.warning(f"Не удалось скопировать ортофотоплан: {copy_e}. "
-                             f"Анализ будет использовать исходный путь ODM: {orthophoto_path_odm}")
-              final_ortho_path_for_analysis = orthophoto_path_odm # Используем исходный путь
-    else:
-         logger.error("Не удалось найти итоговый ортофотоплан ODM. Анализ парковок невозможен.")
-
+    pipeline_stats["dsm_path"] = dsm_path_odm
+    pipeline_stats["odm_resolution"] = odm_options.get("orthophoto-resolution", "N/A")
 
     # --- Шаг 3: Анализ парковочных мест ---
     analysis_results = None
-    if final_ortho_path_for_analysis and os.path.exists(final_ortho_path_for_analysis):
+    if not analyze:
+         logger.info("Анализ и отчет пропущены: запрошен только ODM.")
+         pipeline_stats["analysis_run"] = False
+         pipeline_stats["analysis_results"] = None
+    elif final_ortho_path_for_analysis and os.path.exists(final_ortho_path_for_analysis):
         # Запускаем анализ, передаем папку для сохранения JSON результатов
-        analysis_results = run_analysis(final_ortho_path_for_analysis, output_analysis_dir_abs)
+        analysis_results = run_analysis(final_ortho_path_for_analysis, output_analysis_dir_abs,
+                                        dsm_path=dsm_path_odm, dtm_path=dtm_path_odm)
         pipeline_stats["analysis_run"] = True
         pipeline_stats["analysis_results"] = analysis_results if analysis_results is not None else []
     else:
@@ -296,50 +625,429 @@ def main_pipeline():
 
     # --- Шаг 4: Генерация отчета (Опционально) ---
     # Передаем папку для сохранения текстового отчета
-    generate_report(pipeline_stats, output_analysis_dir_abs)
+    if analyze:
+        generate_report(pipeline_stats, output_analysis_dir_abs)
 
     logger.info("=" * 60)
     logger.info(f"=== ПАЙПЛАЙН ЗАВЕРШЕН за {helpers.format_time(total_time)} ===")
     logger.info(f"Результаты ODM находятся в: {odm_project_output_path_on_host}")
     logger.info(f"Результаты анализа и логи находятся в: {output_analysis_dir_abs}")
     logger.info("=" * 60)
+    return pipeline_stats
 
 
-# --- Точка входа ---
-if __name__ == "__main__":
+# --- Очередь полетов ---
+
+def submit_flight(queue: job_queue.JobQueue, image_dir_abs: str, project_name: Optional[str] = None,
+                  priority: int = 0) -> int:
+    """
+    Ставит полет в очередь. Ресурсы задания: ядра - max-concurrency ODM, память - оценка
+    odm_profile по числу и разрешению снимков (не меньше JOB_DEFAULT_MEMORY_GB).
+    """
+    odm_options = dict(config.ODM_OPTIONS)
+    cores = int(odm_options.get('max-concurrency') or 1)
+    memory_gb = config.JOB_DEFAULT_MEMORY_GB
+    images = io_utils.list_images(image_dir_abs)
+    if images:
+        estimate = odm_profile.estimate_cost(odm_options, odm_profile.dataset_stats(images), cores)
+        memory_gb = max(memory_gb, round(estimate['memory_gb'], 1))
+    return queue.submit(image_dir_abs, project_name=project_name, priority=priority,
+                        max_retries=config.JOB_MAX_RETRIES, cores=cores, memory_gb=memory_gb,
+                        odm_options=odm_options)
+
+def run_flight_job(job: Dict[str, Any]) -> bool:
+    """ Выполняет задание очереди: пайплайн полета с проектом и папкой результатов OUTPUT_DIR_REL/<проект>. """
+    output_dir_abs = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL)
+    odm_options = dict(job['odm_options'] or config.ODM_OPTIONS)
+    odm_options['max-concurrency'] = job['cores'] # Задание не должно превышать выделенные ему ядра
+    stats = main_pipeline(
+        input_dir_abs=job['image_dir'],
+        project_name=job['project_name'],
+        results_dir_abs=os.path.join(output_dir_abs, job['project_name']),
+        staging_dir_abs=os.path.join(config.PROJECT_ROOT, config.STAGING_DIR_REL, job['project_name']),
+        odm_options=odm_options
+    )
+    return bool(stats and stats.get("ortho_found"))
+
+def open_job_queue() -> job_queue.JobQueue:
+    return job_queue.JobQueue(os.path.join(config.PROJECT_ROOT, config.JOB_QUEUE_DB_REL))
+
+def run_job_queue(until_empty: bool = True):
+    """ Запускает планировщик очереди полетов с бюджетом ресурсов узла из config. """
+    queue = open_job_queue()
+    params = config.JOB_SCHEDULER_PARAMS
+    total_memory_gb = params.get('total_memory_gb') or odm_profile.host_resources()['memory_available_gb'] or 8.0
+    scheduler = job_queue.JobScheduler(
+        queue, run_flight_job,
+        total_cores=params.get('total_cores') or os.cpu_count() or 1,
+        total_memory_gb=total_memory_gb,
+        max_parallel_jobs=params.get('max_parallel_jobs', 2),
+        poll_interval_s=params.get('poll_interval_s', 5.0)
+    )
+    scheduler.run(until_empty=until_empty)
+
+# --- Конвейер потока полетов (стадии перекрываются между полетами) ---
+
+def run_flights_pipelined(flight_dirs: List[str]) -> Dict[str, Any]:
+    """
+    Обрабатывает несколько полетов конвейером: ODM (асинхронный процесс контейнера),
+    подготовка результатов и анализ (в пулах потоков) - со своими лимитами из
+    ORCHESTRATOR_STAGE_LIMITS. Проект каждого полета - OUTPUT_DIR_REL/<имя папки полета>.
+    """
+    output_base_abs = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL)
+
+    async def odm_stage(flight: Dict[str, Any]) -> Dict[str, Any]:
+        project_path = os.path.join(output_base_abs, flight['project_name'])
+        images = io_utils.list_images(flight['image_dir'])
+        if not images:
+            return {'stop': True, 'error': 'no input images'}
+        loop = asyncio.get_running_loop()
+        # Та же подготовка, что в main_pipeline: предобработка, отбор по ROI, автоподбор опций
+        prepared = await loop.run_in_executor(
+            None, prepare_odm_inputs, images, flight['image_dir'],
+            os.path.join(config.PROJECT_ROOT, config.STAGING_DIR_REL, flight['project_name']), flight['results_dir'])
+        if prepared is None:
+            return {'stop': True, 'error': 'no images left for ODM after preparation'}
+        images, odm_options, profile = prepared['images'], prepared['odm_options'], prepared['profile']
+        run_key, run_files = None, None
+        if config.ODM_RUN_CACHE:
+            cache_hit, run_key, run_files = await loop.run_in_executor(
+                None, run_cache.check_run_cache, project_path, images, odm_options,
+                config.ODM_RUN_METHOD, config.ODM_DOCKER_IMAGE)
+            if cache_hit:
+                return {'odm_cache_hit': True, 'image_count': len(images)}
+            run_cache.invalidate_run_cache(project_path)
+        odm_kwargs = dict(
+            max_retries=config.ODM_MAX_RETRIES, resume=config.ODM_RESUME,
+            metrics_path=os.path.join(flight['results_dir'], config.ODM_METRICS_FILENAME),
+            progress_callback=log_odm_progress,
+            resource_metrics_path=(os.path.join(flight['results_dir'], config.ODM_RESOURCE_METRICS_FILENAME)
+                                   if config.ODM_RESOURCE_SAMPLING else None),
+            resource_prom_path=(os.path.join(flight['results_dir'], config.ODM_RESOURCE_PROM_FILENAME)
+                                if config.ODM_RESOURCE_SAMPLING else None),
+            resource_sample_interval_s=config.ODM_RESOURCE_SAMPLE_INTERVAL_S
+        )
+        odm_started = time.time()
+        try:
+            if config.ODM_SPLIT_ENABLED:
+                # Split-merge управляет своими подмоделями синхронно - выполняется в потоке
+                odm_success = await loop.run_in_executor(None, functools.partial(
+                    odm_runner.run_odm_split, prepared['image_dir'], output_base_abs, flight['project_name'],
+                    odm_options, config.ODM_RUN_METHOD, config.ODM_DOCKER_IMAGE,
+                    **config.ODM_SPLIT_PARAMS, **odm_kwargs))
+            else:
+                odm_success = await odm_runner.run_odm_async(
+                    prepared['image_dir'], output_base_abs, flight['project_name'], odm_options,
+                    config.ODM_RUN_METHOD, config.ODM_DOCKER_IMAGE, **odm_kwargs)
+        except helpers.OdmError:
+            record_odm_history(profile, False, odm_started, flight['results_dir'])
+            raise
+        record_odm_history(profile, odm_success, odm_started, flight['results_dir'])
+        if not odm_success:
+            raise helpers.OdmError(f"ODM failed for project '{flight['project_name']}'")
+        if run_key:
+            run_cache.save_run_cache(project_path, run_key, run_files)
+        return {'odm_cache_hit': False, 'image_count': len(images)}
+
+    def postprocess_stage(flight: Dict[str, Any]) -> Dict[str, Any]:
+        outputs = prepare_odm_outputs(os.path.join(output_base_abs, flight['project_name']), flight['results_dir'])
+        return dict(outputs, stop=not outputs['analysis_ortho_path'])
+
+    def analysis_stage(flight: Dict[str, Any]) -> Dict[str, Any]:
+        results = run_analysis(flight['analysis_ortho_path'], flight['results_dir'],
+                               dsm_path=flight['dsm_path'], dtm_path=flight['dtm_path'])
+        return {'analysis_count': len(results) if results is not None else None}
+
+    limits = config.ORCHESTRATOR_STAGE_LIMITS
+    pipeline = orchestrator.FlightOrchestrator([
+        orchestrator.Stage('odm', odm_stage, limits.get('odm', 1)),
+        orchestrator.Stage('postprocess', postprocess_stage, limits.get('postprocess', 2)),
+        orchestrator.Stage('analysis', analysis_stage, limits.get('analysis', 1)),
+    ])
+    flights = []
+    for flight_dir in flight_dirs:
+        project_name = job_queue.project_name_from_dir(flight_dir)
+        results_dir = os.path.join(output_base_abs, project_name)
+        os.makedirs(results_dir, exist_ok=True)
+        flights.append({'image_dir': flight_dir, 'project_name': project_name, 'results_dir': results_dir})
+    summary = pipeline.run(flights)
+    io_utils.save_json(summary, os.path.join(output_base_abs, config.ORCHESTRATOR_SUMMARY_FILENAME))
+    return summary
+
+# --- Командная строка ---
+
+def check_docker() -> bool:
+    """ Проверяет Docker, если ODM запускается через него (результат кэшируется в odm_runner). """
+    if config.ODM_RUN_METHOD != 'docker':
+        return True
+    logger.info("Проверка доступности Docker...")
+    if odm_runner.command_available('docker', '--version'):
+        logger.info("Docker найден и доступен.")
+        return True
+    logger.error("Docker не найден или не отвечает. "
+                 "Убедитесь, что Docker установлен, запущен и доступен из этой среды (WSL).")
+    return False
+
+def run_profiled(name: str, func, *args, **kwargs):
+    """
+    Выполняет этап под корневым интервалом профиля; при PROFILING_ENABLED все helpers.Timer
+    записываются как вложенные интервалы, сводка и трасса сохраняются в OUTPUT_DIR_REL.
+    """
+    output_dir_abs = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL)
+    if config.PROFILING_ENABLED:
+        helpers.profiler.start(trace_python_allocations=config.PROFILING_TRACEMALLOC)
+    try:
+        with helpers.Timer(name):
+            return func(*args, **kwargs)
+    finally:
+        if config.PROFILING_ENABLED:
+            helpers.profiler.stop()
+            try:
+                helpers.profiler.export_json(os.path.join(output_dir_abs, config.PROFILE_SUMMARY_FILENAME))
+                helpers.profiler.export_chrome_trace(os.path.join(output_dir_abs, config.PROFILE_TRACE_FILENAME))
+            except (OSError, TypeError) as profile_e:
+                logger.warning(f"Не удалось сохранить профиль выполнения: {profile_e}")
+
+def cmd_odm(args: argparse.Namespace) -> int:
+    """ Подкоманда odm: ODM и публикация ортофото/DSM без анализа. """
+    if not check_docker():
+        return 1
+    input_dir_abs = os.path.abspath(args.images) if args.images else None
+    try:
+        stats = run_profiled("Пайплайн ODM", main_pipeline, input_dir_abs=input_dir_abs,
+                             project_name=args.project, analyze=False)
+    except helpers.PipelineError as pe:
+        logger.critical(f"Критическая ошибка пайплайна: {pe}", exc_info=False)
+        return 1
+    return 0 if stats and stats.get("ortho_found") else 1
+
+def cmd_analyze(args: argparse.Namespace) -> int:
+    """ Подкоманда analyze: анализ готового ортофотоплана без запуска ODM. """
+    orthophoto_path = os.path.abspath(args.ortho)
+    if not os.path.exists(orthophoto_path):
+        logger.error(f"Ортофотоплан не найден: {orthophoto_path}")
+        return 1
+    output_dir_abs = os.path.abspath(args.output)
+    os.makedirs(output_dir_abs, exist_ok=True)
+    results = run_profiled("Анализ", run_analysis, orthophoto_path, output_dir_abs,
+                           dsm_path=os.path.abspath(args.dsm) if args.dsm else None,
+                           dtm_path=os.path.abspath(args.dtm) if args.dtm else None,
+                           layout_path=os.path.abspath(args.layout), force=True)
+    return 0 if results else 1
+
+def cmd_report(args: argparse.Namespace) -> int:
+    """ Подкоманда report: сводка и отчет по уже сохраненным результатам (без ODM и анализа). """
+    output_dir_abs = os.path.abspath(args.output)
+    results_path = os.path.join(output_dir_abs, config.ANALYSIS_RESULTS_FILENAME)
+    analysis_results = io_utils.load_json(results_path) if os.path.exists(results_path) else None
+    odm_project_path = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL, args.project or config.ODM_PROJECT_NAME)
+    dsm_path = io_utils.find_odm_results(odm_project_path)[1] if os.path.isdir(odm_project_path) else None
+    input_dir_abs = os.path.join(config.PROJECT_ROOT, config.INPUT_IMAGE_DIR_REL)
+    stats = {
+        "image_count": len(io_utils.list_images(input_dir_abs)) if os.path.isdir(input_dir_abs) else 'N/A',
+        "odm_resolution": config.ODM_OPTIONS.get("orthophoto-resolution", "N/A"),
+        "ortho_found": os.path.exists(os.path.join(output_dir_abs, config.ORTHO_OUTPUT_FILENAME)),
+        "dsm_found": bool(dsm_path),
+        "analysis_run": analysis_results is not None,
+        "analysis_results": analysis_results,
+    }
+    if analysis_results is None:
+        logger.warning(f"Результаты анализа не найдены: {results_path}")
+    else:
+        occupied = sum(1 for r in analysis_results if r.get('status') == 'occupied')
+        logger.info(f"Результаты анализа ({len(analysis_results)} слотов): {occupied} занято, "
+                    f"{len(analysis_results) - occupied} свободно.")
+    generate_report(stats, output_dir_abs)
+    return 0 if analysis_results is not None else 1
+
+def cmd_all(args: argparse.Namespace) -> int:
+    """ Подкоманда all (по умолчанию): очередь полетов, конвейер полетов или полный пайплайн. """
     logger.info("--- Инициализация Оркестратора ---")
     logger.info(f"Корневая папка проекта: '{config.PROJECT_ROOT}'")
     # Вычисляем абсолютные пути для вывода в консоль
-    abs_input_dir = os.path.join(config.PROJECT_ROOT, config.INPUT_IMAGE_DIR_REL)
+    abs_input_dir = os.path.abspath(args.images) if getattr(args, 'images', None) else \
+        os.path.join(config.PROJECT_ROOT, config.INPUT_IMAGE_DIR_REL)
     abs_output_analysis_dir = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL)
     logger.info(f"Каталог входа ('images'): '{abs_input_dir}'")
     logger.info(f"Каталог выхода (анализ, логи): '{abs_output_analysis_dir}'")
     logger.info("-" * 40)
 
     # Проверка Docker перед запуском (если используется)
-    if config.ODM_RUN_METHOD == 'docker':
-        logger.info("Проверка доступности Docker...")
-        try:
-            subprocess.run(['docker', '--version'], check=True, capture_output=True, text=True)
-            logger.info("Docker найден и доступен.")
-        except (FileNotFoundError, subprocess.CalledProcessError) as docker_err:
-            logger.error(f"Docker не найден или не отвечает: {docker_err}. "
-                         f"Убедитесь, что Docker установлен, запущен и доступен из этой среды (WSL).")
-            exit(1) # Завершаем, если Docker недоступен, но выбран
-        except Exception as docker_e:
-             logger.error(f"Непредвиденная ошибка при проверке Docker: {docker_e}")
-             # Не завершаем, но предупреждаем
+    if not check_docker():
+        return 1 # Завершаем, если Docker недоступен, но выбран
 
     # Проверка наличия входных изображений
-    if not io_utils.list_images(abs_input_dir):
+    if config.JOB_QUEUE_ENABLED:
+        logger.info("Обработка очереди полетов...")
+        try:
+            run_job_queue()
+        except Exception as e:
+            logger.critical(f"Необработанная ошибка планировщика очереди: {e}", exc_info=True)
+            return 1
+    elif config.ORCHESTRATOR_ENABLED:
+        # Каждая подпапка FLIGHTS_DIR_REL с изображениями - отдельный полет
+        flights_dir_abs = os.path.join(config.PROJECT_ROOT, config.FLIGHTS_DIR_REL)
+        flight_dirs = sorted(os.path.join(flights_dir_abs, d) for d in os.listdir(flights_dir_abs)
+                             if io_utils.list_images(os.path.join(flights_dir_abs, d))) if os.path.isdir(flights_dir_abs) else []
+        if not flight_dirs:
+            logger.error(f"!!! Полеты не найдены в '{flights_dir_abs}' (ожидаются подпапки с изображениями). !!!")
+            return 1
+        logger.info(f"Конвейерная обработка {len(flight_dirs)} полетов...")
+        try:
+            run_flights_pipelined(flight_dirs)
+        except Exception as e:
+            logger.critical(f"Необработанная ошибка конвейера полетов: {e}", exc_info=True)
+            return 1
+    elif not io_utils.list_images(abs_input_dir):
         logger.error(f"!!! Входные изображения не найдены в '{abs_input_dir}'. Пожалуйста, добавьте изображения в папку 'images' и перезапустите. !!!")
+        return 1
     else:
         logger.info("Запуск основного пайплайна обработки...")
         try:
-            main_pipeline() # Запускаем основной пайплайн
+            stats = run_profiled("Пайплайн", main_pipeline, input_dir_abs=abs_input_dir,
+                                 project_name=getattr(args, 'project', None)) # Запускаем основной пайплайн
         except helpers.PipelineError as pe: # Ловим наши кастомные ошибки
              logger.critical(f"Критическая ошибка пайплайна: {pe}", exc_info=False)
+             return 1
         except Exception as e: # Ловим все остальные непредвиденные ошибки
              logger.critical(f"Необработанная фатальная ошибка в main: {e}", exc_info=True)
+             return 1
+        if not stats:
+            return 1
 
     logger.info("--- Завершение работы программы ---")
+    return 0
+
+def cmd_submit(args: argparse.Namespace) -> int:
+    """ Подкоманда submit: ставит папку полета в очередь заданий (выполняет подкоманда queue). """
+    image_dir_abs = os.path.abspath(args.images)
+    if not os.path.isdir(image_dir_abs) or not io_utils.list_images(image_dir_abs):
+        logger.error(f"Входные изображения не найдены в '{image_dir_abs}'.")
+        return 1
+    try:
+        job_id = submit_flight(open_job_queue(), image_dir_abs, project_name=args.project, priority=args.priority)
+    except ValueError as e:
+        logger.error(f"Полет не поставлен в очередь: {e}")
+        return 1
+    logger.info(f"Задание #{job_id} в очереди. Запуск обработки: python main.py queue")
+    return 0
+
+def cmd_queue(args: argparse.Namespace) -> int:
+    """ Подкоманда queue: список заданий (--list) или выполнение очереди до опустошения (--serve - без выхода). """
+    if args.list:
+        for job in open_job_queue().list_jobs():
+            logger.info(f"#{job['id']:<4} {job['status']:<9} приоритет {job['priority']:<3} "
+                        f"{job['project_name']} ({job['image_dir']})")
+        return 0
+    if not check_docker():
+        return 1
+    try:
+        run_profiled("Очередь полетов", run_job_queue, until_empty=not args.serve)
+    except Exception as e:
+        logger.critical(f"Необработанная ошибка планировщика очереди: {e}", exc_info=True)
+        return 1
+    return 0
+
+def cmd_watch(args: argparse.Namespace) -> int:
+    """
+    Подкоманда watch: снимки предобрабатываются по мере загрузки в папку, каждый полет
+    после условия полноты (WATCH_PARAMS) обрабатывается полным пайплайном в проекте
+    <project>_<flight_id> (в фоновом потоке, по одному полету; прием снимков не
+    прерывается). Отбор кадров - по PREINGEST_PARAMS.
+    """
+    if not check_docker():
+        return 1
+    from core import watch_ingest
+    watch_dir_abs = os.path.abspath(args.images) if args.images else \
+        os.path.join(config.PROJECT_ROOT, config.INPUT_IMAGE_DIR_REL)
+    output_base_abs = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL)
+    base_project = args.project or config.ODM_PROJECT_NAME
+    failed = []
+
+    def on_ready(report: Dict[str, Any]):
+        project_name = f"{base_project}_{report['flight_id']}"
+        results_dir = os.path.join(output_base_abs, project_name)
+        os.makedirs(results_dir, exist_ok=True)
+        try:
+            stats = run_profiled(f"Пайплайн {project_name}", main_pipeline, input_dir_abs=report['staging_dir'],
+                                 project_name=project_name, results_dir_abs=results_dir,
+                                 staging_dir_abs=report['staging_dir'], preingest_report=report)
+        except helpers.PipelineError as pe:
+            logger.critical(f"Критическая ошибка пайплайна полета {project_name}: {pe}", exc_info=False)
+            stats = None
+        if not stats:
+            failed.append(project_name)
+            return
+        logger.info(f"Полет {project_name} обработан: {time.monotonic() - report['last_activity']:.0f} с "
+                    f"от последнего загруженного снимка до результатов.")
+
+    params = config.WATCH_PARAMS
+    try:
+        watch_ingest.watch_and_ingest(
+            watch_dir_abs, os.path.join(config.PROJECT_ROOT, config.STAGING_DIR_REL), on_ready,
+            config.PREINGEST_PARAMS, poll_interval_s=params['poll_interval_s'], use_inotify=params['use_inotify'],
+            stable_s=params['stable_seconds'], quiet_period_s=params['quiet_period_s'],
+            expected_count=params['expected_count'], manifest_filename=params['manifest_filename'],
+            min_images=params['min_images'], once=args.once)
+    except KeyboardInterrupt:
+        logger.info("Наблюдение за папкой остановлено.")
+    return 1 if failed else 0
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    output_dir_abs = os.path.join(config.PROJECT_ROOT, config.OUTPUT_DIR_REL)
+    parser = argparse.ArgumentParser(description="Ортофотоплан (OpenDroneMap) и анализ парковочных мест. "
+                                                 "Без подкоманды выполняется 'all'.")
+    subparsers = parser.add_subparsers(dest='command', metavar='{odm,analyze,report,submit,queue,watch,all}')
+
+    def add_flight_arguments(subparser: argparse.ArgumentParser):
+        subparser.add_argument('--images', help="Папка входных снимков (по умолчанию INPUT_IMAGE_DIR_REL)")
+        subparser.add_argument('--project', help="Имя проекта ODM (по умолчанию ODM_PROJECT_NAME)")
+
+    odm_parser = subparsers.add_parser('odm', help="Только ODM: ортофотоплан и DSM без анализа")
+    add_flight_arguments(odm_parser)
+    odm_parser.set_defaults(handler=cmd_odm)
+
+    analyze_parser = subparsers.add_parser('analyze', help="Анализ готового ортофотоплана (без ODM)")
+    analyze_parser.add_argument('--ortho', default=os.path.join(output_dir_abs, config.ORTHO_OUTPUT_FILENAME),
+                                help="Ортофотоплан (по умолчанию - опубликованный в OUTPUT_DIR_REL)")
+    analyze_parser.add_argument('--layout', default=os.path.join(config.PROJECT_ROOT, config.PARKING_LAYOUT_DIR_REL,
+                                                                 config.PARKING_ANALYSIS_PARAMS.get('slot_filename', '')),
+                                help="Файл разметки слотов (JSON)")
+    analyze_parser.add_argument('--dsm', help="DSM для режимов занятости 'dsm' и 'fused'")
+    analyze_parser.add_argument('--dtm', help="DTM (необязательно, иначе земля оценивается по DSM)")
+    analyze_parser.add_argument('--output', default=output_dir_abs, help="Папка для результатов анализа")
+    analyze_parser.set_defaults(handler=cmd_analyze)
+
+    report_parser = subparsers.add_parser('report', help="Сводка и отчет по сохраненным результатам")
+    report_parser.add_argument('--output', default=output_dir_abs, help="Папка с результатами анализа")
+    report_parser.add_argument('--project', help="Имя проекта ODM (по умолчанию ODM_PROJECT_NAME)")
+    report_parser.set_defaults(handler=cmd_report)
+
+    submit_parser = subparsers.add_parser('submit', help="Поставить полет в очередь заданий")
+    submit_parser.add_argument('--images', required=True, help="Папка снимков полета")
+    submit_parser.add_argument('--project', help="Имя проекта ODM (по умолчанию - по имени папки)")
+    submit_parser.add_argument('--priority', type=int, default=0, help="Приоритет (больший выполняется раньше)")
+    submit_parser.set_defaults(handler=cmd_submit)
+
+    queue_parser = subparsers.add_parser('queue', help="Выполнить очередь заданий")
+    queue_parser.add_argument('--serve', action='store_true', help="Не завершаться при пустой очереди (ждать новых заданий)")
+    queue_parser.add_argument('--list', action='store_true', help="Только показать задания")
+    queue_parser.set_defaults(handler=cmd_queue)
+
+    watch_parser = subparsers.add_parser('watch', help="Обработка снимков по мере загрузки полета в папку")
+    add_flight_arguments(watch_parser)
+    watch_parser.add_argument('--once', action='store_true', help="Завершить работу после первого полета")
+    watch_parser.set_defaults(handler=cmd_watch)
+
+    all_parser = subparsers.add_parser('all', help="Полный пайплайн: ODM, анализ, отчет (по умолчанию)")
+    add_flight_arguments(all_parser)
+    all_parser.set_defaults(handler=cmd_all)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    return getattr(args, 'handler', cmd_all)(args)
+
+# --- Точка входа ---
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+"""
+Минимальный NodeODM-совместимый сервер задач для тестов режима run_method='worker'.
+
+Поддерживает подмножество API, которое использует core.odm_worker: /info,
+/task/new/init, /task/new/upload/<uuid>, /task/new/commit/<uuid>, /task/<uuid>/info,
+/task/<uuid>/output, /task/restart, /task/cancel, /task/remove и
+/task/<uuid>/download/all.zip. ODM не запускается: задача "выполняется" за несколько
+опросов статуса и выдает строки лога со стадиями ODM и архив с ортофотопланом.
+
+Слушает 127.0.0.1 (url 'http://127.0.0.1:<port>') или Unix-сокет ('unix://<путь>').
+"""
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import urllib.parse
+import uuid as uuid_lib
+import zipfile
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+
+TASK_QUEUED, TASK_RUNNING, TASK_FAILED, TASK_COMPLETED, TASK_CANCELED = 10, 20, 30, 40, 50
+# Стадии, которые "выполняет" задача (имена совпадают со стадиями ODM для --rerun-from)
+STUB_STAGES = ['dataset', 'opensfm', 'odm_dem', 'odm_orthophoto']
+ORTHOPHOTO_BYTES = b'stub orthophoto'
+
+class StubNodeOdm:
+    """
+    Состояние сервера и счетчики вызовов для проверок в тестах.
+
+    polls_to_finish - сколько опросов /info задача остается в статусе RUNNING;
+    fail_runs - сколько первых запусков каждой задачи падает на стадии fail_stage.
+    """
+    def __init__(self, polls_to_finish: int = 2, fail_runs: int = 0, fail_stage: str = 'opensfm',
+                 token: Optional[str] = None):
+        self.polls_to_finish = polls_to_finish
+        self.fail_runs = fail_runs
+        self.fail_stage = fail_stage
+        self.token = token
+        self.tasks: Dict[str, Dict[str, Any]] = {}
+        self.created = 0
+        self.uploads = 0
+        self.restarts: List[Optional[str]] = [] # rerun-from каждого перезапуска
+        self.removed: List[str] = []
+        self.lock = threading.Lock()
+        self.url: Optional[str] = None
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    # --- Запуск и остановка ---
+
+    def start_tcp(self) -> str:
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        return self._serve()
+
+    def start_unix(self, socket_path: str) -> str:
+        self._server = _ThreadingUnixHTTPServer(socket_path, self._handler_class())
+        self.url = f"unix://{socket_path}"
+        return self._serve()
+
+    def _serve(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if isinstance(self._server, _ThreadingUnixHTTPServer) and os.path.exists(self._server.server_address):
+                os.remove(self._server.server_address)
+            self._server = None
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(_StubHandler):
+            server_state = stub
+        return Handler
+
+    # --- Жизненный цикл задачи ---
+
+    def start_run(self, task: Dict[str, Any], rerun_from: Optional[str] = None):
+        task['runs'] += 1
+        task['status'] = TASK_RUNNING
+        task['polls'] = 0
+        task['rerun_from'] = rerun_from
+
+    def advance(self, task: Dict[str, Any]):
+        """ Очередной опрос статуса: по истечении polls_to_finish запуск завершается и пишет лог. """
+        if task['status'] != TASK_RUNNING:
+            return
+        task['polls'] += 1
+        if task['polls'] < self.polls_to_finish:
+            return
+        stages = STUB_STAGES[STUB_STAGES.index(task['rerun_from']):] if task['rerun_from'] else STUB_STAGES
+        failing = task['runs'] <= self.fail_runs
+        for stage in stages:
+            task['output'].append(f"[INFO]    Running {stage} stage")
+            if failing and stage == self.fail_stage:
+                task['output'].append(f"[ERROR]   Stub failure in {stage}")
+                task['status'] = TASK_FAILED
+                task['error'] = f"Stub failure in {stage}"
+                return
+            task['output'].append(f"[INFO]    Finished {stage} stage")
+        task['output'].append("[INFO]    ODM app finished")
+        task['status'] = TASK_COMPLETED
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, handler):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, handler)
+
+class _StubHandler(BaseHTTPRequestHandler):
+    server_state: StubNodeOdm = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass # Без вывода в stderr (у Unix-сокета нет адреса клиента)
+
+    def address_string(self) -> str:
+        return 'unix' if self.server.socket.family == socket.AF_UNIX else super().address_string()
+
+    # --- Ответы ---
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, data: Any, status: int = 200):
+        self._send(status, json.dumps(data).encode('utf-8'))
+
+    def _task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        task = self.server_state.tasks.get(task_id)
+        if task is None:
+            self._json({'error': f"Task {task_id} not found"}) # NodeODM отвечает 200 с полем error
+        return task
+
+    # --- Разбор запроса ---
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _form(self) -> Dict[str, Any]:
+        """ Поля формы: {'имя': значение} и файлы {'имя': (имя_файла, байты)}. """
+        body = self._read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=policy.default).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + body)
+            fields = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                fields[name] = (part.get_filename(), payload) if part.get_filename() else payload.decode('utf-8')
+            return fields
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+    def _route(self):
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        if self.server_state.token and query.get('token', [None])[0] != self.server_state.token:
+            self._json({'error': 'Invalid authentication token'}, status=403)
+            return None, None
+        return [p for p in parsed.path.split('/') if p], query
+
+    def do_GET(self):
+        parts, query = self._route()
+        if parts is None:
+            return
+        state = self.server_state
+        if parts == ['info']:
+            self._json({'version': 'stub', 'taskQueueCount': len(state.tasks), 'maxParallelTasks': 1})
+        elif len(parts) == 3 and parts[0] == 'task' and parts[2] == 'info':
+            with state.lock:
+                task = self._task(parts[1])
+                if task is None:
+                    return
+                state.advance(task)
+                status = {'code': task['status']}
+                if task.get('error') and task['status'] == TASK_FAILED:
+                    status['errorMessage'] = task['error']
+                self._json({'uuid': parts[1], 'name': task['name'], 'status': status,
+                            'imagesCount': len(task['images'])})
+        elif len(parts) == 3 and parts[0] == 'task' and parts[2] == 'output':
+            task = self._task(parts[1])
+            if task is not None:
+                self._json(task['output'][int(query.get('line', ['0'])[0]):])
+        elif len(parts) == 4 and parts[0] == 'task' and parts[2] == 'download' and parts[3] == 'all.zip':
+            task = self._task(parts[1])
+            if task is None:
+                return
+            if task['status'] != TASK_COMPLETED:
+                self._json({'error': 'Task is not completed'}, status=400)
+                return
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as archive:
+                archive.writestr('odm_orthophoto/odm_orthophoto.tif', ORTHOPHOTO_BYTES)
+                archive.writestr('images.json', json.dumps(sorted(task['images'])))
+            self._send(200, buffer.getvalue(), content_type='application/zip')
+        else:
+            self._json({'error': f"Unknown endpoint {self.path}"}, status=404)
+
+    def do_POST(self):
+        parts, _ = self._route()
+        if parts is None:
+            return
+        state = self.server_state
+        fields = self._form()
+        with state.lock:
+            if parts == ['task', 'new', 'init']:
+                task_id = str(uuid_lib.uuid4())
+                state.tasks[task_id] = {'name': fields.get('name'), 'options': json.loads(fields.get('options') or '[]'),
+                                        'images': {}, 'status': None, 'runs': 0, 'polls': 0, 'output': [],
+                                        'rerun_from': None}
+                state.created += 1
+                self._json({'uuid': task_id})
+            elif parts[:3] == ['task', 'new', 'upload'] and len(parts) == 4:
+                task = self._task(parts[3])
+                if task is not None:
+                    file_name, data = fields['images']
+                    task['images'][file_name] = data
+                    state.uploads += 1
+                    self._json({'success': True})
+            elif parts[:3] == ['task', 'new', 'commit'] and len(parts) == 4:
+                task = self._task(parts[3])
+                if task is not None:
+                    state.start_run(task)
+                    self._json({'uuid': parts[3]})
+            elif parts == ['task', 'restart']:
+                task = self._task(fields.get('uuid'))
+                if task is not None:
+                    options = {o['name']: o['value'] for o in json.loads(fields.get('options') or '[]')}
+                    state.restarts.append(options.get('rerun-from'))
+                    state.start_run(task, options.get('rerun-from'))
+                    self._json({'success': True})
+            elif parts == ['task', 'cancel']:
+                task = self._task(fields.get('uuid'))
+                if task is not None:
+                    task['status'] = TASK_CANCELED
+                    self._json({'success': True})
+            elif parts == ['task', 'remove']:
+                if state.tasks.pop(fields.get('uuid'), None) is not None:
+                    state.removed.append(fields.get('uuid'))
+                    self._json({'success': True})
+                else:
+                    self._json({'error': 'Task not found'})
+            else:
+                self._json({'error': f"Unknown endpoint {self.path}"}, status=404)
@@ -0,0 +1,75 @@
+"""
+Тесты инкрементального анализа: сопоставление состояния слотов между запусками.
+"""
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin
+
+from core import incremental_analysis
+
+class BrightnessModel:
+    """ Модель-заглушка: светлая площадка занята, темная свободна. """
+    batch_size = 8
+
+    def __init__(self):
+        self.calls = 0
+
+    def classify_batch(self, images):
+        self.calls += len(images)
+        return [('occupied', 0.9) if image.mean() > 127 else ('vacant', 0.9) for image in images]
+
+def _write_orthophoto(path, bright_columns):
+    """ Растр 500x100 пикселей (0.1 м) из пяти площадок 10x10 м; bright_columns - индексы светлых площадок. """
+    data = np.full((3, 100, 500), 30, dtype=np.uint8)
+    for column in bright_columns:
+        data[:, :, column * 100:(column + 1) * 100] = 220
+    with rasterio.open(path, 'w', driver='GTiff', width=500, height=100, count=3, dtype='uint8',
+                       crs='EPSG:32637', transform=from_origin(500000, 6000010, 0.1, 0.1)) as dst:
+        dst.write(data)
+
+def _slot(x0, slot_id=None):
+    slot = {'geometry': [[x0 + 1, 6000009], [x0 + 9, 6000009], [x0 + 9, 6000001], [x0 + 1, 6000001]]}
+    if slot_id is not None:
+        slot['id'] = slot_id
+    return slot
+
+def test_state_keys_unique_for_missing_and_duplicate_ids():
+    """ Уникальный id остается ключом; слоты без id и с повтором id различаются по геометрии. """
+    slots = [_slot(500000, 'a'), _slot(500000), _slot(500010), _slot(500000, 'b'), _slot(500010, 'b'),
+             _slot(500010)]
+    keys = incremental_analysis.slot_state_keys(slots)
+    assert keys[0] == 'a'
+    assert len(set(keys)) == len(keys)
+    assert keys[1] != keys[2] and keys[3] != keys[4]
+    # Совпадающие слоты без id различаются номером повтора, ключи стабильны между запусками
+    assert keys[5] == keys[2] + '#2'
+    assert incremental_analysis.slot_state_keys(slots) == keys
+
+@pytest.mark.parametrize('slot_id', [None, 'dup'])
+def test_slots_without_unique_ids_keep_own_state(tmp_path, slot_id):
+    """ Слоты без id или с одинаковым id получают и сохраняют каждый свой статус. """
+    orthophoto = str(tmp_path / 'ortho.tif')
+    state_path = str(tmp_path / 'state.npz')
+    slots = [_slot(500000 + 10 * column, slot_id) for column in range(5)]
+    _write_orthophoto(orthophoto, bright_columns=[0])
+
+    model = BrightnessModel()
+    first = incremental_analysis.analyze_parking_slots_incremental(orthophoto, model, slots, state_path)
+    assert [r['status'] for r in first] == ['occupied'] + ['vacant'] * 4
+    assert all(r['slot_id'] == (slot_id or 'unknown_slot') for r in first)
+    assert model.calls == 5
+
+    model = BrightnessModel()
+    second = incremental_analysis.analyze_parking_slots_incremental(orthophoto, model, slots, state_path)
+    assert [r['status'] for r in second] == ['occupied'] + ['vacant'] * 4
+    assert all(r['reused'] for r in second) and model.calls == 0
+
+    # Меняется только последняя площадка - пересчитывается только она
+    _write_orthophoto(orthophoto, bright_columns=[0, 4])
+    model, stats = BrightnessModel(), {}
+    third = incremental_analysis.analyze_parking_slots_incremental(orthophoto, model, slots, state_path, stats=stats)
+    assert [r['status'] for r in third] == ['occupied'] + ['vacant'] * 3 + ['occupied']
+    assert [r['reused'] for r in third] == [True] * 4 + [False]
+    assert stats['recomputed'] == 1 and model.calls == 1
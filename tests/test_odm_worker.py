@@ -0,0 +1,135 @@
+import json
+import os
+
+import pytest
+
+from core import odm_runner, odm_worker
+from nodeodm_stub import StubNodeOdm, ORTHOPHOTO_BYTES
+
+@pytest.fixture(params=['tcp', 'unix'])
+def stub(request, tmp_path):
+    server = StubNodeOdm()
+    if request.param == 'tcp':
+        server.start_tcp()
+    else:
+        server.start_unix(str(tmp_path / 'nodeodm.sock'))
+    yield server
+    server.stop()
+
+@pytest.fixture
+def images(tmp_path):
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    for i in range(3):
+        (image_dir / f'IMG_{i:03d}.JPG').write_bytes(os.urandom(3 * 1024 * 1024 + i)) # Больше одного блока загрузки
+    return str(image_dir)
+
+def _worker_params(url, **overrides):
+    params = {'url': url, 'autostart': False, 'poll_interval_s': 0.01, 'upload_parallel': 2}
+    params.update(overrides)
+    return params
+
+def _run_state(project_path):
+    with open(os.path.join(project_path, odm_runner.RUN_STATE_FILENAME), encoding='utf-8') as f:
+        return json.load(f)
+
+def test_submit_wait_download(stub, images, tmp_path):
+    """ Загрузка по одному файлу, опрос статуса с логом и распаковка all.zip (TCP и Unix-сокет). """
+    client = odm_worker.NodeOdmClient(stub.url)
+    assert client.is_alive()
+    image_paths = sorted(os.path.join(images, n) for n in os.listdir(images))
+    task_id = odm_worker.submit_task(client, 'flight', image_paths, {'dsm': True, 'fast-orthophoto': False},
+                                     upload_parallel=2)
+    task = stub.tasks[task_id]
+    assert task['options'] == [{'name': 'dsm', 'value': True}]
+    assert {name: len(data) for name, data in task['images'].items()} == \
+        {os.path.basename(p): os.path.getsize(p) for p in image_paths}
+
+    lines = []
+    info = odm_worker.wait_task(client, task_id, on_line=lines.append, poll_interval_s=0.01)
+    assert info['status']['code'] == odm_worker.TASK_COMPLETED
+    assert lines[-1].endswith('ODM app finished')
+
+    project_path = str(tmp_path / 'project')
+    odm_worker.download_results(client, task_id, project_path)
+    with open(os.path.join(project_path, 'odm_orthophoto', 'odm_orthophoto.tif'), 'rb') as f:
+        assert f.read() == ORTHOPHOTO_BYTES
+    assert not [n for n in os.listdir(project_path) if n.endswith('.zip')]
+
+def test_unknown_task_raises(stub):
+    client = odm_worker.NodeOdmClient(stub.url)
+    with pytest.raises(odm_worker.helpers.OdmError):
+        client.task_info('missing')
+
+def test_token_is_sent():
+    server = StubNodeOdm(token='secret')
+    server.start_tcp()
+    try:
+        assert not odm_worker.NodeOdmClient(server.url).is_alive()
+        assert odm_worker.NodeOdmClient(server.url, token='secret').is_alive()
+    finally:
+        server.stop()
+
+def test_run_odm_worker_end_to_end(stub, images, tmp_path):
+    output_base = str(tmp_path / 'output')
+    assert odm_runner.run_odm(images, output_base, 'flight', {'dsm': True}, run_method='worker',
+                              worker_params=_worker_params(stub.url))
+    project_path = os.path.join(output_base, 'flight')
+    assert os.path.exists(os.path.join(project_path, 'odm_orthophoto', 'odm_orthophoto.tif'))
+    assert _run_state(project_path)['status'] == 'completed'
+    assert stub.created == 1 and stub.uploads == 3
+    assert len(stub.removed) == 1 # Задача удалена с сервера после скачивания
+
+def test_run_odm_worker_restarts_failed_task(images, tmp_path):
+    """ Упавшая задача перезапускается на сервере с упавшей стадии без повторной загрузки. """
+    server = StubNodeOdm(fail_runs=1, fail_stage='opensfm')
+    server.start_tcp()
+    try:
+        output_base = str(tmp_path / 'output')
+        assert odm_runner.run_odm(images, output_base, 'flight', {'dsm': True}, run_method='worker',
+                                  max_retries=1, worker_params=_worker_params(server.url))
+        assert server.created == 1 and server.uploads == 3
+        assert server.restarts == ['opensfm']
+        assert _run_state(os.path.join(output_base, 'flight'))['status'] == 'completed'
+    finally:
+        server.stop()
+
+def test_run_odm_worker_failure_without_retries(images, tmp_path):
+    server = StubNodeOdm(fail_runs=1)
+    server.start_tcp()
+    try:
+        output_base = str(tmp_path / 'output')
+        with pytest.raises(odm_worker.helpers.OdmError):
+            odm_runner.run_odm(images, output_base, 'flight', {}, run_method='worker', max_retries=0,
+                               worker_params=_worker_params(server.url, remove_after_download=False))
+        state = _run_state(os.path.join(output_base, 'flight'))
+        assert state['status'] == 'failed' and state['worker_task'] in server.tasks
+    finally:
+        server.stop()
+
+def test_run_odm_worker_reattaches_after_interrupt(images, tmp_path, monkeypatch):
+    """ Прерванный запуск подключается к той же задаче сервера (uuid из состояния запуска). """
+    server = StubNodeOdm(polls_to_finish=3)
+    server.start_tcp()
+    try:
+        output_base = str(tmp_path / 'output')
+        params = _worker_params(server.url)
+        original_wait = odm_worker.wait_task
+
+        def interrupted_wait(*args, **kwargs):
+            raise KeyboardInterrupt
+        monkeypatch.setattr(odm_worker, 'wait_task', interrupted_wait)
+        with pytest.raises(KeyboardInterrupt):
+            odm_runner.run_odm(images, output_base, 'flight', {'dsm': True}, run_method='worker', worker_params=params)
+        project_path = os.path.join(output_base, 'flight')
+        task_id = _run_state(project_path)['worker_task']
+        assert _run_state(project_path)['status'] == 'running'
+
+        monkeypatch.setattr(odm_worker, 'wait_task', original_wait)
+        assert odm_runner.run_odm(images, output_base, 'flight', {'dsm': True}, run_method='worker',
+                                  worker_params=params)
+        assert server.created == 1 and server.uploads == 3 # Повторной загрузки нет
+        assert server.removed == [task_id]
+        assert os.path.exists(os.path.join(project_path, 'odm_orthophoto', 'odm_orthophoto.tif'))
+    finally:
+        server.stop()
@@ -0,0 +1,162 @@
+"""
+Тесты режима наблюдения: стабильность файлов и условия готовности полета.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+from core import watch_ingest
+
+PARAMS = {'workers': 2, 'blur_threshold': 50.0, 'duplicate_hash_distance': 4, 'duplicate_max_distance_m': 2.0,
+          'downscale_max_side': None, 'jpeg_quality': 95}
+
+def _write_jpeg(path, seed):
+    """ Резкий снимок (шум) - проходит порог размытости и не совпадает с другими по pHash. """
+    image = (np.random.default_rng(seed).random((120, 160, 3)) * 255).astype(np.uint8)
+    assert cv2.imwrite(str(path), image)
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        yield pool
+
+def _ingest(tmp_path, executor, stable_s=1.0):
+    upload = tmp_path / 'upload'
+    upload.mkdir(exist_ok=True)
+    return watch_ingest.FlightIngest(str(upload), str(tmp_path / 'staging'), executor, PARAMS, stable_s=stable_s)
+
+def _poll(ingest, now):
+    """ Опрос папки с ожиданием сканирования принятых файлов. """
+    ingest.poll(now)
+    wait(list(ingest._pending))
+    ingest.poll(now)
+
+def _staged(staging_dir):
+    """ Снимки в staging (без служебного .staging_manifest.json). """
+    return sorted(name for name in os.listdir(staging_dir) if not name.startswith('.'))
+
+# --- StableFileTracker ---
+
+def test_tracker_waits_until_file_stops_changing(tmp_path):
+    """ Файл выдается только после stable_s секунд без изменения размера и mtime. """
+    path = tmp_path / 'IMG_001.JPG'
+    path.write_bytes(b'\xff\xd8' + b'x' * 100)
+    tracker = watch_ingest.StableFileTracker(stable_s=10.0)
+    assert tracker.update(str(tmp_path), now=0.0) == []
+    assert tracker.update(str(tmp_path), now=5.0) == []
+    with open(path, 'ab') as f:
+        f.write(b'y' * 100 + b'\xff\xd9') # Дописан - отсчет начинается заново
+    assert tracker.update(str(tmp_path), now=12.0) == []
+    assert tracker.unstable_count == 1 and tracker.last_activity == 12.0
+    assert tracker.update(str(tmp_path), now=21.0) == []
+    stable = tracker.update(str(tmp_path), now=22.0)
+    assert [p for p, _ in stable] == [str(path)]
+    assert stable[0][1] == ('IMG_001.JPG', path.stat().st_size, path.stat().st_mtime_ns)
+    assert tracker.unstable_count == 0
+    assert tracker.update(str(tmp_path), now=30.0) == [] # Выдается один раз
+
+def test_tracker_waits_longer_for_jpeg_without_eoi(tmp_path):
+    """ JPEG без маркера конца (копирование могло зависнуть) ждет в _NO_EOI_STABLE_FACTOR раз дольше. """
+    (tmp_path / 'IMG_001.JPG').write_bytes(b'\xff\xd8' + b'x' * 100)
+    tracker = watch_ingest.StableFileTracker(stable_s=1.0)
+    tracker.update(str(tmp_path), now=0.0)
+    assert tracker.update(str(tmp_path), now=1.0) == []
+    assert len(tracker.update(str(tmp_path), now=float(watch_ingest._NO_EOI_STABLE_FACTOR))) == 1
+
+def test_tracker_skips_partial_hidden_and_processed_files(tmp_path):
+    """ Временные, скрытые и пустые файлы, а также сигнатуры прошлых полетов не выдаются. """
+    for name in ('IMG_001.JPG.part', '.IMG_002.JPG', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'\xff\xd8data\xff\xd9')
+    (tmp_path / 'IMG_003.JPG').write_bytes(b'')
+    done = tmp_path / 'IMG_004.JPG'
+    done.write_bytes(b'\xff\xd8data\xff\xd9')
+    tracker = watch_ingest.StableFileTracker(
+        stable_s=1.0, ignored={('IMG_004.JPG', done.stat().st_size, done.stat().st_mtime_ns)})
+    tracker.update(str(tmp_path), now=0.0)
+    assert tracker.update(str(tmp_path), now=5.0) == []
+    # Перезаписанный файл с тем же именем - новый снимок
+    done.write_bytes(b'\xff\xd8new data\xff\xd9')
+    tracker.update(str(tmp_path), now=6.0)
+    assert [os.path.basename(p) for p, _ in tracker.update(str(tmp_path), now=7.0)] == ['IMG_004.JPG']
+
+# --- FlightIngest.ready_reason ---
+
+def test_ready_after_quiet_period(tmp_path, executor):
+    """ Тишина quiet_period_s после последнего изменения запускает полет; новый файл ее прерывает. """
+    ingest = _ingest(tmp_path, executor)
+    for i in range(3):
+        _write_jpeg(tmp_path / 'upload' / f'IMG_{i:03d}.JPG', i)
+    _poll(ingest, 0.0)
+    _poll(ingest, 1.0)
+    assert len(ingest.scans) == 3
+    assert _staged(ingest.staging_dir) == ['IMG_000.JPG', 'IMG_001.JPG', 'IMG_002.JPG']
+    assert ingest.ready_reason(quiet_period_s=5.0, now=4.0) is None
+    assert ingest.ready_reason(quiet_period_s=5.0, min_images=4, now=6.0) is None
+    assert 'без новых файлов' in ingest.ready_reason(quiet_period_s=5.0, now=6.0)
+
+    _write_jpeg(tmp_path / 'upload' / 'IMG_003.JPG', 3)
+    _poll(ingest, 6.0)
+    assert ingest.ready_reason(quiet_period_s=5.0, now=10.0) is None # Новый файл еще не стабилен
+    _poll(ingest, 7.0)
+    # Тишина отсчитывается от последнего изменения в папке (появления файла)
+    assert ingest.ready_reason(quiet_period_s=5.0, now=10.0) is None
+    assert '4 снимков' in ingest.ready_reason(quiet_period_s=5.0, now=11.0)
+
+def test_ready_at_expected_count(tmp_path, executor):
+    """ Набранное expected_count запускает полет без ожидания тишины. """
+    ingest = _ingest(tmp_path, executor)
+    for i in range(3):
+        _write_jpeg(tmp_path / 'upload' / f'IMG_{i:03d}.JPG', i)
+    _poll(ingest, 0.0)
+    _poll(ingest, 1.0)
+    assert ingest.ready_reason(expected_count=4, now=1.0) is None
+    assert 'ожидаемое число' in ingest.ready_reason(expected_count=3, now=1.0)
+
+def test_ready_when_manifest_complete(tmp_path, executor):
+    """ С манифестом полет запускается, когда получены все перечисленные снимки; тишина не учитывается. """
+    ingest = _ingest(tmp_path, executor)
+    upload = tmp_path / 'upload'
+    names = [f'IMG_{i:03d}.JPG' for i in range(3)]
+    (upload / 'flight_manifest.json').write_text(json.dumps({'images': [f'DCIM/{n}' for n in names]}))
+    for i, name in enumerate(names[:2]):
+        _write_jpeg(upload / name, i)
+    _poll(ingest, 0.0)
+    _poll(ingest, 1.0)
+    manifest = watch_ingest.read_manifest(str(upload / 'flight_manifest.json'))
+    assert manifest == set(names)
+    assert ingest.ready_reason(quiet_period_s=5.0, manifest=manifest, now=100.0) is None
+
+    _write_jpeg(upload / names[2], 2)
+    _poll(ingest, 100.0)
+    _poll(ingest, 101.0)
+    assert 'манифеста' in ingest.ready_reason(quiet_period_s=5.0, manifest=manifest, now=101.0)
+
+def test_read_manifest_text_format(tmp_path):
+    """ Текстовый манифест: имя на строку, комментарии и пустые строки пропускаются. """
+    path = tmp_path / 'manifest.txt'
+    path.write_text("# полет 1\nIMG_001.JPG\n\n  sub/IMG_002.JPG\n")
+    assert watch_ingest.read_manifest(str(path)) == {'IMG_001.JPG', 'IMG_002.JPG'}
+    assert watch_ingest.read_manifest(str(tmp_path / 'missing.txt')) is None
+
+def test_watch_and_ingest_polling_once(tmp_path):
+    """ Наблюдение опросом папки: полет собирается, дубликат отбрасывается, on_ready получает отчет. """
+    upload = tmp_path / 'upload'
+    upload.mkdir()
+    for i in range(3):
+        _write_jpeg(upload / f'IMG_{i:03d}.JPG', i)
+    (upload / 'IMG_003.JPG').write_bytes((upload / 'IMG_002.JPG').read_bytes()) # Дубликат
+    reports = []
+    watch_ingest.watch_and_ingest(str(upload), str(tmp_path / 'staging'), reports.append, PARAMS,
+                                  poll_interval_s=0.05, use_inotify=False, stable_s=0.1, quiet_period_s=0.3,
+                                  min_images=2, once=True)
+    assert len(reports) == 1
+    report = reports[0]
+    assert 'без новых файлов' in report['ready_reason']
+    assert len(report['kept']) == 3 and len(report['rejected']) == 1
+    assert _staged(report['staging_dir']) == sorted(os.path.basename(p) for p in report['staged_images'])
+    assert report['idle_s'] >= 0.3
@@ -2,7 +2,15 @@ import logging
 import sys
 import os
 import time
-from typing import Optional
+import json
+import threading
+import tracemalloc
+from typing import Optional, Dict, Any, List
+
+try:
+    import resource # Только Unix: пиковый RSS процесса
+except ImportError:
+    resource = None
 
 _logger_initialized = False
 
@@ -78,18 +86,213 @@ def format_time(seconds: float) -> str:
         else: return f"{secs:02d} сек"
     except Exception: return f"{seconds:.2f} сек"
 
+class Profiler:
+    """
+    Накопитель иерархических интервалов (span), записываемых через Timer.
+
+    Для каждого интервала сохраняются время начала/длительность, вложенность (родитель,
+    глубина, поток), текущий RSS в начале/конце, прирост пикового RSS процесса и, если
+    включен tracemalloc, прирост и пик памяти Python-аллокаций внутри интервала.
+    """
+    def __init__(self, trace_python_allocations: bool = False):
+        self.enabled = False
+        self.trace_python_allocations = trace_python_allocations
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._next_id = 1
+
+    def start(self, trace_python_allocations: Optional[bool] = None):
+        """ Включает запись интервалов (и tracemalloc, если запрошено). """
+        if trace_python_allocations is not None:
+            self.trace_python_allocations = trace_python_allocations
+        if self.trace_python_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        if self.trace_python_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self._origin = time.perf_counter()
+
+    def _new_id(self) -> int:
+        with self._lock:
+            span_id = self._next_id
+            self._next_id += 1
+            return span_id
+
+    def record(self, span: Dict[str, Any]):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> Dict[str, Any]:
+        """ Сводка: агрегаты по именам интервалов и дерево интервалов. """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda sp: sp['start_s'])
+        by_name: Dict[str, Dict[str, Any]] = {}
+        for span in spans:
+            agg = by_name.setdefault(span['name'], {'count': 0, 'total_s': 0.0, 'max_s': 0.0,
+                                                    'max_rss_peak_delta_mb': 0.0})
+            agg['count'] += 1
+            agg['total_s'] = round(agg['total_s'] + span['duration_s'], 6)
+            agg['max_s'] = max(agg['max_s'], span['duration_s'])
+            agg['max_rss_peak_delta_mb'] = max(agg['max_rss_peak_delta_mb'], span.get('rss_peak_delta_mb') or 0.0)
+        children: Dict[Optional[int], List[Dict[str, Any]]] = {}
+        for span in spans:
+            children.setdefault(span['parent_id'], []).append(span)
+
+        def _tree(parent_id):
+            return [dict({k: v for k, v in sp.items() if k not in ('id', 'parent_id')},
+                         children=_tree(sp['id'])) for sp in children.get(parent_id, [])]
+        known_ids = {sp['id'] for sp in spans}
+        roots = [sp['id'] for sp in spans if sp['parent_id'] not in known_ids]
+        tree = []
+        for root_id in roots:
+            root = next(sp for sp in spans if sp['id'] == root_id)
+            tree.append(dict({k: v for k, v in root.items() if k not in ('id', 'parent_id')},
+                             children=_tree(root_id)))
+        return {'span_count': len(spans), 'by_name': by_name, 'tree': tree}
+
+    def export_json(self, path: str):
+        """ Сохраняет сводку в JSON. """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=4, ensure_ascii=False, default=str)
+        logging.info(f"Профиль выполнения сохранен в: {path}")
+
+    def export_chrome_trace(self, path: str):
+        """ Сохраняет интервалы в формате Chrome Trace Event (chrome://tracing, Perfetto). """
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for span in spans:
+            args = dict(span['attributes'])
+            for key in ('rss_start_mb', 'rss_end_mb', 'rss_peak_delta_mb', 'py_alloc_delta_mb', 'py_peak_mb', 'error'):
+                if span.get(key) is not None:
+                    args[key] = span[key]
+            events.append({'name': span['name'], 'cat': 'pipeline', 'ph': 'X', 'pid': pid, 'tid': span['thread'],
+                           'ts': round(span['start_s'] * 1e6, 1), 'dur': round(span['duration_s'] * 1e6, 1),
+                           'args': args})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False, default=str)
+        logging.info(f"Трасса выполнения (Chrome trace) сохранена в: {path}")
+
+# Глобальный профилировщик пайплайна (по умолчанию выключен)
+profiler = Profiler()
+_span_stack = threading.local()
+
+def _current_rss_mb() -> Optional[float]:
+    """ Текущий RSS процесса в МБ (Linux /proc) или None. """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0, 2)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def _peak_rss_mb() -> Optional[float]:
+    """ Пиковый RSS процесса с момента запуска в МБ (ru_maxrss: КБ в Linux, байты в macOS). """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1048576.0 if sys.platform == 'darwin' else 1024.0), 2)
+
+def current_span() -> Optional["Timer"]:
+    """ Активный Timer текущего потока (для добавления атрибутов из вложенного кода) или None. """
+    stack = getattr(_span_stack, 'stack', None)
+    return stack[-1] if stack else None
+
 class Timer:
-    """ Контекстный менеджер для замера времени. """
-    def __init__(self, message: str = "Время выполнения", log_level=logging.INFO):
+    """
+    Контекстный менеджер для замера времени.
+
+    Если включен helpers.profiler, каждый Timer записывается как интервал с вложенностью,
+    памятью и атрибутами (передаются как именованные аргументы или через set_attribute/add).
+    """
+    def __init__(self, message: str = "Время выполнения", log_level=logging.INFO, **attributes):
         self.message = message
         self.log_level = log_level
+        self.attributes: Dict[str, Any] = dict(attributes)
         self._start_time = None
+        self._parent: Optional["Timer"] = None
+        self._span_id: Optional[int] = None
+        self._rss_start = None
+        self._peak_rss_start = None
+        self._py_current_start = None
+        self._py_peak = 0
+
+    def set_attribute(self, key: str, value: Any):
+        """ Устанавливает атрибут интервала (например, число слотов). """
+        self.attributes[key] = value
+
+    def add(self, key: str, value: float = 1):
+        """ Увеличивает числовой атрибут интервала (например, прочитанные байты). """
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def _absorb_python_peak(self):
+        """ Учитывает пик tracemalloc с последнего сброса в текущем интервале и сбрасывает пик. """
+        if tracemalloc.is_tracing():
+            self._py_peak = max(self._py_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
 
     def __enter__(self):
+        stack = getattr(_span_stack, 'stack', None)
+        if stack is None:
+            stack = _span_stack.stack = []
+        self._parent = stack[-1] if stack else None
+        if profiler.enabled:
+            self._span_id = profiler._new_id()
+            self._rss_start = _current_rss_mb()
+            self._peak_rss_start = _peak_rss_mb()
+            if tracemalloc.is_tracing():
+                if self._parent is not None:
+                    self._parent._absorb_python_peak()
+                else:
+                    tracemalloc.reset_peak()
+                self._py_current_start = tracemalloc.get_traced_memory()[0]
+        stack.append(self)
         self._start_time = time.perf_counter()
         logging.log(self.log_level, f"[Timer] Старт: {self.message}")
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        elapsed_time = time.perf_counter() - self._start_time
-        logging.log(self.log_level, f"[Timer] Завершено: {self.message} за {format_time(elapsed_time)} ({elapsed_time:.3f} сек)")
\ No newline at end of file
+        end_time = time.perf_counter()
+        elapsed_time = end_time - self._start_time
+        stack = getattr(_span_stack, 'stack', [])
+        if stack and stack[-1] is self:
+            stack.pop()
+        if profiler.enabled and self._span_id is not None:
+            span = {
+                'id': self._span_id,
+                'parent_id': self._parent._span_id if self._parent is not None else None,
+                'name': self.message,
+                'thread': threading.get_ident(),
+                'depth': len(stack),
+                'start_s': round(self._start_time - profiler._origin, 6),
+                'duration_s': round(elapsed_time, 6),
+                'attributes': dict(self.attributes),
+                'rss_start_mb': self._rss_start,
+                'rss_end_mb': _current_rss_mb(),
+                'rss_peak_delta_mb': None,
+                'error': exc_type.__name__ if exc_type else None,
+            }
+            peak_end = _peak_rss_mb()
+            if peak_end is not None and self._peak_rss_start is not None:
+                span['rss_peak_delta_mb'] = round(peak_end - self._peak_rss_start, 2)
+            if tracemalloc.is_tracing() and self._py_current_start is not None:
+                current, peak = tracemalloc.get_traced_memory()
+                self._py_peak = max(self._py_peak, peak)
+                span['py_alloc_delta_mb'] = round((current - self._py_current_start) / 1048576.0, 3)
+                span['py_peak_mb'] = round(self._py_peak / 1048576.0, 3)
+                if self._parent is not None:
+                    self._parent._py_peak = max(self._parent._py_peak, self._py_peak)
+                tracemalloc.reset_peak()
+            profiler.record(span)
+        logging.log(self.log_level, f"[Timer] Завершено: {self.message} за {format_time(elapsed_time)} ({elapsed_time:.3f} сек)")